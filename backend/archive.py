@@ -0,0 +1,131 @@
+import io
+import os
+import zipfile
+import threading
+import time
+from collections import OrderedDict
+from typing import Iterator, List, Optional, Tuple
+
+######################################
+## ダウンロード用zipの生成
+######################################
+
+## zipfileの書き込み先。書かれたバイト列をため込み、少しずつ取り出せるようにする
+class _ChunkBuffer(io.RawIOBase):
+    def __init__(self):
+        self._chunks: List[bytes] = []
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def pop(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks = []
+        return data
+
+
+## (zip内のパス, 実ファイルのパス) の一覧からzipを組み立て、ファイルごとに逐次出力する
+## 一時ディレクトリやディスク上のzipを作らず、メモリ上で必要な分だけ保持する
+def iter_zip(files: List[Tuple[str, str]]) -> Iterator[bytes]:
+    buffer = _ChunkBuffer()
+    with zipfile.ZipFile(buffer, mode="w", compression=zipfile.ZIP_DEFLATED) as zf:
+        for arcname, path in files:
+            zf.write(path, arcname)
+            chunk = buffer.pop()
+            if chunk:
+                yield chunk
+    chunk = buffer.pop()
+    if chunk:
+        yield chunk
+
+
+## ファイル一覧の内容が変わったかどうかを判定するための署名
+def files_signature(files: List[Tuple[str, str]]) -> Tuple:
+    signature = []
+    for arcname, path in files:
+        stat = os.stat(path)
+        signature.append((arcname, stat.st_mtime_ns, stat.st_size))
+    return tuple(signature)
+
+
+## バッチ全体のzipのキャッシュキー（ジョブ単位のzipはジョブIDをキーにする）
+def batch_archive_key(batch_id: str) -> str:
+    return f"batch:{batch_id}"
+
+
+## 最近作成したzipを合計サイズの上限付きで保持する（LRU）
+class ArchiveCache:
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        ## キー -> (ファイルの状態, zipの内容, 登録時刻)
+        self._entries: "OrderedDict[str, Tuple[Tuple, bytes, float]]" = OrderedDict()
+        self._total_bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key: str, signature: Tuple) -> Optional[bytes]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] != signature:
+                return None
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def set(self, key: str, signature: Tuple, data: bytes):
+        if len(data) > self.max_bytes:
+            return
+        with self._lock:
+            self._discard(key)
+            self._entries[key] = (signature, data, time.monotonic())
+            self._total_bytes += len(data)
+            while self._total_bytes > self.max_bytes:
+                _, (_, evicted, _) = self._entries.popitem(last=False)
+                self._total_bytes -= len(evicted)
+
+    def discard(self, key: str):
+        with self._lock:
+            self._discard(key)
+
+    def _discard(self, key: str):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._total_bytes -= len(entry[1])
+
+    ## 登録から max_age 秒以上経ったものを破棄し、破棄した件数を返す
+    def evict_expired(self, max_age: float) -> int:
+        cutoff = time.monotonic() - max_age
+        with self._lock:
+            expired = [key for key, entry in self._entries.items() if entry[2] < cutoff]
+            for key in expired:
+                self._discard(key)
+        return len(expired)
+
+    ## zipを逐次出力しつつ、出力し終えたものをキャッシュに登録する
+    ## キャッシュ済みで内容が変わっていなければそれを返す
+    def iter_cached_zip(self, key: str, files: List[Tuple[str, str]]) -> Iterator[bytes]:
+        signature = files_signature(files)
+        cached = self.get(key, signature)
+        if cached is not None:
+            yield cached
+            return
+
+        chunks = []
+        for chunk in iter_zip(files):
+            chunks.append(chunk)
+            yield chunk
+        self.set(key, signature, b"".join(chunks))
+
+    @property
+    def total_bytes(self) -> int:
+        return self._total_bytes
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+## 環境変数から上限を読み込んでキャッシュを作成する（0で無効）
+def create_archive_cache() -> ArchiveCache:
+    return ArchiveCache(int(os.environ.get("ZIP_CACHE_MAX_BYTES", 50 * 1024 * 1024)))
@@ -0,0 +1,257 @@
+import json
+import random
+import asyncio
+import threading
+from io import BytesIO
+from typing import Optional
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import StreamingResponse
+from PIL import Image
+
+######################################
+## ベンチマーク用のプロバイダの代替
+######################################
+
+## Anthropic Messages API はローカルのHTTPサーバー（ANTHROPIC_BASE_URL で接続先を差し替える）、
+## Gemini と Imagen はSDKのクラスをプロセス内の偽物に差し替えて、APIを使わずにパイプライン全体を動かす
+## 応答までの時間・出力の速さ・出力サイズは引数で調整できる
+
+
+######################################
+## 生成物のダミー
+######################################
+
+## ヒーローセクションを含むHTML（画像適用の差分が当たるよう id="hero" を含める）
+def mock_html(size: int) -> str:
+    sections = []
+    index = 0
+    while sum(len(section) for section in sections) < size:
+        index += 1
+        sections.append(
+            f'<section class="section-{index}"><h2>セクション{index}</h2>'
+            f"<p>{'ダミーのテキストです。' * 8}</p></section>\n"
+        )
+    return (
+        '<!DOCTYPE html>\n<html lang="ja">\n<head>\n<meta charset="UTF-8">\n'
+        '<link rel="stylesheet" href="style.css">\n</head>\n<body>\n'
+        "<header><nav>ナビゲーション</nav></header>\n"
+        '<section id="hero" class="hero"><h1>サービス名</h1><p>キャッチコピー</p></section>\n'
+        + "".join(sections)
+        + "<footer>フッター</footer>\n"
+        "<script>\n        lucide.createIcons();\n</script>\n"
+        '<script src="script.js"></script>\n</body>\n</html>'
+    )
+
+
+def mock_css(size: int) -> str:
+    rules = []
+    index = 0
+    while sum(len(rule) for rule in rules) < size:
+        index += 1
+        rules.append(f".section-{index} {{\n  padding: 64px 24px;\n  color: #333;\n}}\n")
+    return "/* ダミーのスタイル */\n.hero {\n  height: 800px;\n}\n" + "".join(rules)
+
+
+def mock_js(size: int) -> str:
+    lines = []
+    index = 0
+    while sum(len(line) for line in lines) < size:
+        index += 1
+        lines.append(f"  document.querySelectorAll('.section-{index}').forEach((el) => el.classList.add('ready'));\n")
+    return "// ダミーのスクリプト\ndocument.addEventListener('DOMContentLoaded', () => {\n" + "".join(lines) + "});\n"
+
+
+######################################
+## Anthropic Messages API（HTTP・ストリーミング）
+######################################
+
+def _sse(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+## 指示の内容から、どのエージェントの呼び出しかを判断してダミーの出力を返す
+def mock_text_output(instruction: str, output_chars: int) -> str:
+    if "JavaScript" in instruction:
+        return f"```javascript\n{mock_js(output_chars)}\n```"
+    if "CSS" in instruction:
+        return f"```css\n{mock_css(output_chars)}\n```"
+    return f"```html\n{mock_html(output_chars)}\n```"
+
+
+class MockAnthropicServer:
+    def __init__(
+        self,
+        time_to_first_token: float = 1.0,
+        tokens_per_second: float = 200.0,
+        output_chars: int = 8000,
+        port: int = 0,
+    ):
+        self.time_to_first_token = time_to_first_token
+        self.tokens_per_second = tokens_per_second
+        self.output_chars = output_chars
+        self.port = port
+        self.requests = 0
+        self._server: Optional[uvicorn.Server] = None
+        self._thread: Optional[threading.Thread] = None
+        self.app = self._create_app()
+
+    def _create_app(self) -> FastAPI:
+        app = FastAPI()
+
+        @app.post("/v1/messages")
+        async def messages(request: Request):
+            body = await request.json()
+            self.requests += 1
+            text = mock_text_output(body["messages"][0]["content"][-1].get("text", ""), self.output_chars)
+            ## 1トークン = 4文字として、指定の速さで少しずつ返す
+            chunk_chars = 40
+            chunk_interval = chunk_chars / 4 / self.tokens_per_second
+            input_chars = sum(len(block.get("text", "")) for block in body.get("system", []) if isinstance(block, dict))
+            input_chars += sum(len(block.get("text", "")) for block in body["messages"][0]["content"])
+
+            async def stream():
+                yield _sse("message_start", {
+                    "type": "message_start",
+                    "message": {
+                        "id": f"msg_mock_{self.requests}", "type": "message", "role": "assistant",
+                        "model": body["model"], "content": [], "stop_reason": None, "stop_sequence": None,
+                        "usage": {
+                            "input_tokens": input_chars // 4, "output_tokens": 1,
+                            "cache_creation_input_tokens": 0, "cache_read_input_tokens": 0,
+                        },
+                    },
+                })
+                yield _sse("content_block_start", {
+                    "type": "content_block_start", "index": 0, "content_block": {"type": "text", "text": ""},
+                })
+                await asyncio.sleep(self.time_to_first_token)
+                for start in range(0, len(text), chunk_chars):
+                    yield _sse("content_block_delta", {
+                        "type": "content_block_delta", "index": 0,
+                        "delta": {"type": "text_delta", "text": text[start:start + chunk_chars]},
+                    })
+                    await asyncio.sleep(chunk_interval)
+                yield _sse("content_block_stop", {"type": "content_block_stop", "index": 0})
+                yield _sse("message_delta", {
+                    "type": "message_delta",
+                    "delta": {"stop_reason": "end_turn", "stop_sequence": None},
+                    "usage": {"output_tokens": len(text) // 4},
+                })
+                yield _sse("message_stop", {"type": "message_stop"})
+
+            return StreamingResponse(stream(), media_type="text/event-stream")
+
+        return app
+
+    ## 別スレッド（別のイベントループ）で起動し、計測対象のイベントループに負荷をかけないようにする
+    def start(self):
+        config = uvicorn.Config(self.app, host="127.0.0.1", port=self.port, log_level="warning")
+        self._server = uvicorn.Server(config)
+        self._thread = threading.Thread(target=self._server.run, daemon=True)
+        self._thread.start()
+        while not self._server.started:
+            if not self._thread.is_alive():
+                raise RuntimeError("モックサーバーの起動に失敗しました")
+            threading.Event().wait(0.05)
+        self.port = self._server.servers[0].sockets[0].getsockname()[1]
+
+    @property
+    def base_url(self) -> str:
+        return f"http://127.0.0.1:{self.port}"
+
+    def stop(self):
+        if self._server is not None:
+            self._server.should_exit = True
+            self._thread.join(timeout=5)
+
+
+######################################
+## Gemini（google.generativeai の GenerativeModel を差し替え）
+######################################
+
+class _Obj:
+    def __init__(self, **kwargs):
+        self.__dict__.update(kwargs)
+
+
+class _FakeGeminiResponse:
+    def __init__(self, text: str, prompt: str = ""):
+        self.text = text
+        self.usage_metadata = _Obj(prompt_token_count=len(prompt) // 4, candidates_token_count=len(text) // 4)
+
+
+class FakeGenerativeModel:
+    latency = 1.0
+    output_chars = 8000
+
+    def __init__(self, model_name=None, generation_config=None, system_instruction=None, **kwargs):
+        self.generation_config = generation_config or {}
+        self.system_instruction = system_instruction or ""
+
+    async def generate_content_async(self, prompt):
+        await asyncio.sleep(self.latency)
+        if "画像生成のプロンプト" in self.system_instruction:
+            return _FakeGeminiResponse(json.dumps({"placeholder_css_1.jpg": "a mock hero image"}), prompt)
+        if self.generation_config.get("response_mime_type") == "application/json":
+            return _FakeGeminiResponse(json.dumps({
+                "selector": "section#hero",
+                "html": '<section id="hero" class="hero"><div class="hero-overlay"><h1>サービス名</h1></div></section>',
+                "css": ".hero { background-image: url(${imageBase64}); background-size: cover; }",
+            }), prompt)
+        if "画像を適用する" not in self.system_instruction:
+            ## フェイルオーバー・ヘッジでワイヤーフレーム・CSS・JSの生成に使われた場合
+            instruction = prompt.rsplit("**タスク:**", 1)[-1] if "**タスク:**" in prompt else ""
+            return _FakeGeminiResponse(mock_text_output(instruction, self.output_chars), prompt)
+        ## 全文を出力させる方式：入力のHTML/CSSをそのまま返す
+        html = prompt.split("**HTML**:", 1)[-1].split("**CSS**:", 1)[0]
+        css = prompt.split("**CSS**:", 1)[-1] + "\n.hero { background-image: url(${imageBase64}); }"
+        return _FakeGeminiResponse(f"```html\n{html}\n```\n```css\n{css}\n```", prompt)
+
+
+def install_fake_gemini(latency: float, output_chars: int = 8000):
+    import lp_generator
+
+    FakeGenerativeModel.latency = latency
+    FakeGenerativeModel.output_chars = output_chars
+    lp_generator.genai.GenerativeModel = FakeGenerativeModel
+
+
+######################################
+## Imagen（google.genai のクライアントを差し替え）
+######################################
+
+## ノイズ画像（圧縮が効きにくく、実際の写真に近いサイズになる）
+def mock_image_bytes(width: int, height: int) -> bytes:
+    rng = random.Random(0)
+    image = Image.frombytes("RGB", (width, height), rng.randbytes(width * height * 3))
+    buffer = BytesIO()
+    image.save(buffer, "PNG")
+    return buffer.getvalue()
+
+
+## client.aio.models.generate_images（非同期）と client.models.generate_images（同期・Ray用）を持つ
+class FakeImagenClient:
+    def __init__(self, latency: float, image_bytes: bytes):
+        self.latency = latency
+        self.image_bytes = image_bytes
+        self.aio = _Obj(models=_Obj(generate_images=self._generate_images_async))
+        self.models = _Obj(generate_images=self._generate_images)
+
+    def _response(self):
+        return _Obj(generated_images=[_Obj(image=_Obj(image_bytes=self.image_bytes))])
+
+    async def _generate_images_async(self, model, prompt, config=None):
+        await asyncio.sleep(self.latency)
+        return self._response()
+
+    def _generate_images(self, model, prompt, config=None):
+        threading.Event().wait(self.latency)
+        return self._response()
+
+
+def install_fake_imagen(latency: float, width: int, height: int):
+    import image_worker
+
+    image_bytes = mock_image_bytes(width, height)
+    image_worker.create_imagen_client = lambda: FakeImagenClient(latency, image_bytes)
@@ -0,0 +1,327 @@
+import os
+import sys
+import json
+import math
+import time
+import asyncio
+import argparse
+import tempfile
+import threading
+import contextlib
+from datetime import datetime
+from typing import Any, Dict, List, Optional
+
+######################################
+## LP生成APIの負荷ベンチマーク
+######################################
+
+## プロバイダをローカルの代替（bench/mock_providers.py）に差し替えてAPIサーバーを起動し、
+## POST /api/generate と状態のポーリングで N 件のジョブを並行に流して、
+## スループット・ステップごとのレイテンシ・イベントループの遅延・メモリ使用量を報告する
+##
+## 使い方（backend ディレクトリで実行）:
+##   python -m bench.run_benchmark --jobs 20 --concurrency 10
+##   python -m bench.run_benchmark --jobs 50 --concurrency 50 --workers 8 --json result.json
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+STEP_IDS = ["wireframe", "css", "js", "image", "apply-image"]
+TERMINAL_STATUSES = {"completed", "error"}
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description="LP生成APIの負荷ベンチマーク")
+    parser.add_argument("--jobs", type=int, default=20, help="投入するジョブの総数")
+    parser.add_argument("--concurrency", type=int, default=10, help="同時に実行中にしておくジョブ数")
+    parser.add_argument("--workers", type=int, default=4, help="APIサーバーのジョブワーカー数（JOB_WORKER_COUNT）")
+    parser.add_argument("--poll-interval", type=float, default=1.0, help="状態をポーリングする間隔（秒）")
+    parser.add_argument("--claude-ttft", type=float, default=1.0, help="Claudeの最初のトークンまでの時間（秒）")
+    parser.add_argument("--claude-tokens-per-second", type=float, default=200.0, help="Claudeの出力速度")
+    parser.add_argument("--claude-output-chars", type=int, default=8000, help="Claudeの出力サイズ（文字数）")
+    parser.add_argument("--gemini-latency", type=float, default=1.0, help="Geminiの応答時間（秒）")
+    parser.add_argument("--imagen-latency", type=float, default=3.0, help="Imagenの応答時間（秒）")
+    parser.add_argument("--image-size", default="1408x768", help="生成画像のサイズ（幅x高さ）")
+    parser.add_argument("--json", dest="json_path", help="結果をJSONで書き出すパス")
+    parser.add_argument("--verbose", action="store_true", help="サーバー側のログを表示する")
+    return parser.parse_args()
+
+
+## 最近傍順位法によるパーセンタイル
+def percentile(values: List[float], p: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(p / 100 * len(ordered)) - 1)]
+
+
+def summarize(values: List[float]) -> Dict[str, Optional[float]]:
+    return {
+        "count": len(values),
+        "p50": percentile(values, 50),
+        "p95": percentile(values, 95),
+        "p99": percentile(values, 99),
+        "max": max(values) if values else None,
+    }
+
+
+## イベントループの遅延：一定間隔で sleep し、予定より遅れて再開した時間を記録する
+class LoopLagMonitor:
+    def __init__(self, interval: float = 0.05):
+        self.interval = interval
+        self.samples: List[float] = []
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        self._task = asyncio.get_running_loop().create_task(self._run())
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            started = loop.time()
+            await asyncio.sleep(self.interval)
+            self.samples.append(max(0.0, loop.time() - started - self.interval))
+
+
+## プロセスの常駐メモリ（RSS）を定期的に記録する
+class MemorySampler:
+    def __init__(self, interval: float = 0.5):
+        self.interval = interval
+        self.samples: List[int] = []
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+
+    @staticmethod
+    def rss_bytes() -> int:
+        try:
+            with open("/proc/self/statm") as f:
+                return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+        except (OSError, ValueError):
+            import resource
+
+            ## /proc が無い環境ではピーク値で代用する（Linux は KB、macOS はバイト単位）
+            peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            return peak if sys.platform == "darwin" else peak * 1024
+
+    def start(self):
+        self.samples.append(self.rss_bytes())
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        self.samples.append(self.rss_bytes())
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.samples.append(self.rss_bytes())
+
+
+## APIサーバーを別スレッドのイベントループで起動する（遅延の計測もそのループで行う）
+def start_api_server(app, monitor: LoopLagMonitor):
+    import uvicorn
+
+    config = uvicorn.Config(app, host="127.0.0.1", port=0, log_level="warning", lifespan="on")
+    server = uvicorn.Server(config)
+
+    async def serve():
+        monitor.start()
+        await server.serve()
+
+    thread = threading.Thread(target=asyncio.run, args=(serve(),), daemon=True)
+    thread.start()
+    while not server.started:
+        if not thread.is_alive():
+            raise RuntimeError("APIサーバーの起動に失敗しました")
+        time.sleep(0.05)
+    port = server.servers[0].sockets[0].getsockname()[1]
+    return server, thread, f"http://127.0.0.1:{port}"
+
+
+def sample_request(index: int) -> Dict[str, str]:
+    return {
+        "serviceName": f"ベンチマーク{index}",
+        "serviceType": "オンライン英会話スクール",
+        "targetAudience": "社会人",
+        "features": "24時間対応、パーソナルカリキュラム",
+        "testimonials": "講師情報、お客様の声",
+        "companyName": "株式会社サンプル",
+    }
+
+
+def _seconds_between(start: Optional[str], end: Optional[str]) -> Optional[float]:
+    if not start or not end:
+        return None
+    return (datetime.fromisoformat(end) - datetime.fromisoformat(start)).total_seconds()
+
+
+## 1件のジョブを投入し、終了するまでポーリングする
+async def run_job(client, index: int, poll_interval: float) -> Dict[str, Any]:
+    submitted_at = time.monotonic()
+    response = await client.post("/api/generate", json=sample_request(index))
+    response.raise_for_status()
+    job_id = response.json()["jobId"]
+    polls = 0
+    while True:
+        await asyncio.sleep(poll_interval)
+        polls += 1
+        job = (await client.get(f"/api/jobs/{job_id}")).json()
+        if job["status"] in TERMINAL_STATUSES:
+            break
+    started = [step["startedAt"] for step in job["steps"] if step.get("startedAt")]
+    return {
+        "jobId": job_id,
+        "status": job["status"],
+        "error": job.get("error"),
+        "latency": time.monotonic() - submitted_at,
+        "queueWait": _seconds_between(job["createdAt"], min(started)) if started else None,
+        "polls": polls,
+        "steps": {
+            step["id"]: _seconds_between(step.get("startedAt"), step.get("completedAt"))
+            for step in job["steps"]
+        },
+    }
+
+
+async def drive(base_url: str, args) -> Dict[str, Any]:
+    import httpx
+
+    semaphore = asyncio.Semaphore(args.concurrency)
+    async with httpx.AsyncClient(base_url=base_url, timeout=60) as client:
+        async def limited(index: int):
+            async with semaphore:
+                return await run_job(client, index, args.poll_interval)
+
+        started_at = time.monotonic()
+        records = await asyncio.gather(*(limited(index) for index in range(args.jobs)))
+        wall_seconds = time.monotonic() - started_at
+    return {"records": records, "wallSeconds": wall_seconds}
+
+
+def build_report(args, run: Dict[str, Any], lag: LoopLagMonitor, memory: MemorySampler, claude_requests: int) -> Dict[str, Any]:
+    records = run["records"]
+    completed = [record for record in records if record["status"] == "completed"]
+    step_latency = {
+        step_id: summarize([r["steps"][step_id] for r in completed if r["steps"].get(step_id) is not None])
+        for step_id in STEP_IDS
+    }
+    return {
+        "config": {key: value for key, value in vars(args).items() if key not in ("json_path", "verbose")},
+        "jobs": len(records),
+        "completed": len(completed),
+        "errors": [record["error"] for record in records if record["status"] != "completed"],
+        "wallSeconds": run["wallSeconds"],
+        "jobsPerMinute": len(completed) / run["wallSeconds"] * 60 if run["wallSeconds"] else 0,
+        "jobLatencySeconds": summarize([r["latency"] for r in completed]),
+        "queueWaitSeconds": summarize([r["queueWait"] for r in completed if r["queueWait"] is not None]),
+        "stepLatencySeconds": step_latency,
+        "eventLoopLagMs": summarize([sample * 1000 for sample in lag.samples]),
+        "memoryMb": {
+            "start": memory.samples[0] / 2**20,
+            "peak": max(memory.samples) / 2**20,
+            "end": memory.samples[-1] / 2**20,
+        },
+        "claudeRequests": claude_requests,
+    }
+
+
+def _fmt(value: Optional[float], digits: int = 2) -> str:
+    return "-" if value is None else f"{value:.{digits}f}"
+
+
+def print_report(report: Dict[str, Any]):
+    config = report["config"]
+    print("\n== LP生成ベンチマーク ==")
+    print(
+        f"jobs: {report['jobs']} (completed {report['completed']}, error {len(report['errors'])})"
+        f"  concurrency: {config['concurrency']}  workers: {config['workers']}"
+    )
+    print(f"wall time: {report['wallSeconds']:.1f} s  throughput: {report['jobsPerMinute']:.2f} jobs/min")
+    print(f"{'':18}{'p50':>9}{'p95':>9}{'p99':>9}{'max':>9}")
+
+    def row(label: str, summary: Dict[str, Optional[float]], digits: int = 2):
+        print(
+            f"{label:18}{_fmt(summary['p50'], digits):>9}{_fmt(summary['p95'], digits):>9}"
+            f"{_fmt(summary['p99'], digits):>9}{_fmt(summary['max'], digits):>9}"
+        )
+
+    row("job latency (s)", report["jobLatencySeconds"])
+    row("queue wait (s)", report["queueWaitSeconds"])
+    for step_id, summary in report["stepLatencySeconds"].items():
+        row(f"  {step_id} (s)", summary)
+    row("loop lag (ms)", report["eventLoopLagMs"], 1)
+    memory = report["memoryMb"]
+    print(f"memory (MB): start {memory['start']:.1f}  peak {memory['peak']:.1f}  end {memory['end']:.1f}")
+    for error in report["errors"][:5]:
+        print(f"error: {error}")
+
+
+def main():
+    args = parse_args()
+    ## 作業ディレクトリを移す前に、結果の書き出し先を呼び出し元のディレクトリ基準で確定する
+    if args.json_path:
+        args.json_path = os.path.abspath(args.json_path)
+    workdir = tempfile.mkdtemp(prefix="lp-bench-")
+
+    ## backend のモジュールは作業ディレクトリを移した後も読み込めるよう絶対パスで追加する
+    sys.path.insert(0, BACKEND_DIR)
+    from bench.mock_providers import MockAnthropicServer, install_fake_gemini, install_fake_imagen
+
+    mock = MockAnthropicServer(
+        time_to_first_token=args.claude_ttft,
+        tokens_per_second=args.claude_tokens_per_second,
+        output_chars=args.claude_output_chars,
+    )
+    mock.start()
+
+    ## APIモジュールは読み込み時に設定を読むため、先に環境変数を用意する
+    os.environ.update({
+        "ANTHROPIC_BASE_URL": mock.base_url,
+        "ANTHROPIC_API_KEY": "mock",
+        "GEMINI_API_KEY": "mock",
+        "GOOGLE_IMAGEN_API_KEY": "mock",
+        "JOB_DB_PATH": os.path.join(workdir, "jobs.db"),
+        "JOB_WORKER_COUNT": str(args.workers),
+        "JOB_QUEUE_MAX_SIZE": str(max(100, args.jobs)),
+        "LLM_CACHE_ENABLED": "0",
+        "IMAGE_EXECUTOR": "local",
+    })
+    ## レート制限で待たされないよう、指定が無ければ十分大きくする
+    for name in (
+        "ANTHROPIC_REQUESTS_PER_MINUTE", "ANTHROPIC_INPUT_TOKENS_PER_MINUTE",
+        "ANTHROPIC_OUTPUT_TOKENS_PER_MINUTE", "GEMINI_REQUESTS_PER_MINUTE", "IMAGEN_IMAGES_PER_MINUTE",
+    ):
+        os.environ.setdefault(name, "1000000")
+    os.chdir(workdir)
+
+    log_path = os.path.join(workdir, "server.log")
+    log_file = open(log_path, "w", encoding="utf-8")
+    output = contextlib.nullcontext() if args.verbose else contextlib.redirect_stdout(log_file)
+
+    width, height = (int(value) for value in args.image_size.lower().split("x"))
+    lag = LoopLagMonitor()
+    memory = MemorySampler()
+    with output:
+        install_fake_gemini(args.gemini_latency, args.claude_output_chars)
+        install_fake_imagen(args.imagen_latency, width, height)
+        import main as api
+
+        server, thread, base_url = start_api_server(api.app, lag)
+        memory.start()
+        try:
+            run = asyncio.run(drive(base_url, args))
+        finally:
+            memory.stop()
+            server.should_exit = True
+            thread.join(timeout=30)
+            mock.stop()
+    log_file.close()
+
+    report = build_report(args, run, lag, memory, mock.requests)
+    print_report(report)
+    print(f"work dir: {workdir}")
+    if args.json_path:
+        with open(args.json_path, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,388 @@
+import os
+import re
+import gzip
+from typing import List, Optional
+
+try:
+    import brotli
+except ImportError:  # brotli が無い環境では .gz のみ作成する
+    brotli = None
+
+######################################
+## 生成物のビルド（圧縮・事前圧縮）
+######################################
+
+## 画像適用の後に、HTML/CSS/JSの空白・コメントを取り除き（BUILD_MINIFY=1）、
+## 配信用に .gz / .br の圧縮済みファイルを隣に書き出す（BUILD_PRECOMPRESS=1）
+## ミニファイは構文を解析しない簡易的なものなので、意味が変わりうる変換（改行の削除など）は行わない
+
+BUILD_MINIFY = os.environ.get("BUILD_MINIFY", "0").lower() in ("1", "true", "yes")
+BUILD_PRECOMPRESS = os.environ.get("BUILD_PRECOMPRESS", "1").lower() in ("1", "true", "yes")
+
+## ビルド対象のファイル
+BUILD_FILES = ["index.html", "style.css", "script.js"]
+
+## 事前圧縮したファイルの拡張子（Content-Encoding の値 -> 拡張子）
+PRECOMPRESSED_EXTENSIONS = {"br": ".br", "gzip": ".gz"}
+
+_IDENTIFIER_CHAR = re.compile(r"[\w$]")
+
+
+######################################
+## JavaScript
+######################################
+
+## この文字（またはキーワード）の後の / は正規表現リテラルの開始とみなす
+_REGEX_PRECEDING_CHARS = set("(,=:[!&|?{};+-*%<>~^")
+_REGEX_PRECEDING_WORDS = {"return", "typeof", "instanceof", "in", "of", "new", "delete", "void", "throw", "case", "do", "else", "yield", "await"}
+
+
+## 文字列リテラルの終わり（閉じ引用符の次の位置）
+def _skip_string(code: str, i: int) -> int:
+    quote = code[i]
+    i += 1
+    while i < len(code):
+        if code[i] == "\\":
+            i += 2
+            continue
+        if code[i] == quote or code[i] == "\n":
+            return i + 1
+        i += 1
+    return i
+
+
+## テンプレートリテラルの終わり。${ } の中はコードとして読み飛ばす
+def _skip_template(code: str, i: int) -> int:
+    i += 1
+    while i < len(code):
+        char = code[i]
+        if char == "\\":
+            i += 2
+            continue
+        if char == "`":
+            return i + 1
+        if code.startswith("${", i):
+            i = _skip_braced_code(code, i + 2)
+            continue
+        i += 1
+    return i
+
+
+## ${ の直後から、対応する } の次の位置まで読み飛ばす
+def _skip_braced_code(code: str, i: int) -> int:
+    depth = 1
+    while i < len(code):
+        char = code[i]
+        if char in "'\"":
+            i = _skip_string(code, i)
+            continue
+        if char == "`":
+            i = _skip_template(code, i)
+            continue
+        if char == "{":
+            depth += 1
+        elif char == "}":
+            depth -= 1
+            if depth == 0:
+                return i + 1
+        i += 1
+    return i
+
+
+## 正規表現リテラルの終わり（フラグを含む）
+def _skip_regex(code: str, i: int) -> int:
+    i += 1
+    in_class = False
+    while i < len(code):
+        char = code[i]
+        if char == "\\":
+            i += 2
+            continue
+        if char == "\n":
+            return i
+        if char == "[":
+            in_class = True
+        elif char == "]":
+            in_class = False
+        elif char == "/" and not in_class:
+            i += 1
+            while i < len(code) and _IDENTIFIER_CHAR.match(code[i]):
+                i += 1
+            return i
+        i += 1
+    return i
+
+
+def _regex_allowed(out: List[str]) -> bool:
+    ## 識別子は1文字ずつ出力されるため、直前のキーワードが収まる程度の末尾を見る
+    text = "".join(out[-16:])[-16:]
+    if not text:
+        return True
+    ## i++ / 2 のような後置インクリメント・デクリメントの後は除算
+    if text.endswith(("++", "--")):
+        return False
+    if text[-1] in _REGEX_PRECEDING_CHARS:
+        return True
+    match = re.search(r"([\w$]+)$", text)
+    return bool(match and match.group(1) in _REGEX_PRECEDING_WORDS)
+
+
+## 出力の末尾が数値リテラルか（1 .toString() の空白を詰めると 1.toString() となり構文エラーになる）
+def _ends_with_number(out: List[str]) -> bool:
+    match = re.search(r"([\w$]+)$", "".join(out[-32:]))
+    return bool(match and match.group(1)[0].isdigit())
+
+
+## 空白を残す必要があるか（識別子同士、+ + / - - が連結して意味が変わる場合、数値の後に . が続く場合）
+def _needs_space(out: List[str], after: str) -> bool:
+    before = out[-1][-1] if out else ""
+    if not before or not after:
+        return False
+    if _IDENTIFIER_CHAR.match(before) and _IDENTIFIER_CHAR.match(after):
+        return True
+    if after == "." and before.isdigit():
+        return _ends_with_number(out)
+    return before == after and before in "+-"
+
+
+## コメントを取り除き、行頭・行末の空白と空行、連続する空白を詰める
+## 自動セミコロン挿入に影響しないよう、改行は1つ残す
+def minify_js(code: str) -> str:
+    out: List[str] = []
+    pending_space = False
+    pending_newline = False
+    i = 0
+    while i < len(code):
+        char = code[i]
+        if char in " \t\r\f\v":
+            pending_space = True
+            i += 1
+            continue
+        if char == "\n":
+            pending_newline = True
+            i += 1
+            continue
+        if code.startswith("//", i):
+            end = code.find("\n", i)
+            i = len(code) if end == -1 else end
+            continue
+        if code.startswith("/*", i):
+            end = code.find("*/", i + 2)
+            comment = code[i:] if end == -1 else code[i:end + 2]
+            if "\n" in comment:
+                pending_newline = True
+            else:
+                pending_space = True
+            i = len(code) if end == -1 else end + 2
+            continue
+
+        if char in "'\"":
+            end = _skip_string(code, i)
+        elif char == "`":
+            end = _skip_template(code, i)
+        elif char == "/" and _regex_allowed(out):
+            end = _skip_regex(code, i)
+        else:
+            end = i + 1
+        token = code[i:end]
+
+        if out:
+            if pending_newline:
+                out.append("\n")
+            elif pending_space and _needs_space(out, token[0]):
+                out.append(" ")
+        pending_space = pending_newline = False
+        out.append(token)
+        i = end
+    return "".join(out)
+
+
+######################################
+## CSS
+######################################
+
+_CSS_TOKEN = re.compile(
+    r"(/\*.*?\*/)|(\"(?:\\.|[^\"\\])*\"|'(?:\\.|[^'\\])*')|(\s+)|([{};,>])|([^\"'/\s{};,>]+|/)",
+    re.DOTALL,
+)
+
+
+## コメントと余分な空白を取り除く
+## 前後の空白を取り除くのは { } ; , > の前後のみ（+ や ~ は calc() 内で空白が必要なため残す）
+def minify_css(css: str) -> str:
+    out: List[str] = []
+    pending_space = False
+    for comment, string, space, punctuation, other in _CSS_TOKEN.findall(css):
+        if comment:
+            ## /*! で始まるコメント（ライセンス表記など）は残す
+            if not comment.startswith("/*!"):
+                pending_space = True
+                continue
+            token = comment
+        elif space:
+            pending_space = True
+            continue
+        elif punctuation:
+            ## ブロック末尾のセミコロンは不要
+            if punctuation == "}" and out and out[-1] == ";":
+                out.pop()
+            out.append(punctuation)
+            pending_space = False
+            continue
+        else:
+            token = string or other
+        if pending_space and out and out[-1] not in ("{", "}", ";", ",", ">") and not out[-1].endswith(":"):
+            out.append(" ")
+        pending_space = False
+        out.append(token)
+    return "".join(out)
+
+
+######################################
+## HTML
+######################################
+
+## 中身をそのまま残す、または専用の方法で圧縮する要素
+_RAW_ELEMENT = re.compile(
+    r"(<(pre|textarea|script|style)\b[^>]*>)(.*?)(</\2\s*>)", re.DOTALL | re.IGNORECASE
+)
+_HTML_COMMENT = re.compile(r"<!--(?!\[if).*?-->", re.DOTALL)
+## タグ（属性値の中の > を含む）
+_HTML_TAG = re.compile(r"<(?:\"[^\"]*\"|'[^']*'|[^'\">])*>")
+## タグ内の引用符で囲まれた属性値、または空白
+_HTML_ATTRIBUTE_SPACE = re.compile(r"(\"[^\"]*\"|'[^']*')|\s+")
+
+
+## タグ内の空白を詰める（属性値の中の空白は値の一部なのでそのまま残す）
+def _minify_tag(match: re.Match) -> str:
+    return _HTML_ATTRIBUTE_SPACE.sub(lambda m: m.group(1) or " ", match.group(0))
+
+
+def _minify_html_text(html: str) -> str:
+    html = _HTML_COMMENT.sub("", html)
+    parts = []
+    position = 0
+    for tag in _HTML_TAG.finditer(html):
+        ## インライン要素の間の空白は表示に影響するため、1つの空白として残す
+        parts.append(re.sub(r"\s+", " ", html[position:tag.start()]))
+        parts.append(_minify_tag(tag))
+        position = tag.end()
+    parts.append(re.sub(r"\s+", " ", html[position:]))
+    return "".join(parts)
+
+
+def _minify_raw_element(match: re.Match) -> str:
+    start_tag, name, body, end_tag = match.groups()
+    name = name.lower()
+    if name == "script" and not re.search(r"\bsrc\s*=", start_tag, re.IGNORECASE):
+        type_match = re.search(r"\btype\s*=\s*['\"]?([^'\"\s>]+)", start_tag, re.IGNORECASE)
+        if not type_match or type_match.group(1).lower() in ("text/javascript", "module", "application/javascript"):
+            body = minify_js(body).strip()
+    elif name == "style":
+        body = minify_css(body).strip()
+    return _minify_html_text(start_tag) + body + end_tag
+
+
+def minify_html(html: str) -> str:
+    parts = []
+    position = 0
+    for match in _RAW_ELEMENT.finditer(html):
+        parts.append(_minify_html_text(html[position:match.start()]))
+        parts.append(_minify_raw_element(match))
+        position = match.end()
+    parts.append(_minify_html_text(html[position:]))
+    return "".join(parts).strip()
+
+
+MINIFIERS = {
+    ".html": minify_html,
+    ".css": minify_css,
+    ".js": minify_js,
+}
+
+
+######################################
+## 事前圧縮
+######################################
+
+## .gz / .br を書き出す（元より小さくならない場合は作らない）
+def write_precompressed(path: str) -> List[str]:
+    with open(path, "rb") as f:
+        data = f.read()
+    written = []
+    encoders = [(".gz", lambda d: gzip.compress(d, compresslevel=9, mtime=0))]
+    if brotli is not None:
+        encoders.append((".br", lambda d: brotli.compress(d, quality=11)))
+    for extension, encode in encoders:
+        compressed_path = path + extension
+        compressed = encode(data)
+        if len(compressed) >= len(data):
+            if os.path.exists(compressed_path):
+                os.remove(compressed_path)
+            continue
+        tmp_path = compressed_path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(compressed)
+        os.replace(tmp_path, compressed_path)
+        written.append(compressed_path)
+    return written
+
+
+## 元のファイルより新しい事前圧縮ファイルのうち、クライアントが受け付けるものを選ぶ
+## q値の高いものを優先し、同じq値なら PRECOMPRESSED_EXTENSIONS の順（br → gzip）で選ぶ
+## 戻り値は (圧縮済みファイルのパス, Content-Encoding の値)。使えるものが無ければ None
+def select_precompressed(path: str, accept_encoding: Optional[str]) -> Optional[tuple]:
+    accepted = parse_accept_encoding(accept_encoding)
+    source_mtime = os.stat(path).st_mtime_ns
+    candidates = [
+        (accepted.get(encoding, accepted.get("*", 0)), encoding, extension)
+        for encoding, extension in PRECOMPRESSED_EXTENSIONS.items()
+    ]
+    ## sorted は安定なので、同じq値の間では元の順序が保たれる
+    for quality, encoding, extension in sorted(candidates, key=lambda candidate: -candidate[0]):
+        if quality <= 0:
+            continue
+        compressed_path = path + extension
+        try:
+            if os.stat(compressed_path).st_mtime_ns >= source_mtime:
+                return compressed_path, encoding
+        except FileNotFoundError:
+            continue
+    return None
+
+
+## Accept-Encoding を (エンコーディング -> q値) に変換する
+def parse_accept_encoding(header: Optional[str]) -> dict:
+    accepted = {}
+    for item in (header or "").split(","):
+        name, _, params = item.strip().partition(";")
+        if not name:
+            continue
+        quality = 1.0
+        match = re.search(r"q\s*=\s*([0-9.]+)", params)
+        if match:
+            try:
+                quality = float(match.group(1))
+            except ValueError:
+                quality = 0.0
+        accepted[name.strip().lower()] = quality
+    return accepted
+
+
+## 作業ディレクトリ内の生成物をビルドする（CPU処理のためスレッドで呼び出すこと）
+def build_outputs(output_dir: str) -> List[str]:
+    built = []
+    for name in BUILD_FILES:
+        path = os.path.join(output_dir, name)
+        if not os.path.exists(path):
+            continue
+        if BUILD_MINIFY:
+            with open(path, "r", encoding="utf-8") as f:
+                source = f.read()
+            minified = MINIFIERS[os.path.splitext(name)[1]](source)
+            with open(path, "w", encoding="utf-8") as f:
+                f.write(minified)
+        if BUILD_PRECOMPRESS:
+            write_precompressed(path)
+        built.append(path)
+    return built
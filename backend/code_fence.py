@@ -0,0 +1,204 @@
+import json
+from dataclasses import dataclass
+from typing import Any, List, Optional, Sequence
+
+######################################
+## モデルの出力からのコードブロック・JSONの抽出
+######################################
+
+## Markdown のコードブロック（```html ... ```）を1行ずつ、先頭から1回だけ走査して取り出す
+## feed() にはストリーミング中の出力を少しずつ渡せるため、生成途中でも抽出済みのコードを参照できる
+## 抽出できない場合は CodeFenceError を送出する
+
+
+## コードブロック・JSONを抽出できない場合の例外
+class CodeFenceError(ValueError):
+    pass
+
+
+## 言語名の表記ゆれ（```js と ```javascript など）
+LANGUAGE_ALIASES = {
+    "htm": "html",
+    "js": "javascript",
+    "mjs": "javascript",
+}
+
+FENCE = "```"
+
+
+def normalize_language(language: str) -> str:
+    language = language.strip().lower()
+    return LANGUAGE_ALIASES.get(language, language)
+
+
+## 1つのコードブロック
+## language は言語名（指定が無い場合は空文字）、closed は閉じるフェンスまで出力されたか
+@dataclass
+class CodeBlock:
+    language: str
+    code: str
+    closed: bool = True
+
+
+class FenceParser:
+    def __init__(self):
+        self.reset()
+
+    ## 読み取った内容を破棄して最初の状態に戻す
+    def reset(self):
+        ## 抽出済みのコードブロック（開いているブロックは含まない）
+        self.blocks: List[CodeBlock] = []
+        ## コードブロックの外のテキスト（行単位）
+        self._outside: List[str] = []
+        ## 開いているブロックの言語と行（ブロックの外にいる間は None）
+        self._language: Optional[str] = None
+        self._lines: List[str] = []
+        ## 改行がまだ届いていない行の断片
+        self._pending: List[str] = []
+        ## update() で受け取った出力全体
+        self._received = ""
+
+    ## テキストの続きを渡し、新たに閉じたコードブロックを返す
+    def feed(self, chunk: str) -> List[CodeBlock]:
+        if "\n" not in chunk:
+            self._pending.append(chunk)
+            return []
+        count = len(self.blocks)
+        head, *lines, tail = chunk.split("\n")
+        self._pending.append(head)
+        self._feed_line("".join(self._pending))
+        for line in lines:
+            self._feed_line(line)
+        self._pending = [tail]
+        return self.blocks[count:]
+
+    ## これまでの出力全体を渡し、前回からの差分だけを読む
+    ## 前回の続きでない場合（フェイルオーバーで別のプロバイダの出力に切り替わった場合など）は最初から読み直す
+    def update(self, text: str) -> List[CodeBlock]:
+        if not text.startswith(self._received):
+            self.reset()
+        chunk = text[len(self._received):]
+        self._received = text
+        return self.feed(chunk)
+
+    ## 出力の終わりを処理し、抽出したすべてのコードブロックを返す
+    ## 閉じるフェンスが無いまま終わったブロック（出力が途中で切れた場合など）は closed=False で含める
+    def close(self) -> List[CodeBlock]:
+        if self._pending:
+            self._feed_line("".join(self._pending))
+            self._pending = []
+        if self._language is not None:
+            self.blocks.append(CodeBlock(self._language, "\n".join(self._lines).strip(), closed=False))
+            self._language = None
+            self._lines = []
+        return self.blocks
+
+    ## フェンスは行の途中（"以下のコードです ```css" や "}```"）にあっても認識する
+    def _feed_line(self, line: str):
+        if self._language is None:
+            start = line.find(FENCE)
+            if start < 0:
+                self._outside.append(line)
+                return
+            if line[:start].strip():
+                self._outside.append(line[:start])
+            self._language = normalize_language((line[start + len(FENCE):].split() or [""])[0])
+            self._lines = []
+            return
+        stripped = line.rstrip()
+        if not stripped.endswith(FENCE):
+            self._lines.append(line)
+            return
+        if stripped[:-len(FENCE)].strip():
+            self._lines.append(stripped[:-len(FENCE)])
+        self.blocks.append(CodeBlock(self._language, "\n".join(self._lines).strip()))
+        self._language = None
+        self._lines = []
+
+    ## コードブロックの外のテキスト（コードブロックが無い出力では出力全体）
+    @property
+    def text(self) -> str:
+        lines = self._outside
+        if self._language is None:
+            lines = lines + ["".join(self._pending)]
+        return "\n".join(lines).strip()
+
+    ## 生成途中のコード（書きかけのブロック、無ければ直前に閉じたブロック、ブロックが無ければテキスト全体）
+    @property
+    def partial(self) -> str:
+        if self._language is not None:
+            pending = "".join(self._pending)
+            ## 閉じるフェンスの書きかけは含めない
+            if pending.strip() and not pending.strip().strip("`"):
+                pending = ""
+            return "\n".join(self._lines + [pending])
+        if self.blocks:
+            return self.blocks[-1].code
+        ## 開くフェンスの書きかけは含めない
+        if FENCE[0] in "".join(self._pending):
+            return "\n".join(self._outside).strip()
+        return self.text
+
+
+## テキスト全体からコードブロックを抽出する
+def parse_code_blocks(text: str) -> List[CodeBlock]:
+    parser = FenceParser()
+    parser.feed(text)
+    return parser.close()
+
+
+## 抽出済みのコードブロックから、指定した言語のコードを取り出す（同じ言語のブロックは改行でつなげる）
+## fallback=True の場合、該当する言語のブロックが無ければ言語指定の無いブロックを使い、
+## コードブロックが無い出力は text（ブロックの外のテキスト）をそのまま使う
+## 見つからない・空・閉じるフェンスが無い（出力が途中で切れた）場合は CodeFenceError を送出する
+def select_code(blocks: List[CodeBlock], text: str, languages: Sequence[str], fallback: bool = True) -> str:
+    names = "/".join(languages)
+    if not blocks and fallback:
+        if not text.strip():
+            raise CodeFenceError(f"{names} のコードが出力されていません")
+        return text.strip()
+    candidates = [[normalize_language(language) for language in languages]]
+    if fallback:
+        candidates.append([""])
+    for languages_to_match in candidates:
+        matched = [block for block in blocks if block.language in languages_to_match]
+        if not matched:
+            continue
+        if not all(block.closed for block in matched):
+            raise CodeFenceError(f"{names} のコードブロックが閉じられていません（出力が途中で終わっています）")
+        code = "\n".join(block.code for block in matched if block.code)
+        if not code.strip():
+            raise CodeFenceError(f"{names} のコードブロックが空です")
+        return code
+    raise CodeFenceError(
+        f"{names} のコードブロックが見つかりませんでした"
+        f"（出力されたブロック: {', '.join(block.language or '言語指定なし' for block in blocks) or 'なし'}）"
+    )
+
+
+## テキスト全体から指定した言語のコードを取り出す
+def extract_code(text: str, languages: Sequence[str]) -> str:
+    parser = FenceParser()
+    parser.feed(text)
+    blocks = parser.close()
+    return select_code(blocks, parser.text, languages)
+
+
+## JSONを読み込む（```json のコードブロックや、前後に説明文の付いた出力にも対応する）
+def parse_json(text: str) -> Any:
+    blocks = parse_code_blocks(text)
+    candidates = [block.code for block in blocks if block.language in ("json", "")]
+    source = candidates[0] if candidates else text.strip()
+    try:
+        return json.loads(source)
+    except json.JSONDecodeError:
+        pass
+    ## 最初の { から始まるJSONの値を読み、後ろに続くテキストは無視する
+    start = source.find("{")
+    if start < 0:
+        raise CodeFenceError("テキスト内に有効な JSON が見つかりませんでした")
+    try:
+        value, _ = json.JSONDecoder().raw_decode(source, start)
+    except json.JSONDecodeError as e:
+        raise CodeFenceError(f"抽出した JSON のデコードに失敗しました: {e}") from e
+    return value
@@ -0,0 +1,188 @@
+import re
+from html.parser import HTMLParser
+from typing import Any, List, Optional, Tuple
+
+######################################
+## HTML/CSSへの部分的な差分の適用
+######################################
+
+## モデルにはページ全体ではなく「置き換える要素のセレクタ・その要素のHTML・追加するCSS」だけを出力させ、
+## 元のHTMLの該当要素をローカルで差し替える。検証に失敗した場合は HtmlPatchError を送出する
+
+## 差分が不正で適用できない場合の例外
+class HtmlPatchError(Exception):
+    pass
+
+
+## 終了タグを持たない要素
+VOID_ELEMENTS = {
+    "area", "base", "br", "col", "embed", "hr", "img", "input",
+    "link", "meta", "param", "source", "track", "wbr",
+}
+
+## 対応するセレクタは「タグ名・#id・.class」の組み合わせ1つのみ（例: section#hero.hero）
+SELECTOR_PATTERN = re.compile(r"^([a-zA-Z][\w-]*)?((?:[#.][\w-]+)*)$")
+
+
+def parse_selector(selector: str) -> Tuple[Optional[str], Optional[str], List[str]]:
+    match = SELECTOR_PATTERN.match(selector.strip())
+    if not match or not selector.strip():
+        raise HtmlPatchError(f"対応していないセレクタです: {selector}")
+    tag, rest = match.groups()
+    element_id = None
+    classes = []
+    for prefix, name in re.findall(r"([#.])([\w-]+)", rest):
+        if prefix == "#":
+            element_id = name
+        else:
+            classes.append(name)
+    return (tag.lower() if tag else None), element_id, classes
+
+
+## セレクタに一致する最初の要素の範囲（開始タグの先頭から終了タグの末尾まで）を探す
+class _ElementLocator(HTMLParser):
+    def __init__(self, html: str, selector: str):
+        super().__init__(convert_charrefs=False)
+        self.html = html
+        self.tag, self.element_id, self.classes = parse_selector(selector)
+        ## HTMLParser の行番号は改行文字（\n）で数えるため、それに合わせて各行の先頭位置を求める
+        self._line_offsets = [0] + [match.end() for match in re.finditer("\n", html)]
+        self._stack: List[str] = []
+        self._depth: Optional[int] = None
+        self.matches = 0
+        self.start: Optional[int] = None
+        self.end: Optional[int] = None
+
+    def _offset(self) -> int:
+        line, column = self.getpos()
+        return self._line_offsets[line - 1] + column
+
+    def _matches(self, tag: str, attrs: List[Tuple[str, Optional[str]]]) -> bool:
+        values = dict(attrs)
+        if self.tag and tag != self.tag:
+            return False
+        if self.element_id and values.get("id") != self.element_id:
+            return False
+        classes = (values.get("class") or "").split()
+        return all(name in classes for name in self.classes)
+
+    def handle_starttag(self, tag, attrs):
+        if self._matches(tag, attrs):
+            self.matches += 1
+            if self.start is None:
+                self.start = self._offset()
+                if tag in VOID_ELEMENTS:
+                    self.end = self.start + len(self.get_starttag_text())
+                else:
+                    self._depth = len(self._stack)
+        if tag not in VOID_ELEMENTS:
+            self._stack.append(tag)
+
+    def handle_startendtag(self, tag, attrs):
+        if self._matches(tag, attrs):
+            self.matches += 1
+            if self.start is None:
+                self.start = self._offset()
+                self.end = self.start + len(self.get_starttag_text())
+
+    def handle_endtag(self, tag):
+        if tag not in self._stack:
+            return
+        ## 閉じ忘れのタグは、外側の終了タグで閉じられたものとみなす
+        index = len(self._stack) - 1 - self._stack[::-1].index(tag)
+        del self._stack[index:]
+        if self._depth is not None and self.end is None and index <= self._depth:
+            offset = self._offset()
+            if index == self._depth:
+                self.end = self.html.index(">", offset) + 1
+            else:
+                self.end = offset
+
+
+def find_element_span(html: str, selector: str) -> Tuple[int, int]:
+    locator = _ElementLocator(html, selector)
+    locator.feed(html)
+    locator.close()
+    if locator.start is None:
+        raise HtmlPatchError(f"セレクタに一致する要素がありません: {selector}")
+    if locator.matches > 1:
+        raise HtmlPatchError(f"セレクタに一致する要素が複数あります: {selector}")
+    if locator.end is None:
+        raise HtmlPatchError(f"要素の終了タグが見つかりません: {selector}")
+    return locator.start, locator.end
+
+
+## 差し替えるHTML断片のタグが正しく対応しているかを確認する
+class _FragmentValidator(HTMLParser):
+    def __init__(self):
+        super().__init__(convert_charrefs=False)
+        self.stack: List[str] = []
+        self.elements = 0
+        self.error: Optional[str] = None
+
+    def handle_starttag(self, tag, attrs):
+        self.elements += 1
+        if tag not in VOID_ELEMENTS:
+            self.stack.append(tag)
+
+    def handle_startendtag(self, tag, attrs):
+        self.elements += 1
+
+    def handle_endtag(self, tag):
+        if tag in VOID_ELEMENTS or self.error:
+            return
+        if not self.stack or self.stack[-1] != tag:
+            self.error = f"終了タグ </{tag}> が開始タグと対応していません"
+        else:
+            self.stack.pop()
+
+
+def validate_fragment(fragment: str):
+    validator = _FragmentValidator()
+    validator.feed(fragment)
+    validator.close()
+    if validator.error:
+        raise HtmlPatchError(validator.error)
+    if validator.stack:
+        raise HtmlPatchError(f"閉じられていないタグがあります: {', '.join(validator.stack)}")
+    if validator.elements == 0:
+        raise HtmlPatchError("HTML断片に要素がありません")
+
+
+## コメントと文字列を除いて波括弧の対応を確認する
+def validate_css(css: str):
+    stripped = re.sub(r"/\*.*?\*/", "", css, flags=re.DOTALL)
+    stripped = re.sub(r"\"(?:\\.|[^\"\\])*\"|'(?:\\.|[^'\\])*'", "", stripped)
+    depth = 0
+    for char in stripped:
+        if char == "{":
+            depth += 1
+        elif char == "}":
+            depth -= 1
+            if depth < 0:
+                break
+    if depth != 0:
+        raise HtmlPatchError("CSSの波括弧が対応していません")
+
+
+## 差分 {"selector", "html", "css"} を検証してHTML/CSSに適用する
+## required_text を指定した場合、差分（HTMLまたはCSS）にその文字列が含まれることも確認する
+def apply_patch(html: str, css: str, patch: Any, required_text: Optional[str] = None) -> Tuple[str, str]:
+    if not isinstance(patch, dict):
+        raise HtmlPatchError("差分がJSONオブジェクトではありません")
+    for key in ("selector", "html", "css"):
+        if not isinstance(patch.get(key), str):
+            raise HtmlPatchError(f"差分に {key} がありません")
+    fragment = patch["html"].strip()
+    patch_css = patch["css"].strip()
+
+    start, end = find_element_span(html, patch["selector"])
+    validate_fragment(fragment)
+    validate_css(patch_css)
+    if required_text and required_text not in fragment and required_text not in patch_css:
+        raise HtmlPatchError(f"差分に {required_text} が含まれていません")
+
+    new_html = html[:start] + fragment + html[end:]
+    ## 既存のルールを上書きできるよう、追加のCSSは末尾に置く
+    new_css = css.rstrip() + "\n\n" + patch_css + "\n" if patch_css else css
+    return new_html, new_css
@@ -0,0 +1,186 @@
+import os
+import re
+import asyncio
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Dict, List, Optional
+from PIL import Image, features
+
+######################################
+## レスポンシブ画像の派生ファイル生成
+######################################
+
+## 生成した画像から幅違い・形式違い（JPEG/WebP/AVIF）のファイルを作り、
+## CSSの image-set() とHTMLの srcset から参照できるようにする
+## エンコードはCPU処理なので、APIのイベントループを止めないようプロセスプールで行う
+
+## 派生ファイルの幅（元画像より大きい幅は作らない）
+VARIANT_WIDTHS = [
+    int(width) for width in os.environ.get("IMAGE_VARIANT_WIDTHS", "640,1280,1920").split(",") if width.strip()
+]
+## 形式ごとのエンコード設定。image-set() にはこの順（小さい形式から）で並べる
+VARIANT_FORMATS = {
+    "avif": {"format": "AVIF", "mime": "image/avif", "options": {"quality": 50}},
+    "webp": {"format": "WEBP", "mime": "image/webp", "options": {"quality": 80, "method": 6}},
+    "jpg": {"format": "JPEG", "mime": "image/jpeg", "options": {"quality": 82, "progressive": True, "optimize": True}},
+}
+
+## 派生ファイル名: <元のファイル名>-<幅>w.<拡張子>
+VARIANT_NAME_PATTERN = r"{stem}-(\d+)w\.({exts})$"
+
+
+## Pillowのビルドによって AVIF が使えない場合があるため、使える形式だけを返す
+def available_formats() -> List[str]:
+    formats = []
+    for ext, spec in VARIANT_FORMATS.items():
+        if spec["format"] == "AVIF" and not features.check("avif"):
+            continue
+        if spec["format"] == "WEBP" and not features.check("webp"):
+            continue
+        formats.append(ext)
+    return formats
+
+
+## 元画像の幅に合わせて作成する幅を決める（最大幅は元画像の幅で頭打ちにする）
+def target_widths(original_width: int, widths: List[int]) -> List[int]:
+    targets = {width for width in widths if width < original_width}
+    targets.add(min(original_width, max(widths)))
+    return sorted(targets)
+
+
+## 派生ファイルを1つ作成する（プロセスプール内で実行される）
+## 幅・形式ごとに別のタスクにして、エンコードをプールのワーカーに分散させる
+def build_variant(path: str, width: int, ext: str) -> Dict[str, Any]:
+    directory = os.path.dirname(path)
+    stem = os.path.splitext(os.path.basename(path))[0]
+    spec = VARIANT_FORMATS[ext]
+    name = f"{stem}-{width}w.{ext}"
+    with Image.open(path) as source:
+        image = source.convert("RGB")
+    if width != image.width:
+        image = image.resize((width, round(image.height * width / image.width)), Image.LANCZOS)
+    ## 書きかけのファイルを配信しないよう一時ファイル経由で置き換える
+    tmp_path = os.path.join(directory, f".{name}.tmp")
+    image.save(tmp_path, spec["format"], **spec["options"])
+    os.replace(tmp_path, os.path.join(directory, name))
+    return {"name": name, "width": width, "format": ext}
+
+
+## ディスク上の派生ファイルを探す（幅の昇順、同じ幅では VARIANT_FORMATS の順）
+def find_variants(path: str) -> List[Dict[str, Any]]:
+    directory = os.path.dirname(path) or "."
+    stem = os.path.splitext(os.path.basename(path))[0]
+    pattern = re.compile(
+        VARIANT_NAME_PATTERN.format(stem=re.escape(stem), exts="|".join(VARIANT_FORMATS))
+    )
+    order = list(VARIANT_FORMATS)
+    variants = []
+    for name in os.listdir(directory):
+        match = pattern.match(name)
+        if match:
+            variants.append({"name": name, "width": int(match.group(1)), "format": match.group(2)})
+    return sorted(variants, key=lambda v: (v["width"], order.index(v["format"])))
+
+
+_pool: Optional[ProcessPoolExecutor] = None
+
+
+## プロセスプールを起動する（起動済みなら何もしない）
+## スレッドを持つ親プロセスからforkすると不安定になるため spawn で起動する
+def start_variant_pool() -> ProcessPoolExecutor:
+    global _pool
+    if _pool is None:
+        workers = int(os.environ.get("IMAGE_VARIANT_WORKERS", min(4, os.cpu_count() or 1)))
+        _pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context("spawn"))
+    return _pool
+
+
+def shutdown_variant_pool():
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(wait=True, cancel_futures=True)
+        _pool = None
+
+
+## 派生ファイルをプロセスプールで作成する
+## 戻り値は {"name", "width", "format"} のリスト（幅の昇順、同じ幅では VARIANT_FORMATS の順）
+async def generate_variants(path: str) -> List[Dict[str, Any]]:
+    loop = asyncio.get_running_loop()
+    pool = start_variant_pool()
+    ## 画像のサイズはヘッダーだけで分かるので、ここでは画素を読み込まない
+    with Image.open(path) as source:
+        original_width = source.width
+    return list(await asyncio.gather(*(
+        loop.run_in_executor(pool, build_variant, path, width, ext)
+        for width in target_widths(original_width, VARIANT_WIDTHS)
+        for ext in available_formats()
+    )))
+
+
+######################################
+## CSS/HTMLへの組み込み
+######################################
+
+def _image_set(variants: List[Dict[str, Any]]) -> str:
+    candidates = ", ".join(
+        f'url("{v["name"]}") type("{VARIANT_FORMATS[v["format"]]["mime"]}")' for v in variants
+    )
+    return f"image-set({candidates})"
+
+
+## 画像を背景に使っているルールについて、画面幅ごとに image-set() で上書きするルールをCSS末尾に追加する
+## 元の url() 指定は image-set() 非対応ブラウザ向けのフォールバックとしてそのまま残す
+def apply_responsive_css(css: str, image_name: str, variants: List[Dict[str, Any]]) -> str:
+    if not variants:
+        return css
+    url_pattern = re.compile(r"url\(\s*['\"]?" + re.escape(image_name) + r"['\"]?\s*\)")
+    ## コメントを除いた上で、ネストしていない「セレクタ { 宣言 }」を探す
+    stripped = re.sub(r"/\*.*?\*/", "", css, flags=re.DOTALL)
+    declarations = []
+    for rule in re.finditer(r"([^{}]+)\{([^{}]*)\}", stripped):
+        selector = rule.group(1).strip()
+        if not selector or selector.startswith("@"):
+            continue
+        for declaration in rule.group(2).split(";"):
+            prop, _, value = declaration.partition(":")
+            prop = prop.strip().lower()
+            if prop in ("background", "background-image") and url_pattern.search(value):
+                declarations.append((selector, prop, value.strip()))
+    if not declarations:
+        return css
+
+    by_width: Dict[int, List[Dict[str, Any]]] = {}
+    for variant in variants:
+        by_width.setdefault(variant["width"], []).append(variant)
+    widths = sorted(by_width, reverse=True)
+
+    def rules_for(width: int, indent: str = "") -> str:
+        image_set = _image_set(by_width[width])
+        return "\n".join(
+            f"{indent}{selector} {{ {prop}: {url_pattern.sub(image_set, value)}; }}"
+            for selector, prop, value in declarations
+        )
+
+    ## 最大幅を既定とし、小さい画面ほど後ろの @media で上書きする
+    blocks = ["/* レスポンシブ画像（自動生成） */", rules_for(widths[0])]
+    for width in widths[1:]:
+        blocks.append(f"@media (max-width: {width}px) {{\n{rules_for(width, '  ')}\n}}")
+    return css.rstrip() + "\n\n" + "\n".join(blocks) + "\n"
+
+
+## 画像を <img> で参照している場合は srcset/sizes を付ける（既に srcset があるものはそのまま）
+def apply_responsive_html(html: str, image_name: str, variants: List[Dict[str, Any]]) -> str:
+    ## srcset は形式を選べないため、どのブラウザでも表示できるJPEGを使う
+    jpegs = [v for v in variants if v["format"] == "jpg"]
+    if not jpegs:
+        return html
+    srcset = ", ".join(f'{v["name"]} {v["width"]}w' for v in jpegs)
+    src_pattern = re.compile(r"\bsrc\s*=\s*['\"]" + re.escape(image_name) + r"['\"]")
+
+    def add_srcset(match):
+        tag = match.group(0)
+        if "srcset" in tag.lower() or not src_pattern.search(tag):
+            return tag
+        return src_pattern.sub(lambda m: f'{m.group(0)} srcset="{srcset}" sizes="100vw"', tag, count=1)
+
+    return re.sub(r"<img\b[^>]*>", add_srcset, html, flags=re.IGNORECASE)
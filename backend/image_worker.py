@@ -0,0 +1,174 @@
+import os
+import asyncio
+from io import BytesIO
+from typing import Optional
+from PIL import Image
+from google import genai as genai_img
+from google.genai import types
+
+######################################
+## 画像生成ワーカー
+######################################
+
+## アプリ起動時に一度だけ作成し、以降のジョブで使い回す
+## IMAGE_EXECUTOR=local（既定）: プロセス内で1つのクライアント（接続プール）を共有して非同期に呼び出す
+## IMAGE_EXECUTOR=ray        : クライアントを保持したRayアクターを常駐させて使い回す
+
+imagen_model = 'imagen-3.0-generate-002'
+
+
+## ファイル名に基づいてアスペクト比を決定（ディレクトリ部分は見ない）
+def aspect_ratio_for(file_name):
+    base_name = os.path.basename(file_name).lower()
+    if 'html' in base_name:
+        return '1:1'
+    elif 'css' in base_name:
+        return '16:9'
+    return '1:1'  # デフォルト値
+
+
+## 生成設定
+def generate_images_config(file_name, aspect_ratio=None):
+    return types.GenerateImagesConfig(
+        number_of_images=1,
+        aspect_ratio=aspect_ratio or aspect_ratio_for(file_name),
+    )
+
+
+## 画像の保存（拡張子に合わせて再エンコードする）
+def save_image_bytes(image_bytes, file_name):
+    image = Image.open(BytesIO(image_bytes))
+    image.save(file_name)
+    print(f"画像を保存しました: {file_name}")
+    return file_name
+
+
+def create_imagen_client():
+    return genai_img.Client(api_key=os.environ.get("GOOGLE_IMAGEN_API_KEY"))
+
+
+## プロセス内で動かすエグゼキュータ
+class LocalImageExecutor:
+    def __init__(self, max_concurrency: int):
+        self._client = None
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+
+    async def start(self):
+        self._client = create_imagen_client()
+
+    async def generate(self, prompt, file_name, aspect_ratio=None):
+        async with self._semaphore:
+            response = await self._client.aio.models.generate_images(
+                model=imagen_model,
+                prompt=prompt,
+                config=generate_images_config(file_name, aspect_ratio),
+            )
+        ## 画像のデコード・エンコードはCPU処理なのでスレッドで行う
+        return await asyncio.to_thread(
+            save_image_bytes, response.generated_images[0].image.image_bytes, file_name
+        )
+
+    async def shutdown(self):
+        if self._client is not None:
+            ## 古いSDKには aclose が無いため、ある場合のみ接続を閉じる
+            close = getattr(self._client.aio, "aclose", None)
+            if close is not None:
+                await close()
+            self._client = None
+
+
+## Rayアクターとして常駐するワーカー（クライアントを保持し続ける）
+class ImagenWorker:
+    def __init__(self):
+        self.client = create_imagen_client()
+
+    def generate(self, prompt, file_name, aspect_ratio=None):
+        response = self.client.models.generate_images(
+            model=imagen_model,
+            prompt=prompt,
+            config=generate_images_config(file_name, aspect_ratio),
+        )
+        return save_image_bytes(response.generated_images[0].image.image_bytes, file_name)
+
+
+## Rayのアクタープールで動かすエグゼキュータ
+class RayImageExecutor:
+    def __init__(self, pool_size: int):
+        self.pool_size = pool_size
+        self._idle_actors: Optional[asyncio.Queue] = None
+        self._actors = []
+
+    async def start(self):
+        import ray
+
+        ## クラスタの起動には数秒かかるため、イベントループを止めないようスレッドで行う
+        if not ray.is_initialized():
+            await asyncio.to_thread(ray.init)
+        actor_class = ray.remote(ImagenWorker)
+        self._actors = [actor_class.remote() for _ in range(self.pool_size)]
+        self._idle_actors = asyncio.Queue()
+        for actor in self._actors:
+            self._idle_actors.put_nowait(actor)
+
+    async def generate(self, prompt, file_name, aspect_ratio=None):
+        ## 空いているアクターを借りて実行し、終わったら返す
+        import ray
+
+        actor = await self._idle_actors.get()
+        try:
+            ref = actor.generate.remote(prompt, file_name, aspect_ratio)
+            try:
+                return await ref
+            except asyncio.CancelledError:
+                ## ジョブがキャンセルされた場合は、まだ実行されていなければリモートの処理も取り消す
+                ray.cancel(ref)
+                raise
+        finally:
+            self._idle_actors.put_nowait(actor)
+
+    async def shutdown(self):
+        import ray
+
+        for actor in self._actors:
+            ray.kill(actor)
+        self._actors = []
+        if ray.is_initialized():
+            await asyncio.to_thread(ray.shutdown)
+
+
+_executor = None
+_executor_lock = asyncio.Lock()
+
+
+## 設定に応じたエグゼキュータを起動する（起動済みなら何もしない）
+async def start_image_executor():
+    global _executor
+    async with _executor_lock:
+        if _executor is None:
+            _executor = await _create_image_executor()
+    return _executor
+
+
+async def _create_image_executor():
+    kind = os.environ.get("IMAGE_EXECUTOR", "local").lower()
+    workers = int(os.environ.get("IMAGE_WORKERS", 4))
+    if kind == "ray":
+        executor = RayImageExecutor(workers)
+    elif kind == "local":
+        executor = LocalImageExecutor(workers)
+    else:
+        raise ValueError(f"IMAGE_EXECUTOR の値が不正です: {kind}")
+    await executor.start()
+    return executor
+
+
+## 起動済みのエグゼキュータを返す（CLI実行時など未起動の場合はここで起動する）
+async def get_image_executor():
+    return await start_image_executor()
+
+
+async def shutdown_image_executor():
+    global _executor
+    if _executor is not None:
+        await _executor.shutdown()
+        _executor = None
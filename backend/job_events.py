@@ -0,0 +1,74 @@
+import json
+import asyncio
+from collections import defaultdict
+from typing import Any, Dict, Optional, Set
+
+######################################
+## ジョブ進捗のプッシュ配信
+######################################
+
+## 完了・エラー・キャンセルなど、これ以上状態が変化しないステータス
+TERMINAL_STATUSES = {"completed", "error", "cancelled"}
+
+
+## Server-Sent Events 形式の1イベントに整形する
+def format_sse(event: str, data: Dict[str, Any]) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+## ジョブごとの購読者へ状態の差分を配信する
+class JobEventBroker:
+    def __init__(self):
+        self._subscribers: Dict[str, Set[asyncio.Queue]] = defaultdict(set)
+        ## 差分計算のため、各ジョブの直前の状態を保持する（終了したジョブは破棄）
+        self._last_state: Dict[str, Dict[str, Any]] = {}
+
+    def subscribe(self, job_id: str) -> asyncio.Queue:
+        queue: asyncio.Queue = asyncio.Queue()
+        self._subscribers[job_id].add(queue)
+        return queue
+
+    def unsubscribe(self, job_id: str, queue: asyncio.Queue):
+        subscribers = self._subscribers.get(job_id)
+        if subscribers is None:
+            return
+        subscribers.discard(queue)
+        if not subscribers:
+            del self._subscribers[job_id]
+
+    ## 任意のイベントを購読者に送る
+    def publish(self, job_id: str, event: str, data: Dict[str, Any]):
+        for queue in self._subscribers.get(job_id, ()):
+            queue.put_nowait((event, data))
+
+    ## 新しい状態を受け取り、前回から変化したフィールドとステップだけを update イベントとして送る
+    def publish_status(self, job_id: str, state: Dict[str, Any]):
+        previous = self._last_state.get(job_id, {})
+
+        delta = {
+            key: value
+            for key, value in state.items()
+            if key != "steps" and previous.get(key) != value
+        }
+        previous_steps = {step["id"]: step for step in previous.get("steps", [])}
+        changed_steps = [
+            step for step in state.get("steps", []) if previous_steps.get(step["id"]) != step
+        ]
+        if changed_steps:
+            delta["steps"] = changed_steps
+
+        if state.get("status") in TERMINAL_STATUSES:
+            self._last_state.pop(job_id, None)
+        else:
+            self._last_state[job_id] = state
+
+        if delta:
+            self.publish(job_id, "update", delta)
+
+    ## キューから次のイベントを取り出す（timeout 秒以内に無ければ None）
+    @staticmethod
+    async def next_event(queue: asyncio.Queue, timeout: float) -> Optional[tuple]:
+        try:
+            return await asyncio.wait_for(queue.get(), timeout=timeout)
+        except asyncio.TimeoutError:
+            return None
@@ -0,0 +1,162 @@
+import os
+import asyncio
+import time
+from collections import OrderedDict, deque
+from itertools import zip_longest
+from typing import Any, Awaitable, Callable, Deque, Dict, Iterator, List, Optional, Tuple
+
+######################################
+## ジョブキュー
+######################################
+
+## キューが満杯で受け付けられない場合の例外
+class QueueFullError(Exception):
+    pass
+
+
+## 上限付きのジョブキュー
+## worker_count 個のワーカーがジョブを取り出して handler を実行する
+## ジョブはグループ（バッチ）ごとに並べ、グループ間で1件ずつ順番に取り出す（ラウンドロビン）
+## これにより大きなバッチが投入されても、後から来た単発のジョブや他のバッチが待たされ続けない
+class JobQueue:
+    def __init__(
+        self,
+        handler: Callable[..., Awaitable[Any]],
+        worker_count: int,
+        max_size: int,
+        default_job_seconds: float,
+    ):
+        self.handler = handler
+        self.worker_count = worker_count
+        self.max_size = max_size
+        ## 待ち時間の見積もりに使うジョブ1件あたりの平均所要時間（指数移動平均）
+        self.average_job_seconds = default_job_seconds
+        ## グループID -> 待機中のジョブ。並び順が次に取り出すグループの順番
+        self._groups: "OrderedDict[str, Deque[Tuple[str, tuple]]]" = OrderedDict()
+        self._size = 0
+        self._wakeup = asyncio.Event()
+        self._running: Dict[str, float] = {}
+        ## 実行中のジョブのタスク（キャンセル用）
+        self._tasks: Dict[str, asyncio.Task] = {}
+        self._workers: List[asyncio.Task] = []
+
+    def start(self):
+        self._workers = [
+            asyncio.create_task(self._worker()) for _ in range(self.worker_count)
+        ]
+
+    async def stop(self):
+        for worker in self._workers:
+            worker.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+    def __len__(self) -> int:
+        return self._size
+
+    ## ジョブをグループの末尾に追加し、待ち順（1始まり）を返す
+    ## group を省略した場合はジョブ単独で1グループとして扱う
+    def submit(self, job_id: str, *args, group: Optional[str] = None) -> int:
+        self.submit_many([(job_id, args)], group=group or job_id)
+        return self.position(job_id)
+
+    ## 複数のジョブを同じグループにまとめて追加する（全件入らない場合は1件も追加しない）
+    def submit_many(self, jobs: List[Tuple[str, tuple]], group: str):
+        if self._size + len(jobs) > self.max_size:
+            raise QueueFullError("ジョブキューが満杯です")
+        self._groups.setdefault(group, deque()).extend(jobs)
+        self._size += len(jobs)
+        self._wakeup.set()
+
+    ## ワーカーが取り出す順に待機中のジョブIDを返す
+    def _dispatch_order(self) -> Iterator[str]:
+        for round_jobs in zip_longest(*self._groups.values()):
+            for job in round_jobs:
+                if job is not None:
+                    yield job[0]
+
+    ## 先頭のグループから1件取り出し、そのグループを最後尾に回す
+    def _pop(self) -> Tuple[str, tuple]:
+        group, jobs = self._groups.popitem(last=False)
+        job = jobs.popleft()
+        if jobs:
+            self._groups[group] = jobs
+        self._size -= 1
+        return job
+
+    ## 待機中のジョブをキューから取り除く。キューに無ければ False
+    def remove(self, job_id: str) -> bool:
+        for group, jobs in self._groups.items():
+            for job in jobs:
+                if job[0] == job_id:
+                    jobs.remove(job)
+                    if not jobs:
+                        del self._groups[group]
+                    self._size -= 1
+                    return True
+        return False
+
+    ## 待機中のジョブは取り除き、実行中のジョブはタスクをキャンセルして終了を待つ
+    ## （実行中のプロバイダへの要求も中断され、ワーカーは次のジョブに移る）
+    ## どちらでもなければ False
+    async def cancel(self, job_id: str) -> bool:
+        if self.remove(job_id):
+            return True
+        task = self._tasks.get(job_id)
+        if task is None:
+            return False
+        task.cancel()
+        await asyncio.wait({task})
+        return True
+
+    ## 待ち順（1始まり）。キューに無ければ None
+    def position(self, job_id: str) -> Optional[int]:
+        for index, queued_id in enumerate(self._dispatch_order()):
+            if queued_id == job_id:
+                return index + 1
+        return None
+
+    ## 処理開始までの見込み待ち時間（秒）。キューに無ければ None
+    def estimated_wait(self, job_id: str) -> Optional[float]:
+        position = self.position(job_id)
+        if position is None:
+            return None
+        ahead = position - 1 + len(self._running)
+        return (ahead // self.worker_count) * self.average_job_seconds
+
+    async def _worker(self):
+        while True:
+            while not self._size:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+
+            job_id, args = self._pop()
+            started_at = time.monotonic()
+            self._running[job_id] = started_at
+            ## ジョブ単位でキャンセルできるよう、ハンドラは別タスクで実行する
+            task = asyncio.create_task(self.handler(job_id, *args))
+            self._tasks[job_id] = task
+            try:
+                await asyncio.wait({task})
+                if not task.cancelled() and task.exception() is not None:
+                    print(f"Error in job worker ({job_id}): {task.exception()}")
+            except asyncio.CancelledError:
+                ## ワーカー自体の停止時は実行中のジョブも止める
+                task.cancel()
+                await asyncio.gather(task, return_exceptions=True)
+                raise
+            finally:
+                del self._running[job_id]
+                del self._tasks[job_id]
+                duration = time.monotonic() - started_at
+                self.average_job_seconds = 0.8 * self.average_job_seconds + 0.2 * duration
+
+
+## 環境変数から設定を読み込んでキューを作成する
+def create_job_queue(handler: Callable[..., Awaitable[Any]]) -> JobQueue:
+    return JobQueue(
+        handler,
+        worker_count=int(os.environ.get("JOB_WORKER_COUNT", 4)),
+        max_size=int(os.environ.get("JOB_QUEUE_MAX_SIZE", 100)),
+        default_job_seconds=float(os.environ.get("JOB_ESTIMATED_SECONDS", 180)),
+    )
@@ -0,0 +1,426 @@
+import os
+import json
+import base64
+import sqlite3
+import threading
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+######################################
+## ジョブの永続化（SQLite）
+######################################
+
+## jobs テーブルには進捗などの小さな状態だけを保存し、
+## HTML/CSS/JSなどの大きな生成結果は job_results テーブルに分けて保存する
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    job_id TEXT PRIMARY KEY,
+    status TEXT NOT NULL,
+    progress REAL NOT NULL DEFAULT 0,
+    current_step TEXT NOT NULL DEFAULT '',
+    steps TEXT NOT NULL,
+    error TEXT,
+    created_at TEXT NOT NULL,
+    updated_at TEXT NOT NULL,
+    original_data TEXT,
+    retry_of TEXT,
+    batch_id TEXT,
+    regenerate_step TEXT,
+    purged_at TEXT,
+    request_hash TEXT
+);
+CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs(status, created_at, job_id);
+CREATE INDEX IF NOT EXISTS idx_jobs_created_at ON jobs(created_at, job_id);
+
+CREATE TABLE IF NOT EXISTS batches (
+    batch_id TEXT PRIMARY KEY,
+    name TEXT,
+    created_at TEXT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS job_results (
+    job_id TEXT PRIMARY KEY REFERENCES jobs(job_id) ON DELETE CASCADE,
+    result TEXT NOT NULL
+);
+
+-- ステップごとの出力（再実行時に完了済みのステップを飛ばすために使う）
+CREATE TABLE IF NOT EXISTS checkpoints (
+    job_id TEXT NOT NULL REFERENCES jobs(job_id) ON DELETE CASCADE,
+    step_id TEXT NOT NULL,
+    result TEXT NOT NULL,
+    created_at TEXT NOT NULL,
+    PRIMARY KEY (job_id, step_id)
+);
+"""
+
+## 既存のデータベースに後から追加した列（列名 -> 定義）
+MIGRATION_COLUMNS = {
+    "batch_id": "TEXT",
+    "regenerate_step": "TEXT",
+    "purged_at": "TEXT",
+    "request_hash": "TEXT",
+}
+## 追加した列を使うインデックス（列の追加後に作成する）
+MIGRATION_INDEXES = """
+CREATE INDEX IF NOT EXISTS idx_jobs_batch_id ON jobs(batch_id, created_at, job_id);
+CREATE INDEX IF NOT EXISTS idx_jobs_request_hash ON jobs(request_hash, created_at);
+"""
+
+
+class JobStore:
+    def __init__(self, path: str):
+        ## FastAPIのワーカースレッドからも使われるため同一スレッド制約を外し、ロックで保護する
+        self._conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._conn.row_factory = sqlite3.Row
+        self._lock = threading.Lock()
+        with self._lock:
+            ## 状態更新を軽くするためWALモードで運用する
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute("PRAGMA foreign_keys=ON")
+            self._conn.executescript(SCHEMA)
+            self._migrate()
+
+    ## 古いスキーマで作られたデータベースに不足している列を追加する
+    def _migrate(self):
+        columns = {row["name"] for row in self._conn.execute("PRAGMA table_info(jobs)")}
+        for name, definition in MIGRATION_COLUMNS.items():
+            if name not in columns:
+                self._conn.execute(f"ALTER TABLE jobs ADD COLUMN {name} {definition}")
+        self._conn.executescript(MIGRATION_INDEXES)
+
+    @contextmanager
+    def _transaction(self) -> Iterator[sqlite3.Connection]:
+        with self._lock:
+            self._conn.execute("BEGIN")
+            try:
+                yield self._conn
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._conn.execute("COMMIT")
+
+    ## 行をAPIで返すジョブ情報の形式に変換する
+    @staticmethod
+    def _row_to_job(row: sqlite3.Row) -> Dict[str, Any]:
+        job = {
+            "jobId": row["job_id"],
+            "status": row["status"],
+            "progress": row["progress"],
+            "currentStep": row["current_step"],
+            "steps": json.loads(row["steps"]),
+            "createdAt": row["created_at"],
+        }
+        if row["error"]:
+            job["error"] = row["error"]
+        if row["original_data"]:
+            job["originalData"] = json.loads(row["original_data"])
+        if row["retry_of"]:
+            job["retryOf"] = row["retry_of"]
+        if row["batch_id"]:
+            job["batchId"] = row["batch_id"]
+        if row["regenerate_step"]:
+            job["regenerateStep"] = row["regenerate_step"]
+        if row["purged_at"]:
+            job["purgedAt"] = row["purged_at"]
+        return job
+
+    @staticmethod
+    def _insert_job(conn: sqlite3.Connection, job: Dict[str, Any]):
+        now = datetime.now().isoformat()
+        conn.execute(
+            """
+            INSERT INTO jobs (job_id, status, progress, current_step, steps,
+                              created_at, updated_at, original_data, retry_of, batch_id,
+                              regenerate_step, request_hash)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+            """,
+            (
+                job["jobId"],
+                job["status"],
+                job["progress"],
+                job["currentStep"],
+                json.dumps(job["steps"], ensure_ascii=False),
+                job.get("createdAt", now),
+                now,
+                json.dumps(job["originalData"], ensure_ascii=False) if job.get("originalData") else None,
+                job.get("retryOf"),
+                job.get("batchId"),
+                job.get("regenerateStep"),
+                job.get("requestHash"),
+            ),
+        )
+
+    ## ジョブを新規登録する
+    def create_job(self, job: Dict[str, Any]):
+        with self._transaction() as conn:
+            self._insert_job(conn, job)
+
+    ## バッチとそれに含まれるジョブをまとめて登録する
+    def create_batch(self, batch_id: str, name: Optional[str], jobs: List[Dict[str, Any]]):
+        with self._transaction() as conn:
+            conn.execute(
+                "INSERT INTO batches (batch_id, name, created_at) VALUES (?, ?, ?)",
+                (batch_id, name, datetime.now().isoformat()),
+            )
+            for job in jobs:
+                self._insert_job(conn, {**job, "batchId": batch_id})
+
+    ## バッチの情報と、含まれるジョブ（登録順、生成結果は含めない）を取得する
+    def get_batch(self, batch_id: str) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            row = self._conn.execute("SELECT * FROM batches WHERE batch_id = ?", (batch_id,)).fetchone()
+            if row is None:
+                return None
+            job_rows = self._conn.execute(
+                "SELECT * FROM jobs WHERE batch_id = ? ORDER BY rowid", (batch_id,)
+            ).fetchall()
+        return {
+            "batchId": row["batch_id"],
+            "name": row["name"],
+            "createdAt": row["created_at"],
+            "jobs": [self._row_to_job(job_row) for job_row in job_rows],
+        }
+
+    def exists(self, job_id: str) -> bool:
+        with self._lock:
+            row = self._conn.execute("SELECT 1 FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+        return row is not None
+
+    ## ジョブ情報を取得する（include_result=True の場合は生成結果も含める）
+    def get_job(self, job_id: str, include_result: bool = True) -> Optional[Dict[str, Any]]:
+        with self._lock:
+            row = self._conn.execute("SELECT * FROM jobs WHERE job_id = ?", (job_id,)).fetchone()
+            if row is None:
+                return None
+            job = self._row_to_job(row)
+            if include_result:
+                result_row = self._conn.execute(
+                    "SELECT result FROM job_results WHERE job_id = ?", (job_id,)
+                ).fetchone()
+                if result_row:
+                    job["result"] = json.loads(result_row["result"])
+        return job
+
+    ## 状態を更新する。結果があれば同じトランザクションで保存する
+    def update_status(
+        self,
+        job_id: str,
+        status: str,
+        progress: float,
+        current_step: str,
+        steps: List[Dict[str, Any]],
+        error: Optional[str] = None,
+        result: Optional[Dict[str, Any]] = None,
+    ):
+        with self._transaction() as conn:
+            conn.execute(
+                """
+                UPDATE jobs
+                SET status = ?, progress = ?, current_step = ?, steps = ?,
+                    error = COALESCE(?, error), updated_at = ?
+                WHERE job_id = ?
+                """,
+                (
+                    status,
+                    progress,
+                    current_step,
+                    json.dumps(steps, ensure_ascii=False),
+                    error,
+                    datetime.now().isoformat(),
+                    job_id,
+                ),
+            )
+            if result is not None:
+                conn.execute(
+                    "INSERT OR REPLACE INTO job_results (job_id, result) VALUES (?, ?)",
+                    (job_id, json.dumps(result, ensure_ascii=False)),
+                )
+
+    ## ステップの出力を保存する（同じステップの既存の出力は置き換える）
+    def save_checkpoint(self, job_id: str, step_id: str, result: Any):
+        with self._transaction() as conn:
+            conn.execute(
+                """
+                INSERT OR REPLACE INTO checkpoints (job_id, step_id, result, created_at)
+                VALUES (?, ?, ?, ?)
+                """,
+                (job_id, step_id, json.dumps(result, ensure_ascii=False), datetime.now().isoformat()),
+            )
+
+    ## ジョブの保存済みのステップ出力（ステップID -> 出力）
+    def get_checkpoints(self, job_id: str) -> Dict[str, Any]:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT step_id, result FROM checkpoints WHERE job_id = ?", (job_id,)
+            ).fetchall()
+        return {row["step_id"]: json.loads(row["result"]) for row in rows}
+
+    ## 作成日時の新しい順にジョブを1ページ分取得する
+    ## (created_at, job_id) のインデックスを辿るため、件数によらずページサイズ分のコストで済む
+    ## 戻り値は (ジョブ一覧, 次ページのカーソル)。最終ページではカーソルは None
+    def list_jobs(
+        self,
+        limit: int,
+        cursor: Optional[str] = None,
+        statuses: Optional[List[str]] = None,
+        include_result: bool = False,
+    ) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+        cursor_condition = ""
+        cursor_params: List[Any] = []
+        if cursor:
+            cursor_condition = "(jobs.created_at, jobs.job_id) < (?, ?)"
+            cursor_params = list(decode_cursor(cursor))
+        order = "ORDER BY jobs.created_at DESC, jobs.job_id DESC LIMIT ?"
+
+        ## 状態を複数指定した場合、IN で絞り込むと該当するすべての行を並べ替えることになるため、
+        ## 状態ごとにインデックス（status, created_at, job_id）順で1ページ分ずつ取り出し、それらだけを並べ替える
+        params: List[Any] = []
+        statuses = list(dict.fromkeys(statuses or []))
+        if len(statuses) > 1:
+            parts = []
+            for status in statuses:
+                conditions = " AND ".join(["jobs.status = ?"] + ([cursor_condition] if cursor else []))
+                parts.append(f"SELECT * FROM (SELECT jobs.* FROM jobs WHERE {conditions} {order})")
+                params.extend([status] + cursor_params + [limit + 1])
+            source = f"({' UNION ALL '.join(parts)}) AS jobs"
+            where = ""
+        else:
+            source = "jobs"
+            conditions = []
+            if statuses:
+                conditions.append("jobs.status = ?")
+                params.extend(statuses)
+            if cursor:
+                conditions.append(cursor_condition)
+                params.extend(cursor_params)
+            where = f"WHERE {' AND '.join(conditions)}" if conditions else ""
+
+        if include_result:
+            select = (
+                f"SELECT jobs.*, job_results.result AS result FROM {source} "
+                "LEFT JOIN job_results ON job_results.job_id = jobs.job_id"
+            )
+        else:
+            select = f"SELECT jobs.* FROM {source}"
+
+        ## 次ページの有無を判定するため1件多く取得する
+        with self._lock:
+            rows = self._conn.execute(f"{select} {where} {order}", params + [limit + 1]).fetchall()
+
+        next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = encode_cursor(rows[-1]["created_at"], rows[-1]["job_id"])
+
+        jobs = []
+        for row in rows:
+            job = self._row_to_job(row)
+            if include_result and row["result"]:
+                job["result"] = json.loads(row["result"])
+            jobs.append(job)
+        return jobs, next_cursor
+
+    ## 指定した状態のジョブを作成順に取得する（起動時の再開用）
+    def find_jobs_by_status(self, statuses: List[str]) -> List[Dict[str, Any]]:
+        placeholders = ", ".join("?" for _ in statuses)
+        with self._lock:
+            rows = self._conn.execute(
+                f"SELECT * FROM jobs WHERE status IN ({placeholders}) ORDER BY created_at",
+                statuses,
+            ).fetchall()
+        return [self._row_to_job(row) for row in rows]
+
+    ## 同じ入力のジョブのうち、まだ実行中のもの、または completed_after 以降に完了したもの（生成物が残っているもの）を探す
+    ## 実行中のものを優先し、同じ条件なら新しいものを返す
+    def find_coalescable_job(
+        self, request_hash: str, active_statuses: List[str], completed_after: Optional[str] = None
+    ) -> Optional[str]:
+        params: List[Any] = [request_hash] + list(active_statuses)
+        condition = f"status IN ({', '.join('?' for _ in active_statuses)})"
+        if completed_after is not None:
+            condition = f"({condition} OR (status = 'completed' AND purged_at IS NULL AND updated_at >= ?))"
+            params.append(completed_after)
+        with self._lock:
+            row = self._conn.execute(
+                f"""
+                SELECT job_id FROM jobs
+                WHERE request_hash = ? AND {condition}
+                ORDER BY status = 'completed', created_at DESC
+                LIMIT 1
+                """,
+                params,
+            ).fetchone()
+        return row["job_id"] if row else None
+
+    ## 生成物を削除していない終了済みのジョブIDを、最終更新が古い順に取得する（保持期間の管理用）
+    ## updated_before を指定すると、それより前に更新されたものに限る
+    def find_unpurged_jobs(self, statuses: List[str], updated_before: Optional[str] = None) -> List[str]:
+        params: List[Any] = list(statuses)
+        condition = ""
+        if updated_before is not None:
+            condition = "AND updated_at < ?"
+            params.append(updated_before)
+        with self._lock:
+            rows = self._conn.execute(
+                f"""
+                SELECT job_id FROM jobs
+                WHERE purged_at IS NULL AND status IN ({', '.join('?' for _ in statuses)}) {condition}
+                ORDER BY updated_at, job_id
+                """,
+                params,
+            ).fetchall()
+        return [row["job_id"] for row in rows]
+
+    ## 生成結果とステップの出力を削除し、状態などの概要だけを残す
+    def purge_job(self, job_id: str):
+        with self._transaction() as conn:
+            conn.execute("DELETE FROM job_results WHERE job_id = ?", (job_id,))
+            conn.execute("DELETE FROM checkpoints WHERE job_id = ?", (job_id,))
+            conn.execute(
+                "UPDATE jobs SET purged_at = ? WHERE job_id = ?", (datetime.now().isoformat(), job_id)
+            )
+
+    ## 保存しているジョブ・生成結果・ステップ出力の件数とサイズ（バイト）
+    def storage_stats(self) -> Dict[str, int]:
+        with self._lock:
+            jobs = self._conn.execute(
+                "SELECT COUNT(*) AS count, COUNT(purged_at) AS purged FROM jobs"
+            ).fetchone()
+            results = self._conn.execute(
+                "SELECT COUNT(*) AS count, COALESCE(SUM(LENGTH(CAST(result AS BLOB))), 0) AS bytes FROM job_results"
+            ).fetchone()
+            checkpoints = self._conn.execute(
+                "SELECT COUNT(*) AS count, COALESCE(SUM(LENGTH(CAST(result AS BLOB))), 0) AS bytes FROM checkpoints"
+            ).fetchone()
+        return {
+            "jobs": jobs["count"],
+            "purgedJobs": jobs["purged"],
+            "results": results["count"],
+            "resultBytes": results["bytes"],
+            "checkpoints": checkpoints["count"],
+            "checkpointBytes": checkpoints["bytes"],
+        }
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+
+## ページングのカーソル（最後に返したジョブの作成日時とID）を不透明な文字列にする
+def encode_cursor(created_at: str, job_id: str) -> str:
+    return base64.urlsafe_b64encode(f"{created_at}|{job_id}".encode("utf-8")).decode("ascii")
+
+
+def decode_cursor(cursor: str) -> Tuple[str, str]:
+    try:
+        created_at, job_id = base64.urlsafe_b64decode(cursor.encode("ascii")).decode("utf-8").split("|", 1)
+    except Exception as e:
+        raise ValueError("不正なカーソルです") from e
+    return created_at, job_id
+
+
+## 環境変数で指定された場所（既定では jobs/jobs.db）にストアを開く
+def open_job_store(jobs_dir: str) -> JobStore:
+    return JobStore(os.environ.get("JOB_DB_PATH", os.path.join(jobs_dir, "jobs.db")))
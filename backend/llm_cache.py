@@ -0,0 +1,169 @@
+import os
+import json
+import time
+import hashlib
+import threading
+from collections import OrderedDict
+from contextvars import ContextVar
+from functools import wraps
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+######################################
+## モデル応答のキャッシュ（コンテンツアドレス方式）
+######################################
+
+## True の間はキャッシュを読まずに必ずモデルを呼び出す（結果は保存する）
+_bypass_cache: ContextVar[bool] = ContextVar("bypass_response_cache", default=False)
+
+
+## 作り直しを指示されたステップなど、キャッシュ済みの応答を使ってはいけない処理を包む
+## （非同期タスクごとにコンテキストが分かれるため、他のステップには影響しない）
+def without_response_cache(func: Callable[..., Awaitable[Any]]) -> Callable[..., Awaitable[Any]]:
+    @wraps(func)
+    async def wrapper(*args, **kwargs):
+        token = _bypass_cache.set(True)
+        try:
+            return await func(*args, **kwargs)
+        finally:
+            _bypass_cache.reset(token)
+    return wrapper
+
+## (プロバイダ, モデル, システムプロンプト, 生成パラメータ, 入力) のハッシュをキーとして
+## 応答をディスクに保存する。容量と有効期限を超えたものは古い順（LRU）に削除する
+class ResponseCache:
+    def __init__(self, directory: str, max_bytes: int, ttl_seconds: float, enabled: bool = True):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.enabled = enabled
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        ## キー -> (サイズ, 作成時刻)。並び順が最近使われた順（末尾が最新）
+        self._index: "OrderedDict[str, tuple]" = OrderedDict()
+        self._total_bytes = 0
+        if enabled:
+            os.makedirs(directory, exist_ok=True)
+            self._load_index()
+
+    ## 起動時に既存のキャッシュファイルを作成時刻順に読み込む
+    def _load_index(self):
+        entries = []
+        for sub_dir in os.listdir(self.directory):
+            sub_path = os.path.join(self.directory, sub_dir)
+            if not os.path.isdir(sub_path):
+                continue
+            for key in os.listdir(sub_path):
+                if key.endswith(".tmp"):
+                    continue
+                stat = os.stat(os.path.join(sub_path, key))
+                entries.append((stat.st_mtime, key, stat.st_size))
+        for created_at, key, size in sorted(entries):
+            self._index[key] = (size, created_at)
+            self._total_bytes += size
+        self._evict()
+
+    @staticmethod
+    def make_key(provider: str, model: str, system: Any, params: Dict[str, Any], input: Any) -> str:
+        payload = json.dumps(
+            {"provider": provider, "model": model, "system": system, "params": params, "input": input},
+            sort_keys=True,
+            ensure_ascii=False,
+        )
+        return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.directory, key[:2], key)
+
+    def _remove(self, key: str):
+        size, _ = self._index.pop(key)
+        self._total_bytes -= size
+        try:
+            os.remove(self._path(key))
+        except FileNotFoundError:
+            pass
+
+    ## 容量・有効期限を超えたエントリを古い順に削除する
+    def _evict(self):
+        now = time.time()
+        for key, (_, created_at) in list(self._index.items()):
+            if now - created_at > self.ttl_seconds:
+                self._remove(key)
+                self.evictions += 1
+        while self._total_bytes > self.max_bytes and self._index:
+            self._remove(next(iter(self._index)))
+            self.evictions += 1
+
+    def get(self, key: str) -> Optional[bytes]:
+        if not self.enabled or _bypass_cache.get():
+            return None
+        with self._lock:
+            entry = self._index.get(key)
+            if entry is not None and time.time() - entry[1] > self.ttl_seconds:
+                self._remove(key)
+                self.evictions += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            try:
+                with open(self._path(key), "rb") as f:
+                    value = f.read()
+            except FileNotFoundError:
+                self._index.pop(key)
+                self._total_bytes -= entry[0]
+                self.misses += 1
+                return None
+            self._index.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key: str, value: bytes):
+        if not self.enabled:
+            return
+        with self._lock:
+            path = self._path(key)
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            ## 書きかけのファイルを読まないよう一時ファイル経由で置き換える
+            tmp_path = f"{path}.tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(value)
+            os.replace(tmp_path, path)
+            if key in self._index:
+                self._total_bytes -= self._index.pop(key)[0]
+            self._index[key] = (len(value), time.time())
+            self._total_bytes += len(value)
+            self._evict()
+
+    def get_text(self, key: str) -> Optional[str]:
+        value = self.get(key)
+        return value.decode("utf-8") if value is not None else None
+
+    def set_text(self, key: str, value: str):
+        self.set(key, value.encode("utf-8"))
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "enabled": self.enabled,
+                "hits": self.hits,
+                "misses": self.misses,
+                "hitRate": self.hits / lookups if lookups else 0.0,
+                "evictions": self.evictions,
+                "entries": len(self._index),
+                "bytes": self._total_bytes,
+                "maxBytes": self.max_bytes,
+                "ttlSeconds": self.ttl_seconds,
+            }
+
+
+## 環境変数から設定を読み込んでキャッシュを作成する（既定では無効）
+def open_response_cache() -> ResponseCache:
+    return ResponseCache(
+        directory=os.path.abspath(os.environ.get("LLM_CACHE_DIR", "cache")),
+        max_bytes=int(os.environ.get("LLM_CACHE_MAX_BYTES", 500 * 1024 * 1024)),
+        ttl_seconds=float(os.environ.get("LLM_CACHE_TTL_SECONDS", 7 * 24 * 60 * 60)),
+        enabled=os.environ.get("LLM_CACHE_ENABLED", "0").lower() in ("1", "true", "yes"),
+    )
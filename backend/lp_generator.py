@@ -1,13 +1,20 @@
 import os
+import asyncio
 import google.generativeai as genai
-import json
-import re
-import ray
-from collections import defaultdict
-from PIL import Image
-from io import BytesIO
-import time
+import shutil
 from dotenv import load_dotenv
+from google.api_core import exceptions as google_exceptions
+from scheduler import PipelineStep, run_pipeline
+import rate_limit
+import metrics
+from llm_cache import ResponseCache, open_response_cache
+from image_worker import imagen_model, get_image_executor, shutdown_image_executor
+from html_patch import HtmlPatchError, apply_patch
+from code_fence import FenceParser, parse_code_blocks, parse_json, select_code
+from text_providers import TextProvider, generate_with_failover, parse_step_seconds, env_seconds
+from image_variants import (
+    generate_variants, find_variants, apply_responsive_css, apply_responsive_html, shutdown_variant_pool,
+)
 
 # 環境変数の読み込み
 load_dotenv()
@@ -17,8 +24,6 @@ load_dotenv()
 ######################################
 
 ## geminiを使う場合
-from google import genai as genai_img
-from google.genai import types
 genai.configure(api_key=os.environ.get("GEMINI_API_KEY"))
 generation_config = {
     "temperature": 1,
@@ -29,147 +34,334 @@ generation_config = {
 }
 
 ## claudeを使う場合
+## イベントループを止めないよう非同期クライアントを使う
 import anthropic
-client = anthropic.Anthropic(
-    api_key=os.environ.get("ANTHROPIC_API_KEY")
+## 接続先は ANTHROPIC_BASE_URL で変更できる（未設定なら公式API）
+## 再試行は rate_limit.call_with_retry とプロバイダの切り替えで行うため、SDK内部の再試行は無効にする
+## （SDKが裏で再試行すると、切り替えが遅れ、ヘッジ・タイムアウトの時間にも含まれてしまう）
+client = anthropic.AsyncAnthropic(
+    api_key=os.environ.get("ANTHROPIC_API_KEY"),
+    max_retries=0,
 )
-def claude(system_prompt, prompt):
-    message = client.messages.create(
-        # model = "claude-3-5-sonnet-20241022",
-        model = "claude-3-7-sonnet-20250219",
-        max_tokens = 8192,
-        temperature = 1,
-        system = system_prompt,
-        messages = [
-            {
-                "role": "user",
-                "content": [
-                    {
-                        "type": "text",
-                        "text": prompt
-                    }
-                ]
-            }
-        ]
-    )
+## 再試行する一時的なエラー（レート制限・過負荷などの5xx・接続エラーとタイムアウト）
+CLAUDE_RETRYABLE_ERRORS = (anthropic.RateLimitError, anthropic.InternalServerError, anthropic.APIConnectionError)
+# claude_model = "claude-3-5-sonnet-20241022"
+claude_model = "claude-3-7-sonnet-20250219"
+claude_config = {
+    "max_tokens": 8192,
+    "temperature": 1,
+}
+
+## ヒーロー画像のファイル名と、画像適用エージェントがCSSに入れるプレースホルダー
+HERO_IMAGE_NAME = "placeholder_css_1.jpg"
+IMAGE_PLACEHOLDER = "${imageBase64}"
+
+## 同じ入力に対する応答のキャッシュ（LLM_CACHE_ENABLED=1 で有効）
+response_cache = open_response_cache()
+
+## ストリームがこの秒数以上途切れたら停止とみなして中断する
+CLAUDE_STREAM_IDLE_TIMEOUT = float(os.environ.get("CLAUDE_STREAM_IDLE_TIMEOUT", 60))
+## 途中経過を通知する最小間隔（秒）
+PROGRESS_INTERVAL = 0.5
+
+## ストリームが停止した場合の例外
+class StreamStalledError(Exception):
+    pass
+
+## プロンプトキャッシュの区切り。先頭からこの位置までの内容がキャッシュされ、
+## 同じ内容で始まる次のリクエストでは読み込みだけで済む（入力トークンの課金と初回応答までの時間を削減）
+## ※ モデルごとの最小トークン数に満たない場合はキャッシュされない
+CACHE_CONTROL = {"type": "ephemeral"}
+
+## Claudeの応答をストリーミングで受け取る
+## on_progress(これまでのテキスト, 出力トークン数) が一定間隔で呼ばれる
+## shared_prefix を渡すと、ユーザーメッセージの先頭に置いてキャッシュの区切りを付ける
+## （同じシステムプロンプトと shared_prefix で呼ぶ他のエージェントとキャッシュを共有できる）
+## on_usage(使用量) には入力・出力トークン数とキャッシュの書き込み・読み込みトークン数が渡される
+## ANTHROPIC_BASE_URL を設定すると、APIの接続先をモックなどに差し替えられる
+## model を省略すると claude_model を使う。max_retries はレート制限時の再試行回数
+## timeout は1回の要求のタイムアウト（秒）。レート制限の待ち時間と再試行までの待ち時間は含まない
+## validate を渡すと、それを満たす応答だけをキャッシュに保存する（use_cache=False でキャッシュを参照しない）
+## on_admitted() はレート制限の待ちが終わり、要求を送信する直前に呼ばれる
+async def claude(
+    system_prompt, prompt, on_progress=None, shared_prefix=None, on_usage=None,
+    model=None, max_retries=rate_limit.RATE_LIMIT_MAX_RETRIES,
+    timeout=None, validate=None, use_cache=True, on_admitted=None,
+):
+    model = model or claude_model
+    ## 同じモデル・プロンプト・パラメータの応答があれば再利用する
+    cache_input = [shared_prefix, prompt] if shared_prefix else prompt
+    cache_key = ResponseCache.make_key("anthropic", model, system_prompt, claude_config, cache_input)
+    cached = response_cache.get_text(cache_key) if use_cache else None
+    if cached is not None and (validate is None or validate(cached)):
+        if on_progress:
+            on_progress(cached, rate_limit.estimate_tokens(cached))
+        return cached
+
+    system = [{"type": "text", "text": system_prompt, "cache_control": CACHE_CONTROL}]
+    content = []
+    if shared_prefix:
+        content.append({"type": "text", "text": shared_prefix, "cache_control": CACHE_CONTROL})
+    content.append({"type": "text", "text": prompt})
+
+    async def stream_message():
+        async with client.messages.stream(
+            model = model,
+            **claude_config,
+            system = system,
+            messages = [
+                {
+                    "role": "user",
+                    "content": content
+                }
+            ]
+        ) as stream:
+            text = ""
+            notified_at = 0.0
+            chunks = stream.text_stream.__aiter__()
+            while True:
+                try:
+                    chunk = await asyncio.wait_for(chunks.__anext__(), CLAUDE_STREAM_IDLE_TIMEOUT)
+                except StopAsyncIteration:
+                    break
+                except asyncio.TimeoutError:
+                    raise StreamStalledError(
+                        f"Claudeの応答が{CLAUDE_STREAM_IDLE_TIMEOUT:.0f}秒間途切れたため中断しました"
+                    )
+                text += chunk
+                ## 出力トークン数は最後にしか返らないため、途中は文字数から概算する
+                if on_progress and asyncio.get_running_loop().time() - notified_at >= PROGRESS_INTERVAL:
+                    notified_at = asyncio.get_running_loop().time()
+                    on_progress(text, rate_limit.estimate_tokens(text))
+            return await stream.get_final_message()
+
+
+    async def request():
+        ## プロバイダのレート制限内に収まるまで待ってから送信する
+        await rate_limit.anthropic_requests.acquire()
+        await rate_limit.anthropic_input_tokens.acquire(
+            rate_limit.estimate_tokens(system_prompt + (shared_prefix or "") + prompt)
+        )
+        await rate_limit.anthropic_output_tokens.acquire(0)
+        if on_admitted:
+            on_admitted()
+        async with asyncio.timeout(timeout):
+            return await stream_message()
+
+    ## SDK内部では再試行しないため、過負荷・5xx・接続エラーもここで再試行する
+    message = await rate_limit.call_with_retry(request, CLAUDE_RETRYABLE_ERRORS, max_retries)
+    ## 出力トークン数はレスポンス後にしか分からないので、ここで差し引く
+    rate_limit.anthropic_output_tokens.debit(message.usage.output_tokens)
+    metrics.record_tokens(message.usage.input_tokens, message.usage.output_tokens)
     # print(message.content[0].text)
+    if on_usage:
+        on_usage({
+            "inputTokens": message.usage.input_tokens,
+            "outputTokens": message.usage.output_tokens,
+            "cacheCreationInputTokens": message.usage.cache_creation_input_tokens or 0,
+            "cacheReadInputTokens": message.usage.cache_read_input_tokens or 0,
+        })
+    if on_progress:
+        on_progress(message.content[0].text, message.usage.output_tokens)
+    ## 途中で切れた応答などを保存すると、再実行しても同じ応答が返り続けるため保存しない
+    if validate is None or validate(message.content[0].text):
+        response_cache.set_text(cache_key, message.content[0].text)
     return message.content[0].text
 
+## geminiでテキストを生成する（config で生成設定の一部を上書きできる）
+## timeout を指定すると、1回の要求がその秒数を超えた場合に asyncio.TimeoutError を送出する
+## validate・use_cache・on_admitted は claude() と同じ
+async def gemini(
+    model_name, system_instruction, prompt, config=None,
+    timeout=None, max_retries=rate_limit.RATE_LIMIT_MAX_RETRIES,
+    validate=None, use_cache=True, on_admitted=None,
+):
+    config = {**generation_config, **(config or {})}
+    cache_key = ResponseCache.make_key("gemini", model_name, system_instruction, config, prompt)
+    cached = response_cache.get_text(cache_key) if use_cache else None
+    if cached is not None and (validate is None or validate(cached)):
+        return cached
+
+    model = genai.GenerativeModel(
+        model_name = model_name,
+        generation_config = config,
+        system_instruction = system_instruction,
+    )
+
+    async def request():
+        await rate_limit.gemini_requests.acquire()
+        if on_admitted:
+            on_admitted()
+        return await asyncio.wait_for(model.generate_content_async(prompt), timeout)
+
+    response = await rate_limit.call_with_retry(request, (google_exceptions.ResourceExhausted,), max_retries)
+    usage = getattr(response, "usage_metadata", None)
+    if usage is not None:
+        metrics.record_tokens(usage.prompt_token_count, usage.candidates_token_count)
+    if validate is None or validate(response.text):
+        response_cache.set_text(cache_key, response.text)
+    return response.text
+
+
+######################################
+## テキスト生成のプロバイダ
+######################################
+
+## ワイヤーフレーム・CSS・JSの生成に使うプロバイダを優先順に指定する
+## "claude" / "gemini" の後に ":モデル名" を付けるとモデルを変更できる（例: "claude,claude:claude-3-5-sonnet-20241022"）
+## 先頭のプロバイダが 5xx/429・タイムアウトで失敗した場合、次のプロバイダに切り替える
+TEXT_PROVIDERS = [
+    name.strip() for name in os.environ.get("TEXT_PROVIDERS", "claude,gemini").split(",") if name.strip()
+]
+## 既定のモデル
+TEXT_PROVIDER_MODELS = {
+    "claude": claude_model,
+    "gemini": "gemini-2.0-flash",
+}
+## ステップごとの1回の要求のタイムアウト（秒）。TEXT_STEP_TIMEOUTS="wireframe=300,js=120" のように上書きできる
+## image-prompt は画像生成のプロンプト作成、apply-image は画像適用の要求
+STEP_TIMEOUTS = {
+    "wireframe": 240,
+    "css": 240,
+    "js": 240,
+    "image-prompt": 60,
+    "apply-image": 180,
+    **parse_step_seconds(os.environ.get("TEXT_STEP_TIMEOUTS")),
+}
+## この秒数までにどの要求からも出力が届かなければ、次のプロバイダにも並行して要求する（未設定なら無効）
+TEXT_HEDGE_DELAY_SECONDS = env_seconds("TEXT_HEDGE_DELAY_SECONDS")
+
+
+async def _claude_text(model, system_prompt, prompt, on_progress, shared_prefix, on_usage, **options):
+    return await claude(system_prompt, prompt, on_progress, shared_prefix, on_usage, model=model, **options)
+
+## Geminiはストリーミング・プロンプトキャッシュを使わないため、共通部分と指示をつなげて送る
+async def _gemini_text(model, system_prompt, prompt, on_progress, shared_prefix, on_usage, **options):
+    full_prompt = f"{shared_prefix}\n\n{prompt}" if shared_prefix else prompt
+    return await gemini(model, system_prompt, full_prompt, **options)
+
+TEXT_PROVIDER_FUNCTIONS = {
+    "claude": _claude_text,
+    "gemini": _gemini_text,
+}
+
+
+def create_text_providers(names):
+    providers = []
+    for name in names:
+        kind, _, model = name.partition(":")
+        if kind not in TEXT_PROVIDER_FUNCTIONS:
+            raise ValueError(f"TEXT_PROVIDERS に不明なプロバイダが指定されています: {name}")
+        function = TEXT_PROVIDER_FUNCTIONS[kind]
+        model = model or TEXT_PROVIDER_MODELS[kind]
+        providers.append(TextProvider(
+            name=f"{kind}:{model}",
+            generate=lambda *args, function=function, model=model, **options: function(model, *args, **options),
+        ))
+    return providers
+
+text_providers = create_text_providers(TEXT_PROVIDERS)
+
+
+## 次のプロバイダに切り替えるべき失敗か（サーバーエラー・レート制限・タイムアウト・接続エラー）
+def is_failover_error(error):
+    if isinstance(error, anthropic.APIStatusError):
+        ## ストリーミング中のエラーはHTTPステータスが200のままなので、エラーの種類で判断する
+        body = error.body if isinstance(error.body, dict) else {}
+        error_type = (body.get("error") or {}).get("type")
+        return (
+            error.status_code == 429 or error.status_code >= 500
+            or error_type in ("overloaded_error", "api_error", "rate_limit_error")
+        )
+    return isinstance(error, (
+        asyncio.TimeoutError,
+        StreamStalledError,
+        anthropic.APIConnectionError,
+        google_exceptions.ServerError,
+        google_exceptions.TooManyRequests,
+    ))
+
+
+## テキスト生成の各ステップから呼ぶ（プロバイダの切り替え・ヘッジ・タイムアウトを適用する）
+async def generate_text(step_id, system_prompt, prompt, on_progress=None, shared_prefix=None, on_usage=None, validate=None):
+    return await generate_with_failover(
+        text_providers,
+        system_prompt,
+        prompt,
+        is_failover_error,
+        timeout=STEP_TIMEOUTS.get(step_id),
+        hedge_delay=TEXT_HEDGE_DELAY_SECONDS,
+        validate=validate,
+        on_progress=on_progress,
+        shared_prefix=shared_prefix,
+        on_usage=on_usage,
+    )
+
+## 最後まで出力されたHTMLか（出力トークンの上限で途中で切れていないか）
+def is_complete_html(text):
+    return "</html>" in text.lower() and is_complete_code(text)
+
+## コードブロックが閉じられているか（開くフェンスと閉じるフェンスが対になっているか）
+## 途中で切れた出力は生成失敗として扱い、フェイルオーバーさせる
+def is_complete_code(text):
+    return text.count("```") % 2 == 0
+
 
 ######################################
 ## 補助関数
 ######################################
 
+## JSONの出力を読み込む（```json のコードブロックや前後の説明文は取り除く）
 def safe_json_loads(text):
-    text = text.strip()
-    if text.startswith("```"):
-        text = re.sub(r"^```(?:json)?\n", "", text)
-        text = re.sub(r"\n```$", "", text)
-    try:
-        return json.loads(text)
-    except json.JSONDecodeError:
-        json_match = re.search(r'(\{.*\})', text, re.DOTALL)
-        if json_match:
-            try:
-                return json.loads(json_match.group(1))
-            except json.JSONDecodeError as e:
-                raise Exception("抽出した JSON のデコードに失敗しました") from e
-        else:
-            raise Exception("テキスト内に有効な JSON が見つかりませんでした")
-
-## Markdown のコードブロック（```html）からHTMLコード部分を抽出する
-def extract_html_code(text):
-    text = text.strip()
-    if text.startswith("```"):
-        text = re.sub(r"^```(?:html)?\n", "", text, flags=re.IGNORECASE)  # 大文字小文字を区別しない
-        text = re.sub(r"\n```$", "", text)
-        return text.strip()
-    return None
-
-## Markdown のコードブロック（```css）からCSSコード部分を抽出する
-def extract_css_code(text):
-    text = text.strip()
-    if text.startswith("```"):
-        text = re.sub(r"^```(?:css)?\n", "", text, flags=re.IGNORECASE)  # 大文字小文字を区別しない
-        text = re.sub(r"\n```$", "", text)
-        return text.strip()
-    return text
-
-## Markdown のコードブロック（```js）からjsコード部分を抽出する
-def extract_js_code(text):
-    text = text.strip()
-    if text.startswith("```"):
-        text = re.sub(r"^```(?:javascript)?\n", "", text, flags=re.IGNORECASE)  # 大文字小文字を区別しない
-        text = re.sub(r"\n```$", "", text)
-        return text.strip()
-    return text
+    return parse_json(text)
 
 ## テキストデータ内のHTMLコードとCSSコードを区別する
 def extract_code_blocks_by_type(text):
-    pattern = r'```(\w+)\n(.*?)\n```'
-    matches = re.finditer(pattern, text, re.DOTALL)
-    
-    code_dict = defaultdict(list)
-    for match in matches:
-        lang, code = match.groups()
-        code_dict[lang].append(code.strip())
-
-    html_code = "\n".join(code_dict.get("html", []))
-    css_code = "\n".join(code_dict.get("css", []))
+    blocks = parse_code_blocks(text)
+    return (
+        select_code(blocks, "", ["html"], fallback=False),
+        select_code(blocks, "", ["css"], fallback=False),
+    )
 
-    return html_code, css_code
+## 生成途中の出力をファイルに反映しつつ、呼び出し元へも通知する
+## 出力は前回からの差分だけをパーサーに渡して書きかけのコードブロックの中身を書き込み、
+## 生成が終わったら読み取り済みのコードブロックからコードを取り出す（出力全体を読み直さない）
+class CodeStreamWriter:
+    def __init__(self, file_name, on_progress=None):
+        self.file_name = file_name
+        self.on_progress = on_progress
+        self.parser = FenceParser()
+
+    def __call__(self, text, output_tokens):
+        self.parser.update(text)
+        with open(self.file_name, "w", encoding="utf-8") as f:
+            f.write(self.parser.partial)
+        if self.on_progress:
+            self.on_progress(text, output_tokens)
+
+    ## 生成が終わった出力から、指定した言語のコードを取り出す
+    def extract(self, text, languages):
+        self.parser.update(text)
+        blocks = self.parser.close()
+        return select_code(blocks, self.parser.text, languages)
 
 ## ファイルに書き込む
 def save_to_file(html_content, file_name):
     try:
         with open(file_name, "w", encoding="utf-8") as f:
             f.write(html_content)
+        metrics.record_output_file(file_name)
         print(f"{file_name}にコンテンツを保存しました。")
     except Exception as e:
         print(html_content)
         print(f"エラーが発生しました: {e}")
 
-## APIを使って画像生成するコード
-@ray.remote
-def generate_image_by_imagen3(prompt, file_name, aspect_ratio=None):
-    # APIクライアントの初期化
-    client = genai_img.Client(api_key=os.environ.get("GOOGLE_IMAGEN_API_KEY"))
-    
-    # ファイル名に基づいてアスペクト比を決定
-    if aspect_ratio is None:
-        if 'html' in file_name.lower():
-            aspect_ratio = '1:1'
-        elif 'css' in file_name.lower():
-            aspect_ratio = '16:9'
-        else:
-            aspect_ratio = '1:1'  # デフォルト値
-
-    # 生成設定
-    config = types.GenerateImagesConfig(
-        number_of_images=1,
-        aspect_ratio=aspect_ratio
-    )
-    
-    # 画像生成
-    response = client.models.generate_images(
-        model='imagen-3.0-generate-002',
-        prompt=prompt,
-        config=config
-    )
-    
-    # 画像の保存
-    image = Image.open(BytesIO(response.generated_images[0].image.image_bytes))
-    image.save(file_name)
-    print(f"画像を保存しました: {file_name}")
-    return file_name
-
-
 ######################################
 ## エージェント関数
 ######################################
 
 ## ワイヤーフレーム作成エージェント
-def wireframe_generate_agent(section_idea):
+async def wireframe_generate_agent(section_idea, output_dir=".", on_progress=None, on_usage=None):
     print("\n===ワイヤーフレーム作成エージェント===")
     print("【ClaudeでHTMLを作成しています．．．】")
     
@@ -198,100 +390,130 @@ LPの構成案が与えられます。
 *   `<body>`タグの最下部には、<script src="script.js"></script>を含めてください。
 """
     )
-    response = claude(system_prompt, str(section_idea))
-    data = extract_html_code(response)
+    writer = CodeStreamWriter(os.path.join(output_dir, "index.html"), on_progress)
+    response = await generate_text(
+        "wireframe",
+        system_prompt,
+        str(section_idea),
+        writer,
+        on_usage=on_usage,
+        validate=is_complete_html,
+    )
+    data = writer.extract(response, ["html"])
 
     ## htmlファイルとして保存
-    save_to_file(data, "index.html")
+    save_to_file(data, os.path.join(output_dir, "index.html"))
 
     return data
 
+## デザイン提案エージェント（CSS・JS）で共通のシステムプロンプト
+## CSSとJSの生成で「システムプロンプト + HTML」までを同一にし、プロンプトキャッシュを共有する
+## エージェントごとの指示はHTMLの後に続ける
+DESIGN_SYSTEM_PROMPT = (
+"""あなたは、HTMLで構築されたランディングページ（LP）のデザインを担当するエージェントです。
+
+**入力:**
+
+*   最初に、セクション構成が既に構築されたHTMLが与えられます。
+*   続けて、担当するタスクの指示が与えられます。必要に応じてCSSコードも与えられます。
+
+**出力:**
+
+*   タスクで指示されたコードのみを出力してください。余分な説明文を含めないでください。
+"""
+)
+
+## デザイン提案エージェントに渡すHTML（CSS・JSのエージェント間でキャッシュを共有する部分）
+def design_html_prefix(html_data):
+    return f"**HTML**:\n{html_data}"
+
 ## デザイン提案エージェント（CSS）
-def design_css_agent(html_data):
+async def design_css_agent(html_data, output_dir=".", on_progress=None, on_usage=None):
     print("\n===デザイン提案エージェント（CSS）===")
 
     print("【claudeでCSSを作成しています．．．】")
-    system_prompt = (
-"""あなたは、HTMLで構築されたランディングページ（LP）にCSSでデザインを提案するエージェントです。
-
-**タスク:**
+    prompt = (
+"""**タスク:**
 
 与えられたHTMLに対して、魅力的なLPとなるようにCSSコードでデザインを提案してください。
 
-**入力:**
-
-*   セクション構成が既に構築されたHTMLが与えられます。
-
 **出力:**
 
 *   厳密なCSSコードのみを出力してください。余分な説明文を含めないでください。
 *   デザイン性を重視してください。
 """    
     )
-    response = claude(system_prompt, html_data)
-    data = extract_css_code(response)
+    writer = CodeStreamWriter(os.path.join(output_dir, "style.css"), on_progress)
+    response = await generate_text(
+        "css",
+        DESIGN_SYSTEM_PROMPT,
+        prompt,
+        writer,
+        shared_prefix=design_html_prefix(html_data),
+        on_usage=on_usage,
+        validate=is_complete_code,
+    )
+    data = writer.extract(response, ["css"])
 
     ## cssファイルとして保存
-    save_to_file(data, "style.css")
+    save_to_file(data, os.path.join(output_dir, "style.css"))
 
     return data
 
 ## デザイン提案エージェント（JS）
-def design_js_agent(html_data, css_data):
+async def design_js_agent(html_data, css_data, output_dir=".", on_progress=None, on_usage=None):
     print("\n===デザイン提案エージェント（JS）===")
     print("【claudeでJSを作成しています．．．】")
-    system_prompt = (
-"""あなたは、HTMLで構築されたランディングページ（LP）にJavaScriptを用いて動的なデザイン要素を追加するエージェントです。
-
-**タスク:**
-
-与えられたHTMLに対して、ユーザーエクスペリエンスを向上させるためのJavaScriptコードを提案してください。
-
-**入力:**
+    prompt = (
+"""**タスク:**
 
-*   セクション構成が既に構築されたHTMLコードと、CSSコードが与えられます。
+与えられたHTMLと、その下に示すCSSに対して、ユーザーエクスペリエンスを向上させるためのJavaScriptコードを提案してください。
 
 **出力:**
 
 *   厳密なJavaScriptコードのみを出力してください。
-*   デザイン性を重視して、ユーザーエクスペリエンスの向上を目指してください。"""
+*   デザイン性を重視して、ユーザーエクスペリエンスの向上を目指してください。
 
-    )
-    prompt = (
-        "**HTML**:"
-        f"{html_data}"
-        ""
-        "**CSS**:"
+"""
+        "**CSS**:\n"
         f"{css_data}"
     )
-    response = claude(system_prompt, prompt)
-    data = extract_js_code(response)
+    writer = CodeStreamWriter(os.path.join(output_dir, "script.js"), on_progress)
+    response = await generate_text(
+        "js",
+        DESIGN_SYSTEM_PROMPT,
+        prompt,
+        writer,
+        shared_prefix=design_html_prefix(html_data),
+        on_usage=on_usage,
+        validate=is_complete_code,
+    )
+    data = writer.extract(response, ["javascript"])
 
-    ## cssファイルとして保存
-    save_to_file(data, "script.js")
+    ## jsファイルとして保存
+    save_to_file(data, os.path.join(output_dir, "script.js"))
 
     return data
 
 ## 画像を作成するエージェント
-def image_generate_agent(html_data):
+async def image_generate_agent(html_data, output_dir="."):
     print("\n===画像を作成するエージェント===")
     
     ## まずは必要な画像の情報を取得する
-    model = genai.GenerativeModel(
-        model_name = "gemini-2.0-flash",
-        generation_config = generation_config,
-        system_instruction = (
+    response = await gemini(
+        "gemini-2.0-flash",
+        (
             "あなたは、画像生成のプロンプトを作成するエージェントです。"
             "あなたには、ランディングページのHTMLが与えられます。"
 
             "**出力**:"
             "ランディングページのヒーローセクションに使用する画像を1つ提案し、それを画像生成するためのプロンプトを英語で作成してください。"
             """出力は厳密なJSON形式で、キーを"placeholder_css_1.jpg"とし、バリューをプロンプトとしてください。"""
-        )
+        ),
+        str(html_data),
+        timeout=STEP_TIMEOUTS.get("image-prompt"),
     )
-    
-    response = model.generate_content(str(html_data))
-    image_information_json = safe_json_loads(response.text)
+    image_information_json = safe_json_loads(response)
     print(image_information_json)
 
     ## プレースホルダーのファイル名とプロンプトをそれぞれリストにまとめる
@@ -303,47 +525,116 @@ def image_generate_agent(html_data):
     generated_files = []
     ## リストの順番で画像生成
     try:
-        if not ray.is_initialized():
-            ray.init()
-        
-        image_tasks = [
-            generate_image_by_imagen3.remote(image_prompt, file_name)
-            for image_prompt, file_name in zip(prompt_data, file_name_data)
-        ]
+        ## ワーカーの作業ディレクトリに依存しないよう絶対パスで渡す
+        ## Imagenのレート制限は1枚ごとに確認してからタスクを投入する
+        executor = await get_image_executor()
+        image_tasks = []
+        cache_keys = {}
+        for image_prompt, file_name in zip(prompt_data, file_name_data):
+            file_path = os.path.abspath(os.path.join(output_dir, file_name))
+
+            ## 同じプロンプトの画像がキャッシュにあれば生成せずに書き出す
+            cache_key = ResponseCache.make_key(
+                "imagen", imagen_model, None, {"file_name": file_name}, image_prompt
+            )
+            cached_image = response_cache.get(cache_key)
+            if cached_image is not None:
+                with open(file_path, "wb") as f:
+                    f.write(cached_image)
+                generated_files.append(file_path)
+                continue
+
+            cache_keys[file_path] = cache_key
+            await rate_limit.imagen_images.acquire()
+            image_tasks.append(executor.generate(image_prompt, file_path))
         
         try:
-            generated_files = ray.get(image_tasks)
+            ## 常駐ワーカーで並行に生成する
+            new_files = await asyncio.gather(*image_tasks)
+            if response_cache.enabled:
+                for file_path in new_files:
+                    with open(file_path, "rb") as f:
+                        response_cache.set(cache_keys[file_path], f.read())
+            generated_files.extend(new_files)
             print(f"生成された画像ファイル: {generated_files}")
-            time.sleep(0.5)
         except Exception as e:
             print(f"画像生成中にエラーが発生しました: {e}")
     except Exception as e:
         print(f"画像生成タスクの作成中にエラーが発生しました: {e}")
+
+    ## 幅違い・形式違いの派生ファイルをプロセスプールで作成する（失敗しても元画像は使える）
+    results = await asyncio.gather(
+        *(generate_variants(file_path) for file_path in generated_files), return_exceptions=True
+    )
+    for file_path, variants in zip(generated_files, results):
+        metrics.record_output_file(file_path)
+        if isinstance(variants, Exception):
+            print(f"派生画像の作成中にエラーが発生しました: {file_path}: {variants}")
+        else:
+            print(f"派生画像を作成しました: {[v['name'] for v in variants]}")
+            for variant in variants:
+                metrics.record_output_file(os.path.join(os.path.dirname(file_path), variant["name"]))
     
     return generated_files
 
-## 画像を適用するエージェント
-def apply_image(html_data, css_data):
-    print("\n===画像を適用するエージェント===")
-    print("【Geminiでコードを修正中です．．．】")
+## 画像適用の方式
+## patch: ヒーローセクションの差分だけを出力させてローカルで適用する（失敗したら full で作り直す）
+## full : 修正後のHTML・CSS全文を出力させる
+APPLY_IMAGE_MODE = os.environ.get("APPLY_IMAGE_MODE", "patch").lower()
+
+## 画像適用エージェントの共通の注意点
+APPLY_IMAGE_NOTES = (
+    "**注意点**:"
+    "*   変更はヒーローセクションに限定してください。他のセクションには手を加えないでください。"
+    "*   画像上のテキストの可読性に注意して、テキストに影を加えたり画像上に暗いオーバーレイを入れたりと、工夫してください。"
+    "*   画像のアスペクト比は16:9の想定です。コンテナーサイズは画像の高さに合わせて変更してください（800pxほど）。"
+)
 
-    model = genai.GenerativeModel(
-        model_name = "gemini-2.0-flash",
-        generation_config = generation_config,
-        system_instruction = (
-            "あなたは、HTMLとCSSに画像を適用するエージェントです。"
-            "あなたには、htmlコードとcssコードが与えられます。"
+## ヒーローセクションの差分（セレクタ・要素のHTML・追加のCSS）を出力させて適用する
+## 出力トークンがページ全体ではなくヒーローセクション分で済む
+async def apply_image_patch(html_data, css_data):
+    system_instruction = (
+        "あなたは、HTMLとCSSに画像を適用するエージェントです。"
+        "あなたには、htmlコードとcssコードが与えられます。"
+
+        "**出力**:"
+        "*   ページ全体は出力せず、ヒーローセクションの変更内容だけを次のキーを持つJSONで出力してください。"
+        """*   "selector": 置き換えるヒーローセクションの要素を特定するセレクタ。タグ名・#id・.classの組み合わせのみとし（例: "section#hero", "section.hero"）、ページ内で1つの要素にだけ一致するようにしてください。"""
+        """*   "html": その要素を置き換える、修正後の要素全体のhtmlコード（開始タグから終了タグまで）。"""
+        """*   "css": ヒーローセクションに追加するCSSルール。既存のCSSの末尾に追加されるため、上書きしたいルールも含めてください。"""
+        "*   CSSでは、background-imageのURLを'${imageBase64}'というプレースホルダーで指定してください。これは後で実際の画像に置き換えられます。"
+
+        + APPLY_IMAGE_NOTES
+    )
+    prompt = (
+        "**HTML**:"
+        f"{html_data}"
+        
+        "**CSS**:"
+        f"{css_data}"
+    )
+    response = await gemini(
+        "gemini-2.0-flash", system_instruction, prompt, {"response_mime_type": "application/json"},
+        timeout=STEP_TIMEOUTS.get("apply-image"),
+    )
+    try:
+        patch = safe_json_loads(response)
+    except Exception as e:
+        raise HtmlPatchError(f"差分のJSONを読み取れませんでした: {e}") from e
+    return apply_patch(html_data, css_data, patch, required_text=IMAGE_PLACEHOLDER)
 
-            "**出力**:"
-            """*   画像は'background-image: url(${imageBase64})'の形式で挿入されることを想定し、htmlコードとcssコードを修正してください。"""
-            "*   出力は、入力のコードを修正したhtmコード全文、cssコード全文としてください。"
-            "*   CSSでは、background-imageのURLを'${imageBase64}'というプレースホルダーで指定してください。これは後でJavaScriptによって実際の画像データに置き換えられます。"
-
-            "**注意点**:"
-            "*   変更はヒーローセクションに限定してください。他のセクションには手を加えないでください。"
-            "*   画像上のテキストの可読性に注意して、テキストに影を加えたり画像上に暗いオーバーレイを入れたりと、工夫してください。"
-            "*   画像のアスペクト比は16:9の想定です。コンテナーサイズは画像の高さに合わせて変更してください（800pxほど）。"
-        )
+## 修正後のHTML・CSS全文を出力させる
+async def apply_image_full(html_data, css_data):
+    system_instruction = (
+        "あなたは、HTMLとCSSに画像を適用するエージェントです。"
+        "あなたには、htmlコードとcssコードが与えられます。"
+
+        "**出力**:"
+        """*   画像は'background-image: url(${imageBase64})'の形式で挿入されることを想定し、htmlコードとcssコードを修正してください。"""
+        "*   出力は、入力のコードを修正したhtmコード全文、cssコード全文としてください。"
+        "*   CSSでは、background-imageのURLを'${imageBase64}'というプレースホルダーで指定してください。これは後でJavaScriptによって実際の画像データに置き換えられます。"
+
+        + APPLY_IMAGE_NOTES
     )
     prompt = (
         "**HTML**:"
@@ -352,43 +643,143 @@ def apply_image(html_data, css_data):
         "**CSS**:"
         f"{css_data}"
     )
-    response = model.generate_content(prompt)
+    response = await gemini("gemini-2.0-flash", system_instruction, prompt, timeout=STEP_TIMEOUTS.get("apply-image"))
 
     ## responseをhtmlコードとcssコードに分割
-    html_code = extract_code_blocks_by_type(response.text)[0]
-    css_code = extract_code_blocks_by_type(response.text)[1]
+    return extract_code_blocks_by_type(response)
+
+## 画像を適用するエージェント
+async def apply_image(html_data, css_data, output_dir="."):
+    print("\n===画像を適用するエージェント===")
+    print("【Geminiでコードを修正中です．．．】")
+
+    if APPLY_IMAGE_MODE == "patch":
+        try:
+            html_code, css_code = await apply_image_patch(html_data, css_data)
+        except HtmlPatchError as e:
+            print(f"差分を適用できなかったため、全文を出力させて適用します: {e}")
+            html_code, css_code = await apply_image_full(html_data, css_data)
+    elif APPLY_IMAGE_MODE == "full":
+        html_code, css_code = await apply_image_full(html_data, css_data)
+    else:
+        raise ValueError(f"APPLY_IMAGE_MODE の値が不正です: {APPLY_IMAGE_MODE}")
+
+    ## 画像が生成できていればプレースホルダーをファイル名に置き換え、派生ファイルを画面幅に応じて使い分ける
+    image_path = os.path.join(output_dir, HERO_IMAGE_NAME)
+    if os.path.exists(image_path):
+        variants = find_variants(image_path)
+        css_code = css_code.replace(IMAGE_PLACEHOLDER, HERO_IMAGE_NAME)
+        css_code = apply_responsive_css(css_code, HERO_IMAGE_NAME, variants)
+        html_code = apply_responsive_html(html_code, HERO_IMAGE_NAME, variants)
 
     ## ファイル保存
-    save_to_file(html_code, "index.html")
-    save_to_file(css_code, "style.css")
+    save_to_file(html_code, os.path.join(output_dir, "index.html"))
+    save_to_file(css_code, os.path.join(output_dir, "style.css"))
 
     return html_code, css_code
 
 
 ######################################
-## メイン
+## パイプライン定義
 ######################################
 
-def main(section_idea):
-    ## ワイヤーフレーム作成エージェントに接続
-    html_data = wireframe_generate_agent(section_idea)
+## LP生成の各ステップと依存関係
+## 画像生成はワイヤーフレームのみに依存するため、CSS/JS生成と並行して実行される
+## 画像適用はCSSと画像の両方が揃った時点で開始する
+## on_progress(ステップID, これまでの出力, 出力トークン数) でストリーミング中の途中経過を受け取れる
+## on_usage(ステップID, 使用量) でClaudeのトークン使用量（キャッシュの書き込み・読み込みを含む）を受け取れる
+def build_lp_pipeline(section_idea, output_dir=".", on_progress=None, on_usage=None):
+    def step_progress(step_id):
+        if on_progress is None:
+            return None
+        return lambda text, output_tokens: on_progress(step_id, text, output_tokens)
+
+    def step_usage(step_id):
+        if on_usage is None:
+            return None
+        return lambda usage: on_usage(step_id, usage)
+
+    return [
+        PipelineStep(
+            id="wireframe",
+            run=lambda r: wireframe_generate_agent(
+                section_idea, output_dir, step_progress("wireframe"), step_usage("wireframe")
+            ),
+        ),
+        PipelineStep(
+            id="css",
+            run=lambda r: design_css_agent(
+                r["wireframe"], output_dir, step_progress("css"), step_usage("css")
+            ),
+            depends_on=["wireframe"],
+        ),
+        PipelineStep(
+            id="js",
+            run=lambda r: design_js_agent(
+                r["wireframe"], r["css"], output_dir, step_progress("js"), step_usage("js")
+            ),
+            depends_on=["wireframe", "css"],
+        ),
+        PipelineStep(
+            id="image",
+            run=lambda r: image_generate_agent(r["wireframe"], output_dir),
+            depends_on=["wireframe"],
+        ),
+        PipelineStep(
+            id="apply-image",
+            run=lambda r: apply_image(r["wireframe"], r["css"], output_dir),
+            depends_on=["css", "image"],
+        ),
+    ]
+
+
+## 保存済みのステップ出力から output_dir のファイルを復元し、output_dir 向けの出力を返す
+## 画像は source_dir（出力を保存したジョブの作業ディレクトリ）からコピーする
+## 後のステップが前のステップのファイルを上書きするため、パイプラインの定義順に呼び出すこと
+def restore_step_outputs(step_id, result, output_dir=".", source_dir="."):
+    if step_id == "wireframe":
+        save_to_file(result, os.path.join(output_dir, "index.html"))
+    elif step_id == "css":
+        save_to_file(result, os.path.join(output_dir, "style.css"))
+    elif step_id == "js":
+        save_to_file(result, os.path.join(output_dir, "script.js"))
+    elif step_id == "image":
+        restored = []
+        for path in result:
+            name = os.path.basename(path)
+            source_path = os.path.join(source_dir, name)
+            target_path = os.path.abspath(os.path.join(output_dir, name))
+            if os.path.abspath(source_path) != target_path:
+                ## 派生画像も合わせてコピーする（元画像が無ければ OSError）
+                names = [name] + [v["name"] for v in find_variants(source_path)]
+                for file_name in names:
+                    shutil.copy2(os.path.join(source_dir, file_name), os.path.join(output_dir, file_name))
+            restored.append(target_path)
+        return restored
+    elif step_id == "apply-image":
+        html_code, css_code = result
+        save_to_file(html_code, os.path.join(output_dir, "index.html"))
+        save_to_file(css_code, os.path.join(output_dir, "style.css"))
+        return html_code, css_code
+    return result
 
-    ## デザインエージェントに接続（CSS）
-    css_data = design_css_agent(html_data)
 
-    ## デザインエージェントに接続（JS）
-    design_js_agent(html_data, css_data)
-
-    ## 画像生成エージェントに接続
-    generated_images = image_generate_agent(html_data)
-    print(f"生成された画像: {generated_images}")
+######################################
+## メイン
+######################################
 
-    ## 画像適用エージェントに接続
-    apply_image(html_data, css_data)
+async def main(section_idea):
+    ## 依存関係に従って各エージェントを実行
+    results = await run_pipeline(
+        build_lp_pipeline(section_idea),
+        on_start=lambda step_id: print(f"【開始】{step_id}"),
+        on_complete=lambda step_id, _: print(f"【完了】{step_id}"),
+    )
+    print(f"生成された画像: {results['image']}")
 
-    ## rayを使用している場合は終了
-    if ray.is_initialized():
-        ray.shutdown()
+    ## 画像生成ワーカーと派生画像のプロセスプールを終了
+    await shutdown_image_executor()
+    shutdown_variant_pool()
 
     print("\n【完了しました！　動作を終了します。】")
 
@@ -407,4 +798,4 @@ if __name__ == "__main__":
 
 ⑥：株式会社アブソリュート"""
 
-    main(section_idea)
\ No newline at end of file
+    asyncio.run(main(section_idea))
\ No newline at end of file
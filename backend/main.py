@@ -1,27 +1,53 @@
 import os
+import re
+import json
 import asyncio
+import hashlib
+import unicodedata
 import uuid
-import json
 import time
-import base64
-from datetime import datetime
+import shutil
+import mimetypes
+from email.utils import formatdate, parsedate_to_datetime
+from contextlib import asynccontextmanager
+from datetime import datetime, timedelta
 from typing import Dict, List, Optional, Any
-from fastapi import FastAPI, HTTPException, BackgroundTasks
+from fastapi import FastAPI, HTTPException, Query, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse, FileResponse
+from fastapi.responses import JSONResponse, FileResponse, StreamingResponse, Response
 from pydantic import BaseModel
-import shutil
+from prometheus_client import CONTENT_TYPE_LATEST, generate_latest
 
 # もとのPythonスクリプトから関数をインポート
-from lp_generator import (
-    wireframe_generate_agent,
-    design_css_agent,
-    design_js_agent,
-    image_generate_agent,
-    apply_image
-)
+from lp_generator import build_lp_pipeline, restore_step_outputs, response_cache, HERO_IMAGE_NAME
+from llm_cache import without_response_cache
+from scheduler import PipelineStep, run_pipeline, reusable_results
+from job_queue import QueueFullError, create_job_queue
+from job_store import open_job_store
+from job_events import JobEventBroker, TERMINAL_STATUSES, format_sse
+from archive import batch_archive_key, create_archive_cache
+from retention import create_retention_manager
+from build_output import BUILD_FILES, PRECOMPRESSED_EXTENSIONS, build_outputs, select_precompressed
+from image_worker import start_image_executor, shutdown_image_executor
+from image_variants import find_variants, start_variant_pool, shutdown_variant_pool
+import metrics
 
-app = FastAPI(title="LP Generator API")
+# アプリの起動・終了時にジョブキューと画像生成のワーカーを開始・停止する
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # 画像生成ワーカーはリクエスト中ではなく起動時に用意しておく
+    await start_image_executor()
+    start_variant_pool()
+    job_queue.start()
+    resume_interrupted_jobs()
+    retention.start()
+    yield
+    await retention.stop()
+    await job_queue.stop()
+    await shutdown_image_executor()
+    shutdown_variant_pool()
+
+app = FastAPI(title="LP Generator API", lifespan=lifespan)
 
 # CORS設定
 app.add_middleware(
@@ -41,12 +67,34 @@ class LPGenerationRequest(BaseModel):
     testimonials: str
     companyName: str
 
+# 複数のLPをまとめて生成するリクエスト
+class LPBatchRequest(BaseModel):
+    items: List[LPGenerationRequest]
+    name: Optional[str] = None
+
 class GenerationStep(BaseModel):
     id: str
     name: str
     description: str
     status: str
     progress: float
+    # ストリーミング中の出力量（トークン数・文字数）
+    outputTokens: int = 0
+    outputChars: int = 0
+    # Claudeの入力トークン数と、プロンプトキャッシュへの書き込み・読み込みトークン数
+    inputTokens: int = 0
+    cacheCreationInputTokens: int = 0
+    cacheReadInputTokens: int = 0
+    # 以前のジョブの出力を再利用して実行を省略した場合は True
+    reused: bool = False
+    # ステップの開始・完了日時（ISO形式）
+    startedAt: Optional[str] = None
+    completedAt: Optional[str] = None
+    # 計測値：所要時間、レート制限による待ち時間、再試行回数、出力したファイルのバイト数（種類ごと）
+    wallSeconds: Optional[float] = None
+    queueWaitSeconds: float = 0
+    retries: int = 0
+    outputBytes: Dict[str, int] = {}
 
 class JobStatus(BaseModel):
     jobId: str
@@ -56,12 +104,97 @@ class JobStatus(BaseModel):
     steps: List[GenerationStep]
     error: Optional[str] = None
     result: Optional[Dict[str, Any]] = None
+    queuePosition: Optional[int] = None
+    estimatedWaitSeconds: Optional[float] = None
 
-# ジョブの状態を保存する辞書
-jobs = {}
+# 生成ステップの初期状態
+def create_initial_steps() -> List[GenerationStep]:
+    return [
+        GenerationStep(
+            id="wireframe",
+            name="ワイヤーフレーム作成",
+            description="HTML構造の生成",
+            status="pending",
+            progress=0,
+        ),
+        GenerationStep(
+            id="css",
+            name="デザイン適用",
+            description="CSSスタイルの生成",
+            status="pending",
+            progress=0,
+        ),
+        GenerationStep(
+            id="js",
+            name="インタラクション追加",
+            description="JavaScript機能の実装",
+            status="pending",
+            progress=0,
+        ),
+        GenerationStep(
+            id="image",
+            name="画像生成",
+            description="AIによる画像の生成",
+            status="pending",
+            progress=0,
+        ),
+        GenerationStep(
+            id="apply-image",
+            name="画像適用",
+            description="生成された画像の適用",
+            status="pending",
+            progress=0,
+        ),
+    ]
 
 # ジョブディレクトリの準備
-os.makedirs("jobs", exist_ok=True)
+JOBS_DIR = os.path.abspath("jobs")
+os.makedirs(JOBS_DIR, exist_ok=True)
+
+# ジョブの状態を保存するストア（再起動後も保持される）
+job_store = open_job_store(JOBS_DIR)
+
+# 進捗をSSEで配信するためのブローカー
+job_events = JobEventBroker()
+
+# SSEのキープアライブ間隔（秒）
+SSE_KEEPALIVE_SECONDS = 15
+
+# 1件のジョブの処理開始からの制限時間（秒）。0 で無制限
+JOB_DEADLINE_SECONDS = float(os.environ.get("JOB_DEADLINE_SECONDS", 1800)) or None
+
+# ジョブごとの作業ディレクトリ（プロセス全体のカレントディレクトリは変更しない）
+def get_job_dir(job_id: str) -> str:
+    return os.path.join(JOBS_DIR, job_id)
+
+# アセット配信で扱うファイルの拡張子
+ASSET_EXTENSIONS = {".html", ".css", ".js", ".jpg", ".jpeg", ".png", ".webp", ".avif"}
+# zipには事前圧縮したファイル（.gz / .br）も含め、そのまま静的配信に使えるようにする
+ARCHIVE_EXTENSIONS = ASSET_EXTENSIONS | set(PRECOMPRESSED_EXTENSIONS.values())
+
+# アセットのURL
+def get_asset_url(job_id: str, name: str) -> str:
+    return f"/api/jobs/{job_id}/assets/{name}"
+
+# 最近ダウンロードされたzipのキャッシュ
+archive_cache = create_archive_cache()
+
+# 終了したジョブの生成物を保持期間・容量の上限に従って削除する（概要は残る）
+retention = create_retention_manager(job_store, JOBS_DIR, archive_cache)
+
+# 保持期間を過ぎて生成物が削除されたジョブ
+def purged_error() -> HTTPException:
+    return HTTPException(status_code=410, detail="Job outputs have expired")
+
+# ダウンロード用zipに含めるファイル（zip内のパス, 実ファイルのパス）
+def get_archive_files(job_id: str) -> List[tuple]:
+    job_dir = get_job_dir(job_id)
+    files = []
+    for name in sorted(os.listdir(job_dir)):
+        path = os.path.join(job_dir, name)
+        if os.path.isfile(path) and os.path.splitext(name)[1].lower() in ARCHIVE_EXTENSIONS:
+            files.append((name, path))
+    return files
 
 # セクションアイデアをフォーマットする関数
 def format_section_idea(data: LPGenerationRequest) -> str:
@@ -77,174 +210,250 @@ def format_section_idea(data: LPGenerationRequest) -> str:
 
 ⑥：{data.companyName}"""
 
+# 同じ入力のリクエストは、待機中・実行中のジョブにまとめる
+# REQUEST_COALESCE_WINDOW_SECONDS を指定すると、その秒数以内に完了したジョブも再利用する（既定は 0 で再利用しない）
+# 同じ入力で別のLPを作り直したい場合に古い結果が返らないよう、完了済みジョブの再利用は明示的に有効にしたときだけ行う
+REQUEST_COALESCE_WINDOW_SECONDS = float(os.environ.get("REQUEST_COALESCE_WINDOW_SECONDS", 0))
+
+# 重複したリクエストをまとめるための入力のハッシュ
+# 全角・半角（NFKC）や前後・連続する空白の違いは同じ入力として扱う
+def request_hash(data: LPGenerationRequest) -> str:
+    normalized = {
+        key: re.sub(r"\s+", " ", unicodedata.normalize("NFKC", value)).strip()
+        for key, value in data.dict().items()
+    }
+    encoded = json.dumps(normalized, ensure_ascii=False, sort_keys=True).encode("utf-8")
+    return hashlib.sha256(encoded).hexdigest()
+
+# 同じ入力で実行中のジョブ、または直近に完了したジョブのID
+def find_coalescable_job(input_hash: str) -> Optional[str]:
+    completed_after = None
+    if REQUEST_COALESCE_WINDOW_SECONDS > 0:
+        completed_after = (datetime.now() - timedelta(seconds=REQUEST_COALESCE_WINDOW_SECONDS)).isoformat()
+    return job_store.find_coalescable_job(input_hash, ["pending", "processing"], completed_after)
+
 # ジョブの状態を更新する関数
 def update_job_status(job_id: str, status: str, progress: float, current_step: str, 
                       steps: List[GenerationStep], error: Optional[str] = None, 
                       result: Optional[Dict[str, Any]] = None):
-    if job_id in jobs:
-        jobs[job_id].update({
-            "status": status,
-            "progress": progress,
-            "currentStep": current_step,
-            "steps": [step.dict() for step in steps],
-        })
-        
-        if error:
-            jobs[job_id]["error"] = error
-            
-        if result:
-            jobs[job_id]["result"] = result
-            
-        # ジョブ状態をファイルに保存
-        job_dir = f"jobs/{job_id}"
-        os.makedirs(job_dir, exist_ok=True)
-        
-        with open(f"{job_dir}/status.json", "w") as f:
-            json.dump(jobs[job_id], f)
+    # 小さな状態行のみを更新する（結果がある場合は同じトランザクションで保存）
+    job_store.update_status(
+        job_id,
+        status,
+        progress,
+        current_step,
+        [step.dict() for step in steps],
+        error=error,
+        result=result,
+    )
+    
+    # 購読中のクライアントへ変化分のみを配信（result は送らない）
+    state = {
+        "status": status,
+        "progress": progress,
+        "currentStep": current_step,
+        "steps": [step.dict() for step in steps],
+    }
+    if error:
+        state["error"] = error
+    job_events.publish_status(job_id, state)
 
 # バックグラウンドでLPを生成する関数
+# 保存済みのステップ出力のうち再利用できるものを作業ディレクトリに復元する
+# ファイルが失われていて復元できないステップがあれば、それと下流のステップは作り直す
+def restore_checkpoints(
+    pipeline: List[PipelineStep],
+    saved: Dict[str, Any],
+    invalidate: List[str],
+    job_dir: str,
+    source_dir: str,
+) -> Dict[str, Any]:
+    invalidate = list(invalidate)
+    while True:
+        reusable = reusable_results(pipeline, saved, invalidate)
+        restored: Dict[str, Any] = {}
+        try:
+            for step in pipeline:
+                if step.id in reusable:
+                    restored[step.id] = restore_step_outputs(step.id, reusable[step.id], job_dir, source_dir)
+            return restored
+        except OSError as e:
+            print(f"Checkpoint for step {step.id} could not be restored: {e}")
+            invalidate.append(step.id)
+
+# キャンセル・制限時間切れで中止したジョブの作業ディレクトリとダウンロード用のキャッシュを削除する
+async def discard_job_workspace(job_id: str):
+    await asyncio.to_thread(shutil.rmtree, get_job_dir(job_id), ignore_errors=True)
+    archive_cache.discard(job_id)
+
 async def generate_lp_background(job_id: str, data: LPGenerationRequest):
+    # ジョブディレクトリを作成（各エージェントにはこのパスを明示的に渡す）
+    job_dir = get_job_dir(job_id)
+    os.makedirs(job_dir, exist_ok=True)
+    
+    # 初期ステップの設定
+    steps = create_initial_steps()
+    
+    # ジョブ全体の制限時間。超えたら実行中のステップ（プロバイダへの要求を含む）ごと中止する
+    deadline = asyncio.timeout(JOB_DEADLINE_SECONDS)
+    
     try:
-        # ジョブディレクトリを作成
-        job_dir = f"jobs/{job_id}"
-        os.makedirs(job_dir, exist_ok=True)
-        os.chdir(job_dir)
-        
-        # 初期ステップの設定
-        steps = [
-            GenerationStep(
-                id="wireframe",
-                name="ワイヤーフレーム作成",
-                description="HTML構造の生成",
-                status="pending",
-                progress=0,
-            ),
-            GenerationStep(
-                id="css",
-                name="デザイン適用",
-                description="CSSスタイルの生成",
-                status="pending",
-                progress=0,
-            ),
-            GenerationStep(
-                id="js",
-                name="インタラクション追加",
-                description="JavaScript機能の実装",
-                status="pending",
-                progress=0,
-            ),
-            GenerationStep(
-                id="image",
-                name="画像生成",
-                description="AIによる画像の生成",
-                status="pending",
-                progress=0,
-            ),
-            GenerationStep(
-                id="apply-image",
-                name="画像適用",
-                description="生成された画像の適用",
-                status="pending",
-                progress=0,
-            ),
-        ]
-        
-        # セクションアイデアをフォーマット
-        section_idea = format_section_idea(data)
-        
-        # 1. ワイヤーフレーム作成
-        steps[0].status = "processing"
-        update_job_status(job_id, "processing", 10, "wireframe", steps)
-        
-        html_data = wireframe_generate_agent(section_idea)
-        
-        steps[0].status = "completed"
-        steps[0].progress = 100
-        steps[1].status = "processing"
-        update_job_status(job_id, "processing", 30, "css", steps)
-        
-        # 2. デザイン適用（CSS）
-        css_data = design_css_agent(html_data)
-        
-        steps[1].status = "completed"
-        steps[1].progress = 100
-        steps[2].status = "processing"
-        update_job_status(job_id, "processing", 50, "js", steps)
-        
-        # 3. デザイン適用（JS）
-        js_data = design_js_agent(html_data, css_data)
-        
-        steps[2].status = "completed"
-        steps[2].progress = 100
-        steps[3].status = "processing"
-        update_job_status(job_id, "processing", 70, "image", steps)
-        
-        # 4. 画像生成
-        image_generate_agent(html_data)
-        
-        steps[3].status = "completed"
-        steps[3].progress = 100
-        steps[4].status = "processing"
-        update_job_status(job_id, "processing", 90, "apply-image", steps)
-        
-        # 5. 画像適用
-        final_html_data, final_css_data = apply_image(html_data, css_data)
-        
-        steps[4].status = "completed"
-        steps[4].progress = 100
-        
-        # ファイルを読み取り、結果を準備
-        with open("index.html", "r", encoding="utf-8") as f:
-            final_html = f.read()
+        async with deadline:
+            # セクションアイデアをフォーマット
+            section_idea = format_section_idea(data)
             
-        with open("style.css", "r", encoding="utf-8") as f:
-            final_css = f.read()
+            steps_by_id = {step.id: step for step in steps}
             
-        with open("script.js", "r", encoding="utf-8") as f:
-            final_js = f.read()
+            # 依存関係の解決したステップから並行に実行されるため、
+            # 進捗は完了ステップ数、currentStep は実行中のステップIDで表す
+            def report_progress():
+                completed = sum(1 for step in steps if step.status == "completed")
+                running = [step.id for step in steps if step.status == "processing"]
+                update_job_status(
+                    job_id, "processing", completed / len(steps) * 100,
+                    ",".join(running), steps,
+                )
             
-        # 画像をBase64エンコード
-        image_base64 = ""
-        try:
-            with open("placeholder_css_1.jpg", "rb") as image_file:
-                image_base64 = base64.b64encode(image_file.read()).decode('utf-8')
-        except Exception as e:
-            print(f"画像エンコード中にエラー: {e}")
+            def on_step_start(step_id: str):
+                steps_by_id[step_id].status = "processing"
+                steps_by_id[step_id].startedAt = datetime.now().isoformat()
+                report_progress()
             
-        # 結果を作成
-        result = {
-            "jobId": job_id,
-            "html": final_html,
-            "css": final_css,
-            "js": final_js,
-            "imageBase64": f"data:image/jpeg;base64,{image_base64}" if image_base64 else "",
-            "createdAt": datetime.now().isoformat(),
-        }
-        
-        # 圧縮用ディレクトリを準備
-        zip_dir = f"../zip-{job_id}"
-        os.makedirs(zip_dir, exist_ok=True)
-        
-        # 結果ファイルをコピー
-        shutil.copy("index.html", f"{zip_dir}/index.html")
-        shutil.copy("style.css", f"{zip_dir}/style.css")
-        shutil.copy("script.js", f"{zip_dir}/script.js")
-        
-        # 画像ファイルがあればコピー
-        if os.path.exists("placeholder_css_1.jpg"):
-            shutil.copy("placeholder_css_1.jpg", f"{zip_dir}/placeholder_css_1.jpg")
-        
-        # ファイルを圧縮
-        shutil.make_archive(f"../download-{job_id}", "zip", zip_dir)
-        
-        # 一時ディレクトリを削除
-        shutil.rmtree(zip_dir)
-        
-        # 状態を完了に更新
-        update_job_status(job_id, "completed", 100, "completed", steps, result=result)
+            def on_step_complete(step_id: str, result: Any):
+                # 再実行・再起動時に使えるよう、完了したステップの出力を保存する
+                job_store.save_checkpoint(job_id, step_id, result)
+                steps_by_id[step_id].status = "completed"
+                steps_by_id[step_id].progress = 100
+                steps_by_id[step_id].completedAt = datetime.now().isoformat()
+                report_progress()
+            
+            # ストリーミング中の途中経過：出力量を状態に反映し、増えた分のテキストだけをSSEで配信する
+            sent_chars: Dict[str, int] = {}
+            def on_step_progress(step_id: str, text: str, output_tokens: int):
+                step = steps_by_id[step_id]
+                step.outputTokens = output_tokens
+                step.outputChars = len(text)
+                offset = sent_chars.get(step_id, 0)
+                # 再試行で最初から生成し直した場合は先頭から送り直す
+                if len(text) < offset:
+                    offset = 0
+                if len(text) > offset:
+                    job_events.publish(job_id, "partial", {
+                        "stepId": step_id,
+                        "offset": offset,
+                        "text": text[offset:],
+                    })
+                    sent_chars[step_id] = len(text)
+                report_progress()
+            
+            # 応答完了時のトークン使用量（プロンプトキャッシュの効果を含む）を記録する
+            def on_step_usage(step_id: str, usage: Dict[str, int]):
+                step = steps_by_id[step_id]
+                step.inputTokens = usage["inputTokens"]
+                step.outputTokens = usage["outputTokens"]
+                step.cacheCreationInputTokens = usage["cacheCreationInputTokens"]
+                step.cacheReadInputTokens = usage["cacheReadInputTokens"]
+                report_progress()
+            
+            # ステップ終了時の計測値を記録する（Geminiのトークン数もここで反映される）
+            def on_step_metrics(step_metrics: metrics.StepMetrics):
+                step = steps_by_id[step_metrics.step_id]
+                step.wallSeconds = round(step_metrics.wall_seconds, 3)
+                step.queueWaitSeconds = round(step_metrics.queue_wait_seconds, 3)
+                step.retries = step_metrics.retries
+                step.outputBytes = dict(step_metrics.output_bytes)
+                if step_metrics.input_tokens or step_metrics.output_tokens:
+                    step.inputTokens = step_metrics.input_tokens
+                    step.outputTokens = step_metrics.output_tokens
+            
+            pipeline = build_lp_pipeline(section_idea, job_dir, on_step_progress, on_step_usage)
+            
+            # 完了済みのステップの出力を再利用する
+            # 再起動で中断されたジョブは自身の出力、再実行・部分再生成のジョブは元のジョブの出力を使う
+            job = job_store.get_job(job_id, include_result=False) or {}
+            if job.get("createdAt"):
+                queue_wait = datetime.now() - datetime.fromisoformat(job["createdAt"])
+                metrics.JOB_QUEUE_WAIT.observe(max(0.0, queue_wait.total_seconds()))
+            saved = job_store.get_checkpoints(job_id)
+            source_dir = job_dir
+            invalidate: List[str] = []
+            if not saved and job.get("retryOf"):
+                saved = job_store.get_checkpoints(job["retryOf"])
+                source_dir = get_job_dir(job["retryOf"])
+            regenerate_step = job.get("regenerateStep")
+            if regenerate_step and regenerate_step not in job_store.get_checkpoints(job_id):
+                invalidate.append(regenerate_step)
+                # 作り直すステップでは、キャッシュ済みの同じ応答を返さないようにする
+                for step in pipeline:
+                    if step.id == regenerate_step:
+                        step.run = without_response_cache(step.run)
+            for step in pipeline:
+                step.run = metrics.instrument_step(step.id, step.run, on_step_metrics)
+            
+            precomputed = restore_checkpoints(pipeline, saved, invalidate, job_dir, source_dir)
+            for step_id, result in precomputed.items():
+                if source_dir != job_dir:
+                    job_store.save_checkpoint(job_id, step_id, result)
+                steps_by_id[step_id].status = "completed"
+                steps_by_id[step_id].progress = 100
+                steps_by_id[step_id].completedAt = datetime.now().isoformat()
+                steps_by_id[step_id].reused = True
+            if precomputed:
+                report_progress()
+            
+            # ワイヤーフレーム → (CSS → JS) / 画像生成 → 画像適用 の順に依存関係を解決して実行
+            await run_pipeline(
+                pipeline,
+                on_start=on_step_start,
+                on_complete=on_step_complete,
+                precomputed=precomputed,
+            )
+            
+            # ミニファイと配信用の事前圧縮（BUILD_MINIFY / BUILD_PRECOMPRESS）
+            await asyncio.to_thread(build_outputs, job_dir)
+            
+            # ファイルを読み取り、結果を準備
+            with open(os.path.join(job_dir, "index.html"), "r", encoding="utf-8") as f:
+                final_html = f.read()
+                
+            with open(os.path.join(job_dir, "style.css"), "r", encoding="utf-8") as f:
+                final_css = f.read()
+                
+            with open(os.path.join(job_dir, "script.js"), "r", encoding="utf-8") as f:
+                final_js = f.read()
+                
+            # 画像はBase64で埋め込まず、CSSからはファイル名で、APIからはURLで参照する
+            # （プレースホルダーの置き換えと派生画像の組み込みは画像適用ステップで済んでいる）
+            image_urls = []
+            image_variants = []
+            hero_image_path = os.path.join(job_dir, HERO_IMAGE_NAME)
+            if os.path.exists(hero_image_path):
+                image_urls.append(get_asset_url(job_id, HERO_IMAGE_NAME))
+                image_variants = [
+                    {"url": get_asset_url(job_id, v["name"]), "width": v["width"], "format": v["format"]}
+                    for v in find_variants(hero_image_path)
+                ]
+                
+            # 結果を作成
+            result = {
+                "jobId": job_id,
+                "html": final_html,
+                "css": final_css,
+                "js": final_js,
+                "imageUrls": image_urls,
+                "imageVariants": image_variants,
+                "createdAt": datetime.now().isoformat(),
+            }
+            
+            # 状態を完了に更新
+            update_job_status(job_id, "completed", 100, "completed", steps, result=result)
+            metrics.JOBS.labels("completed").inc()
         
     except Exception as e:
-        print(f"Error in job {job_id}: {str(e)}")
+        error = str(e) or type(e).__name__
+        if deadline.expired():
+            error = f"制限時間（{JOB_DEADLINE_SECONDS:.0f}秒）を超えたため中止しました"
+        print(f"Error in job {job_id}: {error}")
         
         # エラー状態を更新
         steps_with_error = []
@@ -253,97 +462,306 @@ async def generate_lp_background(job_id: str, data: LPGenerationRequest):
                 step.status = "error"
             steps_with_error.append(step)
             
-        update_job_status(job_id, "error", 0, "", steps_with_error, error=str(e))
+        update_job_status(job_id, "error", 0, "", steps_with_error, error=error)
+        metrics.JOBS.labels("error").inc()
         
-    finally:
-        # 作業ディレクトリを元に戻す
-        os.chdir("../..")
+        # 制限時間切れはキャンセルと同様に作業ディレクトリを削除する
+        if deadline.expired():
+            await discard_job_workspace(job_id)
 
 # エンドポイント
+# ジョブキュー（同時実行数と待ち行列の長さを制限する）
+job_queue = create_job_queue(generate_lp_background)
+
+# 1回のバッチで受け付ける最大件数
+BATCH_MAX_ITEMS = int(os.environ.get("BATCH_MAX_ITEMS", 50))
+
+def queue_full_error() -> HTTPException:
+    return HTTPException(
+        status_code=503,
+        detail="ジョブキューが満杯です。しばらくしてから再度お試しください。",
+        headers={"Retry-After": str(int(job_queue.average_job_seconds))},
+    )
+
+# キューへ投入する（満杯なら503を返す）
+# バッチのジョブは group にバッチIDを指定し、バッチ間・単発ジョブとの間で公平に実行させる
+def enqueue_job(job_id: str, data: LPGenerationRequest, group: Optional[str] = None):
+    try:
+        job_queue.submit(job_id, data, group=group)
+    except QueueFullError:
+        raise queue_full_error()
+
+# 再起動で中断されたジョブ（待機中・処理中）を最初からキューに入れ直す
+def resume_interrupted_jobs():
+    for job in job_store.find_jobs_by_status(["pending", "processing"]):
+        job_id = job["jobId"]
+        steps = create_initial_steps()
+        if "originalData" not in job:
+            update_job_status(job_id, "error", 0, "", steps, error="再起動により中断されました")
+            continue
+        try:
+            job_queue.submit(
+                job_id, LPGenerationRequest(**job["originalData"]), group=job.get("batchId")
+            )
+        except QueueFullError:
+            update_job_status(job_id, "error", 0, "", steps, error="再起動により中断されました")
+            continue
+        update_job_status(job_id, "pending", 0, "", steps)
+
 @app.post("/api/generate")
-async def generate_lp(data: LPGenerationRequest, background_tasks: BackgroundTasks):
+async def generate_lp(
+    data: LPGenerationRequest,
+    coalesce: bool = Query(
+        True,
+        description=(
+            "同じ入力の待機中・実行中のジョブ（REQUEST_COALESCE_WINDOW_SECONDS を指定した場合は直近に完了したジョブも）"
+            "があれば、新しく生成せずそのジョブを返す。false で常に新しいジョブを作成する"
+        ),
+    ),
+):
+    # ダブルクリックやクライアントの再送による重複は、既存のジョブにまとめる
+    # （検索から登録までの間に await が無いため、同時に届いた重複も1件にまとまる）
+    input_hash = request_hash(data)
+    if coalesce:
+        existing_job_id = find_coalescable_job(input_hash)
+        if existing_job_id is not None:
+            existing_job = job_store.get_job(existing_job_id, include_result=False)
+            metrics.COALESCED_REQUESTS.labels(existing_job["status"]).inc()
+            return {"jobId": existing_job_id, "coalesced": True}
+    
     job_id = str(uuid.uuid4())
     
+    # キューに投入（満杯の場合はジョブを登録しない）
+    # ワーカーが動き出すのは次の await 以降なので、この後の登録が先に完了する
+    enqueue_job(job_id, data)
+    
     # 初期ステップの設定
-    steps = [
-        GenerationStep(
-            id="wireframe",
-            name="ワイヤーフレーム作成",
-            description="HTML構造の生成",
-            status="pending",
-            progress=0,
-        ),
-        GenerationStep(
-            id="css",
-            name="デザイン適用",
-            description="CSSスタイルの生成",
-            status="pending",
-            progress=0,
-        ),
-        GenerationStep(
-            id="js",
-            name="インタラクション追加",
-            description="JavaScript機能の実装",
-            status="pending",
-            progress=0,
-        ),
-        GenerationStep(
-            id="image",
-            name="画像生成",
-            description="AIによる画像の生成",
-            status="pending",
-            progress=0,
-        ),
-        GenerationStep(
-            id="apply-image",
-            name="画像適用",
-            description="生成された画像の適用",
-            status="pending",
-            progress=0,
-        ),
-    ]
+    steps = create_initial_steps()
     
-    # ジョブ初期化
-    jobs[job_id] = {
+    # ジョブ初期化（再実行・再起動時の再開に使うため入力データも保存する）
+    job_store.create_job({
         "jobId": job_id,
         "status": "pending",
         "progress": 0,
         "currentStep": "",
         "steps": [step.dict() for step in steps],
         "createdAt": datetime.now().isoformat(),
+        "originalData": data.dict(),
+        "requestHash": input_hash,
+    })
+    
+    return {"jobId": job_id, "coalesced": False}
+
+@app.post("/api/generate/batch")
+async def generate_lp_batch(data: LPBatchRequest):
+    if not data.items:
+        raise HTTPException(status_code=400, detail="items must not be empty")
+    if len(data.items) > BATCH_MAX_ITEMS:
+        raise HTTPException(status_code=400, detail=f"Too many items (max {BATCH_MAX_ITEMS})")
+    
+    batch_id = str(uuid.uuid4())
+    jobs = [(str(uuid.uuid4()), item) for item in data.items]
+    
+    # 全件まとめてキューに投入（入りきらない場合は1件も登録しない）
+    try:
+        job_queue.submit_many([(job_id, (item,)) for job_id, item in jobs], group=batch_id)
+    except QueueFullError:
+        raise queue_full_error()
+    
+    job_store.create_batch(batch_id, data.name, [
+        {
+            "jobId": job_id,
+            "status": "pending",
+            "progress": 0,
+            "currentStep": "",
+            "steps": [step.dict() for step in create_initial_steps()],
+            "createdAt": datetime.now().isoformat(),
+            "originalData": item.dict(),
+        }
+        for job_id, item in jobs
+    ])
+    
+    return {"batchId": batch_id, "jobIds": [job_id for job_id, _ in jobs]}
+
+# バッチ全体の状態（全ジョブが終了していれば completed、1件でも失敗・キャンセルがあれば partial/error）
+def summarize_batch_status(counts: Dict[str, int], total: int) -> str:
+    finished = sum(counts.get(status, 0) for status in TERMINAL_STATUSES)
+    if finished < total:
+        return "pending" if counts.get("pending", 0) == total else "processing"
+    if counts.get("completed", 0) == total:
+        return "completed"
+    if counts.get("cancelled", 0) == total:
+        return "cancelled"
+    if counts.get("completed", 0) == 0:
+        return "error"
+    return "partial"
+
+@app.get("/api/batches/{batch_id}")
+async def get_batch_status(batch_id: str):
+    batch = job_store.get_batch(batch_id)
+    if batch is None:
+        raise HTTPException(status_code=404, detail="Batch not found")
+    
+    jobs = batch["jobs"]
+    counts: Dict[str, int] = {}
+    for job in jobs:
+        counts[job["status"]] = counts.get(job["status"], 0) + 1
+    
+    return {
+        "batchId": batch["batchId"],
+        "name": batch["name"],
+        "createdAt": batch["createdAt"],
+        "status": summarize_batch_status(counts, len(jobs)),
+        "progress": sum(job["progress"] for job in jobs) / len(jobs) if jobs else 0,
+        "total": len(jobs),
+        "counts": counts,
+        "jobs": [
+            {
+                "jobId": job["jobId"],
+                "serviceName": job.get("originalData", {}).get("serviceName"),
+                "status": job["status"],
+                "progress": job["progress"],
+                "currentStep": job["currentStep"],
+                "error": job.get("error"),
+                "queuePosition": job_queue.position(job["jobId"]),
+            }
+            for job in jobs
+        ],
     }
+
+@app.get("/api/batches/{batch_id}/download")
+async def download_batch(batch_id: str):
+    batch = job_store.get_batch(batch_id)
+    if batch is None:
+        raise HTTPException(status_code=404, detail="Batch not found")
     
-    # バックグラウンドタスク開始
-    background_tasks.add_task(generate_lp_background, job_id, data)
+    # 完了したジョブの生成物を、ジョブごとのフォルダに分けて1つのzipにまとめる
+    files = []
+    for index, job in enumerate(batch["jobs"], start=1):
+        if job["status"] != "completed" or not os.path.isdir(get_job_dir(job["jobId"])):
+            continue
+        prefix = f"{index:03d}-{job['jobId']}"
+        files.extend((f"{prefix}/{arcname}", path) for arcname, path in get_archive_files(job["jobId"]))
+    if not files:
+        raise HTTPException(status_code=400, detail="No completed jobs in this batch")
     
-    return {"jobId": job_id}
+    return StreamingResponse(
+        archive_cache.iter_cached_zip(batch_archive_key(batch_id), files),
+        media_type="application/zip",
+        headers={"Content-Disposition": f'attachment; filename="lp-batch-{batch_id}.zip"'},
+    )
 
 @app.get("/api/jobs/{job_id}")
 async def get_job_status(job_id: str):
-    if job_id not in jobs:
+    job = job_store.get_job(job_id)
+    if job is None:
         raise HTTPException(status_code=404, detail="Job not found")
         
-    return jobs[job_id]
+    # 待機中であればキュー内の順番と見込み待ち時間を付与
+    return {
+        **job,
+        "queuePosition": job_queue.position(job_id),
+        "estimatedWaitSeconds": job_queue.estimated_wait(job_id),
+    }
+
+# 一覧で返せるフィールド（既定では重い result を含めない）
+JOB_LIST_FIELDS = {
+    "jobId", "status", "progress", "currentStep", "steps", "error",
+    "createdAt", "retryOf", "batchId", "originalData", "result", "purgedAt",
+}
+DEFAULT_JOB_LIST_FIELDS = ["jobId", "status", "progress", "currentStep", "error", "createdAt", "retryOf", "batchId"]
+
+@app.get("/api/jobs/{job_id}/events")
+async def stream_job_events(job_id: str, request: Request):
+    # 状態を読む前に購読しておき、その間の更新を取りこぼさないようにする
+    queue = job_events.subscribe(job_id)
+    job = job_store.get_job(job_id, include_result=False)
+    if job is None:
+        job_events.unsubscribe(job_id, queue)
+        raise HTTPException(status_code=404, detail="Job not found")
+    
+    async def event_stream():
+        try:
+            # 最初に現在の状態全体を送り、以降は差分のみを送る
+            queue_position = job_queue.position(job_id)
+            yield format_sse("snapshot", {
+                "jobId": job["jobId"],
+                "status": job["status"],
+                "progress": job["progress"],
+                "currentStep": job["currentStep"],
+                "steps": job["steps"],
+                "error": job.get("error"),
+                "queuePosition": queue_position,
+                "estimatedWaitSeconds": job_queue.estimated_wait(job_id),
+            })
+            if job["status"] in TERMINAL_STATUSES:
+                return
+            
+            while not await request.is_disconnected():
+                item = await job_events.next_event(queue, SSE_KEEPALIVE_SECONDS)
+                if item is None:
+                    # 待機中であればキュー内の順番の変化も知らせる
+                    new_position = job_queue.position(job_id)
+                    if new_position is not None and new_position != queue_position:
+                        queue_position = new_position
+                        yield format_sse("update", {
+                            "queuePosition": queue_position,
+                            "estimatedWaitSeconds": job_queue.estimated_wait(job_id),
+                        })
+                    else:
+                        yield ": keep-alive\n\n"
+                    continue
+                
+                event, data = item
+                yield format_sse(event, data)
+                if data.get("status") in TERMINAL_STATUSES:
+                    return
+        finally:
+            job_events.unsubscribe(job_id, queue)
+    
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
 
 @app.get("/api/jobs")
-async def get_jobs():
-    # 最新順にソート
-    sorted_jobs = sorted(
-        [job for job in jobs.values()],
-        key=lambda x: x.get("createdAt", ""), 
-        reverse=True
+async def get_jobs(
+    limit: int = Query(20, ge=1, le=100),
+    cursor: Optional[str] = None,
+    status: Optional[str] = Query(None, description="カンマ区切りで複数指定可"),
+    fields: Optional[str] = Query(None, description="返すフィールドをカンマ区切りで指定"),
+):
+    statuses = [s.strip() for s in status.split(",") if s.strip()] if status else None
+    selected_fields = (
+        [f.strip() for f in fields.split(",") if f.strip()] if fields else DEFAULT_JOB_LIST_FIELDS
     )
+    unknown_fields = set(selected_fields) - JOB_LIST_FIELDS
+    if unknown_fields:
+        raise HTTPException(status_code=400, detail=f"Unknown fields: {', '.join(sorted(unknown_fields))}")
     
-    return {"jobs": sorted_jobs}
-
-@app.post("/api/jobs/{job_id}/retry")
-async def retry_job(job_id: str, background_tasks: BackgroundTasks):
-    if job_id not in jobs:
-        raise HTTPException(status_code=404, detail="Job not found")
-        
-    # 元のジョブから必要なデータを取得
-    original_job = jobs[job_id]
+    # 最新順（createdAtのインデックスを利用）にページ単位で取得
+    try:
+        page, next_cursor = job_store.list_jobs(
+            limit,
+            cursor=cursor,
+            statuses=statuses,
+            include_result="result" in selected_fields,
+        )
+    except ValueError:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
     
+    return {
+        "jobs": [
+            {field: job[field] for field in selected_fields if field in job}
+            for job in page
+        ],
+        "nextCursor": next_cursor,
+    }
+
+# 元のジョブの入力で新しいジョブを作成してキューに入れる
+# 新しいジョブは元のジョブの完了済みステップの出力を再利用し、regenerate_step 以降だけを実行する
+def create_follow_up_job(original_job: Dict[str, Any], regenerate_step: Optional[str] = None) -> str:
     if "originalData" not in original_job:
         raise HTTPException(status_code=400, detail="Original data not found for retry")
         
@@ -351,47 +769,14 @@ async def retry_job(job_id: str, background_tasks: BackgroundTasks):
     new_job_id = str(uuid.uuid4())
     data = LPGenerationRequest(**original_job["originalData"])
     
+    # キューに投入
+    enqueue_job(new_job_id, data)
+    
     # 初期ステップの設定
-    steps = [
-        GenerationStep(
-            id="wireframe",
-            name="ワイヤーフレーム作成",
-            description="HTML構造の生成",
-            status="pending",
-            progress=0,
-        ),
-        GenerationStep(
-            id="css",
-            name="デザイン適用",
-            description="CSSスタイルの生成",
-            status="pending",
-            progress=0,
-        ),
-        GenerationStep(
-            id="js",
-            name="インタラクション追加",
-            description="JavaScript機能の実装",
-            status="pending",
-            progress=0,
-        ),
-        GenerationStep(
-            id="image",
-            name="画像生成",
-            description="AIによる画像の生成",
-            status="pending",
-            progress=0,
-        ),
-        GenerationStep(
-            id="apply-image",
-            name="画像適用",
-            description="生成された画像の適用",
-            status="pending",
-            progress=0,
-        ),
-    ]
+    steps = create_initial_steps()
     
     # ジョブ初期化
-    jobs[new_job_id] = {
+    job_store.create_job({
         "jobId": new_job_id,
         "status": "pending",
         "progress": 0,
@@ -399,35 +784,162 @@ async def retry_job(job_id: str, background_tasks: BackgroundTasks):
         "steps": [step.dict() for step in steps],
         "createdAt": datetime.now().isoformat(),
         "originalData": original_job["originalData"],
-        "retryOf": job_id,
-    }
+        "retryOf": original_job["jobId"],
+        "regenerateStep": regenerate_step,
+    })
+    
+    return new_job_id
+
+# 失敗したジョブを、最初に失敗したステップから再開する
+@app.post("/api/jobs/{job_id}/retry")
+async def retry_job(job_id: str):
+    # 元のジョブから必要なデータを取得
+    original_job = job_store.get_job(job_id, include_result=False)
+    if original_job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    
+    # 待機中・実行中のジョブを再実行すると、同じ作業ディレクトリ・チェックポイントで2つのパイプラインが動いてしまう
+    if original_job["status"] not in TERMINAL_STATUSES:
+        raise HTTPException(status_code=409, detail="Job is still running")
+    
+    return {"jobId": create_follow_up_job(original_job)}
+
+# 指定したステップとその下流のステップだけを作り直す（例: CSSだけを作り直す）
+@app.post("/api/jobs/{job_id}/steps/{step_id}/regenerate")
+async def regenerate_job_step(job_id: str, step_id: str):
+    original_job = job_store.get_job(job_id, include_result=False)
+    if original_job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    
+    if step_id not in {step.id for step in create_initial_steps()}:
+        raise HTTPException(status_code=404, detail="Step not found")
+    
+    if original_job["status"] not in TERMINAL_STATUSES:
+        raise HTTPException(status_code=409, detail="Job is still running")
+    
+    return {"jobId": create_follow_up_job(original_job, regenerate_step=step_id)}
+
+# 待機中・実行中のジョブをキャンセルする
+# 実行中のステップとプロバイダへの要求を中断し、作業ディレクトリを削除してワーカーを空ける
+# （完了済みステップの出力は残すため、再実行すればその続きから生成できる）
+@app.delete("/api/jobs/{job_id}")
+async def cancel_job(job_id: str):
+    job = job_store.get_job(job_id, include_result=False)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    if job["status"] in TERMINAL_STATUSES:
+        raise HTTPException(status_code=409, detail="Job is already finished")
+    
+    await job_queue.cancel(job_id)
+    
+    # キャンセルを待つ間に完了・失敗していた場合はその状態を残す
+    job = job_store.get_job(job_id, include_result=False)
+    if job["status"] in TERMINAL_STATUSES:
+        raise HTTPException(status_code=409, detail="Job is already finished")
+    
+    steps = [GenerationStep(**step) for step in job["steps"]]
+    for step in steps:
+        if step.status == "processing":
+            step.status = "cancelled"
+    update_job_status(job_id, "cancelled", job["progress"], "", steps)
+    metrics.JOBS.labels("cancelled").inc()
     
-    # バックグラウンドタスク開始
-    background_tasks.add_task(generate_lp_background, new_job_id, data)
+    await discard_job_workspace(job_id)
     
-    return {"jobId": new_job_id}
+    return {"jobId": job_id, "status": "cancelled"}
 
 @app.get("/api/jobs/{job_id}/download")
 async def download_job(job_id: str):
-    if job_id not in jobs:
+    job = job_store.get_job(job_id, include_result=False)
+    if job is None:
         raise HTTPException(status_code=404, detail="Job not found")
-        
-    job = jobs[job_id]
     
     if job["status"] != "completed":
         raise HTTPException(status_code=400, detail="Job is not completed yet")
-        
-    download_path = f"download-{job_id}.zip"
     
-    if not os.path.exists(download_path):
-        raise HTTPException(status_code=404, detail="Download file not found")
+    if job.get("purgedAt"):
+        raise purged_error()
         
-    return FileResponse(
-        path=download_path,
-        filename=f"lp-{job_id}.zip",
-        media_type="application/zip"
+    if not os.path.isdir(get_job_dir(job_id)):
+        raise HTTPException(status_code=404, detail="Download file not found")
+    
+    # ジョブの生成物からその場でzipを組み立てて逐次送信する
+    files = get_archive_files(job_id)
+    return StreamingResponse(
+        archive_cache.iter_cached_zip(job_id, files),
+        media_type="application/zip",
+        headers={"Content-Disposition": f'attachment; filename="lp-{job_id}.zip"'},
     )
 
+@app.get("/api/jobs/{job_id}/assets/{name}")
+async def get_job_asset(job_id: str, name: str, request: Request):
+    job = job_store.get_job(job_id, include_result=False)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    if job.get("purgedAt"):
+        raise purged_error()
+    
+    # ジョブディレクトリ直下の生成物のみを配信する
+    if os.path.basename(name) != name or os.path.splitext(name)[1].lower() not in ASSET_EXTENSIONS:
+        raise HTTPException(status_code=404, detail="Asset not found")
+    path = os.path.join(get_job_dir(job_id), name)
+    if not os.path.isfile(path):
+        raise HTTPException(status_code=404, detail="Asset not found")
+    
+    # HTML/CSS/JSは事前圧縮したファイルがあれば、Accept-Encoding に応じてそちらを送る
+    media_type = mimetypes.guess_type(name)[0] or "application/octet-stream"
+    content_encoding = None
+    if name in BUILD_FILES:
+        precompressed = select_precompressed(path, request.headers.get("accept-encoding"))
+        if precompressed is not None:
+            path, content_encoding = precompressed
+    
+    stat = os.stat(path)
+    # エンコーディングごとに別の表現として扱う
+    etag = f'"{stat.st_mtime_ns:x}-{stat.st_size:x}{"-" + content_encoding if content_encoding else ""}"'
+    last_modified = formatdate(stat.st_mtime, usegmt=True)
+    # 完了したジョブの生成物は変わらないため長期キャッシュ、生成中は毎回再検証させる
+    if job["status"] == "completed":
+        cache_control = "public, max-age=31536000, immutable"
+    else:
+        cache_control = "no-cache"
+    headers = {"ETag": etag, "Last-Modified": last_modified, "Cache-Control": cache_control}
+    if name in BUILD_FILES:
+        headers["Vary"] = "Accept-Encoding"
+    if content_encoding:
+        headers["Content-Encoding"] = content_encoding
+    
+    # 条件付きGET（If-None-Match を優先し、無ければ If-Modified-Since を見る）
+    if_none_match = request.headers.get("if-none-match")
+    if_modified_since = request.headers.get("if-modified-since")
+    not_modified = False
+    if if_none_match is not None:
+        not_modified = etag in [tag.strip() for tag in if_none_match.split(",")] or if_none_match.strip() == "*"
+    elif if_modified_since is not None:
+        try:
+            not_modified = int(stat.st_mtime) <= parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            not_modified = False
+    if not_modified:
+        return Response(status_code=304, headers=headers)
+    
+    return FileResponse(path, media_type=media_type, headers=headers)
+
+@app.get("/api/cache/stats")
+async def get_cache_stats():
+    # 応答キャッシュのヒット率や使用量
+    return response_cache.stats()
+
+@app.get("/api/retention/stats")
+async def get_retention_stats():
+    # 作業ディレクトリ・保存済みの生成結果・zipキャッシュの使用量と保持期間の設定
+    return await asyncio.to_thread(retention.stats)
+
+@app.get("/metrics")
+async def get_metrics():
+    # ステップごとの所要時間・待ち時間・トークン数・出力バイト数などのヒストグラム（Prometheus形式）
+    return Response(content=generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
 # サーバー起動
 if __name__ == "__main__":
     import uvicorn
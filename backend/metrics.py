@@ -0,0 +1,153 @@
+import os
+import time
+import asyncio
+from contextvars import ContextVar
+from typing import Any, Awaitable, Callable, Dict, Optional
+from prometheus_client import Counter, Histogram
+
+######################################
+## ステップごとの計測
+######################################
+
+## パイプラインの各ステップについて、所要時間・レート制限の待ち時間・トークン数・再試行回数・
+## 出力したファイルのバイト数を記録し、Prometheus のヒストグラムにも集計する
+## 計測中のステップは ContextVar で引き継ぐため、エージェントや rate_limit からは
+## record_* を呼ぶだけでよい（ステップの外で呼ばれた場合は何もしない）
+
+STEP_DURATION = Histogram(
+    "lp_step_duration_seconds", "ステップの所要時間（秒）", ["step", "status"],
+    buckets=(1, 2.5, 5, 10, 20, 30, 45, 60, 90, 120, 180, 300, 600),
+)
+STEP_QUEUE_WAIT = Histogram(
+    "lp_step_queue_wait_seconds", "レート制限による待ち時間（秒）", ["step"],
+    buckets=(0.01, 0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120),
+)
+STEP_TOKENS = Histogram(
+    "lp_step_tokens", "ステップで使用したトークン数", ["step", "direction"],
+    buckets=(100, 500, 1000, 2000, 4000, 8000, 16000, 32000, 64000),
+)
+STEP_OUTPUT_BYTES = Histogram(
+    "lp_step_output_bytes", "ステップが出力したファイルのバイト数", ["step", "kind"],
+    buckets=(1e3, 5e3, 1e4, 2.5e4, 5e4, 1e5, 2.5e5, 5e5, 1e6, 2.5e6, 5e6),
+)
+STEP_RETRIES = Counter("lp_step_retries_total", "レート制限による再試行の回数", ["step"])
+PROVIDER_ATTEMPTS = Counter(
+    "lp_text_provider_attempts_total", "テキスト生成のプロバイダごとの要求結果", ["step", "provider", "outcome"],
+)
+JOB_QUEUE_WAIT = Histogram(
+    "lp_job_queue_wait_seconds", "ジョブの投入から処理開始までの待ち時間（秒）",
+    buckets=(0.1, 1, 5, 10, 30, 60, 120, 300, 600, 1200),
+)
+JOBS = Counter("lp_jobs_total", "終了したジョブの数", ["status"])
+COALESCED_REQUESTS = Counter(
+    "lp_coalesced_requests_total", "既存のジョブにまとめた生成リクエストの数", ["status"],
+)
+
+## 出力ファイルの拡張子 -> 種類
+OUTPUT_KINDS = {
+    ".html": "html",
+    ".css": "css",
+    ".js": "js",
+    ".jpg": "image",
+    ".jpeg": "image",
+    ".png": "image",
+    ".webp": "image",
+    ".avif": "image",
+}
+
+
+## 1ステップ分の計測値
+class StepMetrics:
+    def __init__(self, step_id: str):
+        self.step_id = step_id
+        self.status = "processing"
+        self.started_at = time.monotonic()
+        self.wall_seconds = 0.0
+        self.queue_wait_seconds = 0.0
+        self.input_tokens = 0
+        self.output_tokens = 0
+        self.retries = 0
+        self.output_bytes: Dict[str, int] = {}
+
+    ## ステップの終了時に所要時間を確定し、ヒストグラムに反映する
+    def finish(self, status: str):
+        self.status = status
+        self.wall_seconds = time.monotonic() - self.started_at
+        STEP_DURATION.labels(self.step_id, status).observe(self.wall_seconds)
+        STEP_QUEUE_WAIT.labels(self.step_id).observe(self.queue_wait_seconds)
+        if self.input_tokens or self.output_tokens:
+            STEP_TOKENS.labels(self.step_id, "input").observe(self.input_tokens)
+            STEP_TOKENS.labels(self.step_id, "output").observe(self.output_tokens)
+        for kind, size in self.output_bytes.items():
+            STEP_OUTPUT_BYTES.labels(self.step_id, kind).observe(size)
+
+
+_current_step: ContextVar[Optional[StepMetrics]] = ContextVar("current_step_metrics", default=None)
+
+
+## ステップの実行関数を計測付きにする
+## 終了時（失敗・キャンセルを含む）に on_finish(計測値) が呼ばれる
+def instrument_step(
+    step_id: str,
+    run: Callable[[Dict[str, Any]], Awaitable[Any]],
+    on_finish: Optional[Callable[[StepMetrics], None]] = None,
+) -> Callable[[Dict[str, Any]], Awaitable[Any]]:
+    async def instrumented(results: Dict[str, Any]) -> Any:
+        step_metrics = StepMetrics(step_id)
+        token = _current_step.set(step_metrics)
+        status = "error"
+        try:
+            result = await run(results)
+            status = "completed"
+            return result
+        except asyncio.CancelledError:
+            status = "cancelled"
+            raise
+        finally:
+            _current_step.reset(token)
+            step_metrics.finish(status)
+            if on_finish:
+                on_finish(step_metrics)
+
+    return instrumented
+
+
+def record_queue_wait(seconds: float):
+    step_metrics = _current_step.get()
+    if step_metrics is not None:
+        step_metrics.queue_wait_seconds += seconds
+
+
+def record_tokens(input_tokens: int, output_tokens: int):
+    step_metrics = _current_step.get()
+    if step_metrics is not None:
+        step_metrics.input_tokens += input_tokens or 0
+        step_metrics.output_tokens += output_tokens or 0
+
+
+def record_retry():
+    step_metrics = _current_step.get()
+    if step_metrics is not None:
+        step_metrics.retries += 1
+        STEP_RETRIES.labels(step_metrics.step_id).inc()
+
+
+## テキスト生成の要求結果（succeeded / failed / invalid / hedged）を数える
+def record_provider_attempt(provider: str, outcome: str):
+    step_metrics = _current_step.get()
+    PROVIDER_ATTEMPTS.labels(step_metrics.step_id if step_metrics else "", provider, outcome).inc()
+
+
+## 書き出したファイルのサイズを種類（html/css/js/image）ごとに加算する
+def record_output_file(path: str):
+    step_metrics = _current_step.get()
+    if step_metrics is None:
+        return
+    kind = OUTPUT_KINDS.get(os.path.splitext(path)[1].lower())
+    if kind is None:
+        return
+    try:
+        size = os.path.getsize(path)
+    except OSError:
+        return
+    step_metrics.output_bytes[kind] = step_metrics.output_bytes.get(kind, 0) + size
@@ -0,0 +1,91 @@
+import os
+import asyncio
+import random
+import time
+from typing import Any, Awaitable, Callable, Optional, Tuple, Type
+import metrics
+
+######################################
+## プロバイダごとのレート制限
+######################################
+
+## トークンバケット
+## rate_per_minute の速度で補充され、capacity まで貯まる
+## 消費量が実際に分かってから差し引く（debit）ことも可能で、その場合は残量が負になり得る
+class TokenBucket:
+    def __init__(self, rate_per_minute: float, capacity: Optional[float] = None):
+        self.rate = rate_per_minute / 60.0
+        self.capacity = capacity if capacity is not None else rate_per_minute
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    ## amount 分のトークンが貯まるまで待ってから消費する
+    ## 待機した秒数を返す（計測中のステップの待ち時間にも加算する）
+    async def acquire(self, amount: float = 1) -> float:
+        ## 容量を超える要求は永久に満たされないので容量に丸める
+        amount = min(amount, self.capacity)
+        started_at = time.monotonic()
+        async with self._lock:
+            while True:
+                self._refill()
+                if self.tokens >= amount:
+                    self.tokens -= amount
+                    waited = time.monotonic() - started_at
+                    metrics.record_queue_wait(waited)
+                    return waited
+                await asyncio.sleep((amount - self.tokens) / self.rate)
+
+    ## 待たずに消費する（レスポンス後に判明した出力トークン数など）
+    def debit(self, amount: float):
+        self._refill()
+        self.tokens -= amount
+
+
+def _env_float(name: str, default: float) -> float:
+    return float(os.environ.get(name, default))
+
+
+## 各プロバイダの上限（1分あたり）。環境変数で上書きできる
+anthropic_requests = TokenBucket(_env_float("ANTHROPIC_REQUESTS_PER_MINUTE", 50))
+anthropic_input_tokens = TokenBucket(_env_float("ANTHROPIC_INPUT_TOKENS_PER_MINUTE", 40000))
+anthropic_output_tokens = TokenBucket(_env_float("ANTHROPIC_OUTPUT_TOKENS_PER_MINUTE", 16000))
+gemini_requests = TokenBucket(_env_float("GEMINI_REQUESTS_PER_MINUTE", 60))
+imagen_images = TokenBucket(_env_float("IMAGEN_IMAGES_PER_MINUTE", 10))
+
+
+## 入力トークン数の概算（日本語を含むため1トークン≒3文字とみなす）
+def estimate_tokens(text: str) -> int:
+    return len(text) // 3 + 1
+
+
+######################################
+## レート制限エラー時の再試行
+######################################
+
+RATE_LIMIT_MAX_RETRIES = int(os.environ.get("RATE_LIMIT_MAX_RETRIES", 4))
+
+## 429 などの一時的なエラーで失敗した場合、指数バックオフで再試行する
+async def call_with_retry(
+    func: Callable[[], Awaitable[Any]],
+    retry_on: Tuple[Type[BaseException], ...],
+    max_retries: int = RATE_LIMIT_MAX_RETRIES,
+    base_delay: float = 2.0,
+) -> Any:
+    attempt = 0
+    while True:
+        try:
+            return await func()
+        except retry_on as e:
+            if attempt >= max_retries:
+                raise
+            delay = base_delay * (2 ** attempt) + random.uniform(0, 1)
+            metrics.record_retry()
+            print(f"レート制限により再試行します（{attempt + 1}/{max_retries}回目, {delay:.1f}秒後）: {e}")
+            await asyncio.sleep(delay)
+            attempt += 1
@@ -0,0 +1,194 @@
+import os
+import re
+import time
+import shutil
+import asyncio
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional
+from archive import ArchiveCache, batch_archive_key
+from job_events import TERMINAL_STATUSES
+from job_store import JobStore
+
+######################################
+## ジョブ・作業ディレクトリ・zipの保持期間の管理
+######################################
+
+## 終了したジョブの生成物（作業ディレクトリ・生成結果・ステップの出力）を
+## 保持期間（RETENTION_TTL_SECONDS）と作業ディレクトリの合計サイズの上限（RETENTION_MAX_BYTES）に従って削除する
+## ジョブの状態・入力などの概要は残し、削除したジョブには purgedAt が付く
+## 処理はバックグラウンドで一定間隔（RETENTION_INTERVAL_SECONDS）ごとに行う
+
+## 以前のバージョンがジョブごとに書き出していたダウンロード用zip（現在はメモリ上のキャッシュから配信する）
+LEGACY_ARCHIVE_PATTERN = re.compile(r"^download-.+\.zip$")
+## ジョブの作業ディレクトリ名（ジョブID）。それ以外のディレクトリには触れない
+JOB_DIR_PATTERN = re.compile(r"^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}$")
+
+
+## ディレクトリ以下のファイルの合計サイズ（バイト）
+def directory_size(path: str) -> int:
+    total = 0
+    for root, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(root, name))
+            except OSError:
+                continue
+    return total
+
+
+class RetentionManager:
+    def __init__(
+        self,
+        job_store: JobStore,
+        jobs_dir: str,
+        archive_cache: ArchiveCache,
+        ttl_seconds: float,
+        max_bytes: int,
+        interval_seconds: float,
+        archive_ttl_seconds: float,
+    ):
+        self.job_store = job_store
+        self.jobs_dir = jobs_dir
+        self.archive_cache = archive_cache
+        self.ttl_seconds = ttl_seconds
+        self.max_bytes = max_bytes
+        self.interval_seconds = interval_seconds
+        self.archive_ttl_seconds = archive_ttl_seconds
+        self.last_sweep: Optional[Dict[str, Any]] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self):
+        if self.interval_seconds > 0:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _run(self):
+        while True:
+            try:
+                ## ディレクトリの走査と削除はブロッキング処理なのでスレッドで行う
+                await asyncio.to_thread(self.sweep)
+            except Exception as e:
+                print(f"保持期間の管理中にエラーが発生しました: {e}")
+            await asyncio.sleep(self.interval_seconds)
+
+    ## ジョブの作業ディレクトリ（ジョブID -> パス）
+    def workspaces(self) -> Dict[str, str]:
+        return {
+            entry.name: entry.path
+            for entry in os.scandir(self.jobs_dir)
+            if entry.is_dir(follow_symlinks=False) and JOB_DIR_PATTERN.match(entry.name)
+        }
+
+    ## ジョブごとの作業ディレクトリのサイズ（ジョブID -> バイト）
+    def workspace_usage(self) -> Dict[str, int]:
+        return {job_id: directory_size(path) for job_id, path in self.workspaces().items()}
+
+    ## ジョブの生成物を削除し、概要だけを残す
+    ## バッチのジョブであれば、そのジョブのファイルを含むバッチ全体のzipもキャッシュから破棄する
+    def purge_job(self, job_id: str):
+        job = self.job_store.get_job(job_id, include_result=False)
+        shutil.rmtree(os.path.join(self.jobs_dir, job_id), ignore_errors=True)
+        self.job_store.purge_job(job_id)
+        self.archive_cache.discard(job_id)
+        if job and job.get("batchId"):
+            self.archive_cache.discard(batch_archive_key(job["batchId"]))
+
+    ## 古いバージョンのダウンロード用zipを削除する
+    def remove_legacy_archives(self) -> int:
+        removed = 0
+        directories = [self.jobs_dir] + list(self.workspaces().values())
+        for directory in directories:
+            for name in os.listdir(directory):
+                if LEGACY_ARCHIVE_PATTERN.match(name):
+                    try:
+                        os.remove(os.path.join(directory, name))
+                        removed += 1
+                    except OSError:
+                        continue
+        return removed
+
+    ## 保持期間・サイズの上限を超えた生成物を削除する
+    def sweep(self) -> Dict[str, Any]:
+        started_at = time.monotonic()
+        statuses = sorted(TERMINAL_STATUSES)
+        purged: List[str] = []
+
+        ## 保持期間を過ぎたジョブ
+        if self.ttl_seconds > 0:
+            cutoff = (datetime.now() - timedelta(seconds=self.ttl_seconds)).isoformat()
+            for job_id in self.job_store.find_unpurged_jobs(statuses, updated_before=cutoff):
+                self.purge_job(job_id)
+                purged.append(job_id)
+
+        ## ジョブとして登録されていない作業ディレクトリ（保持期間を過ぎたもの）
+        usage = self.workspace_usage()
+        orphaned = 0
+        for job_id in list(usage):
+            path = os.path.join(self.jobs_dir, job_id)
+            if self.job_store.exists(job_id):
+                continue
+            if self.ttl_seconds > 0 and time.time() - os.path.getmtime(path) > self.ttl_seconds:
+                shutil.rmtree(path, ignore_errors=True)
+                del usage[job_id]
+                orphaned += 1
+
+        ## 合計サイズが上限を超えていれば、最終更新が古いジョブから削除する
+        total_bytes = sum(usage.values())
+        if self.max_bytes > 0 and total_bytes > self.max_bytes:
+            for job_id in self.job_store.find_unpurged_jobs(statuses):
+                if total_bytes <= self.max_bytes:
+                    break
+                if job_id not in usage:
+                    continue
+                self.purge_job(job_id)
+                purged.append(job_id)
+                total_bytes -= usage.pop(job_id, 0)
+
+        result = {
+            "sweptAt": datetime.now().isoformat(),
+            "durationSeconds": round(time.monotonic() - started_at, 3),
+            "purgedJobs": len(purged),
+            "removedOrphanedWorkspaces": orphaned,
+            "removedLegacyArchives": self.remove_legacy_archives(),
+            "evictedArchiveCacheEntries": (
+                self.archive_cache.evict_expired(self.archive_ttl_seconds) if self.archive_ttl_seconds > 0 else 0
+            ),
+        }
+        if purged or orphaned:
+            print(f"保持期間・容量の上限により {len(purged)} 件のジョブの生成物を削除しました")
+        self.last_sweep = result
+        return result
+
+    ## 現在の使用量と設定
+    def stats(self) -> Dict[str, Any]:
+        usage = self.workspace_usage()
+        return {
+            "workspaces": len(usage),
+            "workspaceBytes": sum(usage.values()),
+            **self.job_store.storage_stats(),
+            "archiveCacheEntries": len(self.archive_cache),
+            "archiveCacheBytes": self.archive_cache.total_bytes,
+            "ttlSeconds": self.ttl_seconds,
+            "maxBytes": self.max_bytes,
+            "intervalSeconds": self.interval_seconds,
+            "archiveTtlSeconds": self.archive_ttl_seconds,
+            "lastSweep": self.last_sweep,
+        }
+
+
+## 環境変数から設定を読み込んで作成する（各値は 0 で無効）
+def create_retention_manager(job_store: JobStore, jobs_dir: str, archive_cache: ArchiveCache) -> RetentionManager:
+    return RetentionManager(
+        job_store,
+        jobs_dir,
+        archive_cache,
+        ttl_seconds=float(os.environ.get("RETENTION_TTL_SECONDS", 7 * 24 * 3600)),
+        max_bytes=int(os.environ.get("RETENTION_MAX_BYTES", 5 * 1024 ** 3)),
+        interval_seconds=float(os.environ.get("RETENTION_INTERVAL_SECONDS", 600)),
+        archive_ttl_seconds=float(os.environ.get("ZIP_CACHE_TTL_SECONDS", 3600)),
+    )
@@ -0,0 +1,117 @@
+import asyncio
+from dataclasses import dataclass, field
+from typing import Any, Awaitable, Callable, Dict, Iterable, List, Optional, Set
+
+######################################
+## 依存関係グラフに基づくステップスケジューラ
+######################################
+
+## パイプラインの1ステップ
+## run にはその時点までに完了したステップの結果（ステップID -> 結果）が渡される
+## 依存先（およびその依存先）の結果は必ず含まれる
+@dataclass
+class PipelineStep:
+    id: str
+    run: Callable[[Dict[str, Any]], Awaitable[Any]]
+    depends_on: List[str] = field(default_factory=list)
+
+
+## ステップ定義の検証（未知の依存・循環依存を検出する）
+def validate_steps(steps: List[PipelineStep]):
+    step_ids = [step.id for step in steps]
+    if len(step_ids) != len(set(step_ids)):
+        raise ValueError("ステップIDが重複しています")
+
+    known = set(step_ids)
+    for step in steps:
+        for dep in step.depends_on:
+            if dep not in known:
+                raise ValueError(f"ステップ {step.id} の依存先 {dep} が存在しません")
+
+    ## トポロジカルソートが完了しなければ循環している
+    resolved = set()
+    remaining = list(steps)
+    while remaining:
+        ready = [step for step in remaining if all(dep in resolved for dep in step.depends_on)]
+        if not ready:
+            raise ValueError("ステップの依存関係が循環しています")
+        for step in ready:
+            resolved.add(step.id)
+            remaining.remove(step)
+
+
+## 指定したステップと、それに（直接・間接に）依存するステップのID
+def downstream_steps(steps: List[PipelineStep], step_ids: Iterable[str]) -> Set[str]:
+    affected = set(step_ids)
+    changed = True
+    while changed:
+        changed = False
+        for step in steps:
+            if step.id not in affected and any(dep in affected for dep in step.depends_on):
+                affected.add(step.id)
+                changed = True
+    return affected
+
+
+## 保存済みの結果のうち再利用できるものだけを返す
+## invalidate に指定したステップとその下流は作り直すため除き、依存先が作り直しになるステップも除く
+def reusable_results(
+    steps: List[PipelineStep],
+    saved: Dict[str, Any],
+    invalidate: Iterable[str] = (),
+) -> Dict[str, Any]:
+    excluded = downstream_steps(steps, invalidate)
+    reusable: Dict[str, Any] = {}
+    remaining = [step for step in steps if step.id in saved and step.id not in excluded]
+    ## 依存先が再利用できると確定したステップから順に採用する
+    changed = True
+    while changed:
+        changed = False
+        for step in list(remaining):
+            if all(dep in reusable for dep in step.depends_on):
+                reusable[step.id] = saved[step.id]
+                remaining.remove(step)
+                changed = True
+    return reusable
+
+
+## 依存関係が満たされたステップから並行に実行する
+## on_start / on_complete はステップの開始・完了時に呼ばれる（進捗報告用）
+## precomputed に結果を渡したステップは実行せず、その結果を後続のステップに渡す
+async def run_pipeline(
+    steps: List[PipelineStep],
+    on_start: Optional[Callable[[str], None]] = None,
+    on_complete: Optional[Callable[[str, Any], None]] = None,
+    precomputed: Optional[Dict[str, Any]] = None,
+) -> Dict[str, Any]:
+    validate_steps(steps)
+
+    results: Dict[str, Any] = dict(precomputed or {})
+    pending = {step.id: step for step in steps if step.id not in results}
+    running: Dict[asyncio.Task, str] = {}
+
+    try:
+        while pending or running:
+            ## 依存ステップがすべて完了したものを起動
+            for step_id, step in list(pending.items()):
+                if all(dep in results for dep in step.depends_on):
+                    del pending[step_id]
+                    if on_start:
+                        on_start(step_id)
+                    running[asyncio.create_task(step.run(dict(results)))] = step_id
+
+            done, _ = await asyncio.wait(running.keys(), return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                step_id = running.pop(task)
+                ## 失敗したステップがあれば例外をそのまま送出する
+                results[step_id] = task.result()
+                if on_complete:
+                    on_complete(step_id, results[step_id])
+    finally:
+        ## 失敗・キャンセル時は実行中の他ステップを止める
+        for task in running:
+            task.cancel()
+        if running:
+            await asyncio.gather(*running.keys(), return_exceptions=True)
+
+    return results
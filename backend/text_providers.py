@@ -0,0 +1,177 @@
+import os
+import asyncio
+from dataclasses import dataclass
+from typing import Awaitable, Callable, Dict, List, Optional
+import metrics
+import rate_limit
+
+######################################
+## テキスト生成のプロバイダ切り替え（フェイルオーバー・ヘッジ）
+######################################
+
+## 複数のプロバイダ（モデル）を優先順に並べ、1つ目が失敗・タイムアウトしたら次に切り替える
+## hedge_delay を指定すると、最初の要求の送信からその秒数までにどの要求からも出力が届かない場合に次のプロバイダへも
+## 同時に要求を出し（ヘッジ）、先に有効な結果を返した方を採用して残りはキャンセルする
+## これにより、1つのエンドポイントの遅延・過負荷でLP全体の所要時間が延びるのを抑える
+
+
+## テキスト生成のプロバイダ
+## generate(system_prompt, prompt, on_progress, shared_prefix, on_usage,
+##          max_retries=, timeout=, validate=, use_cache=, on_admitted=) でテキストを返す
+## timeout は1回の要求のタイムアウトで、プロバイダ側でレート制限の待ちが終わってから計る
+## on_admitted() はレート制限の待ちが終わって要求を送信するときに呼ぶ
+@dataclass
+class TextProvider:
+    name: str
+    generate: Callable[..., Awaitable[str]]
+
+
+## すべてのプロバイダで生成できなかった場合の例外
+class ProviderFailoverError(Exception):
+    pass
+
+
+## "名前=秒数" をカンマ区切りで並べた環境変数を読み込む（例: "wireframe=240,js=120"）
+def parse_step_seconds(value: Optional[str]) -> Dict[str, float]:
+    seconds: Dict[str, float] = {}
+    for item in (value or "").split(","):
+        name, _, number = item.partition("=")
+        if name.strip() and number.strip():
+            seconds[name.strip()] = float(number)
+    return seconds
+
+
+def env_seconds(name: str) -> Optional[float]:
+    value = float(os.environ.get(name, 0) or 0)
+    return value if value > 0 else None
+
+
+## providers を優先順に試してテキストを生成する
+## ・timeout: 1回の要求のタイムアウト（秒）。超えた場合は次のプロバイダに切り替える
+##   自前のレート制限の待ち時間と再試行までの待ち時間は含まない
+## ・hedge_delay: 最初の要求を送信してからこの秒数までに出力が届かなければ、次のプロバイダにも並行して要求する（None で無効）
+##   レート制限で送信を待っている間は数えない
+## ・is_failover_error: 次のプロバイダに切り替えるべき例外か（それ以外の例外はそのまま送出する）
+## ・validate: 結果が使えるか（False の場合は失敗として次のプロバイダに切り替える）
+##   満たさない結果は応答キャッシュに保存されず、一度満たさない結果が出た後の要求はキャッシュを参照しない
+## 途中経過（on_progress）は最初に出力を返し始めた要求のものだけを通知し、
+## 使用量（on_usage）は採用した結果のものだけを通知する
+## 最後のプロバイダ以外はレート制限の再試行をせず、すぐに次へ切り替える
+async def generate_with_failover(
+    providers: List[TextProvider],
+    system_prompt: str,
+    prompt: str,
+    is_failover_error: Callable[[BaseException], bool],
+    timeout: Optional[float] = None,
+    hedge_delay: Optional[float] = None,
+    validate: Optional[Callable[[str], bool]] = None,
+    on_progress: Optional[Callable[[str, int], None]] = None,
+    shared_prefix: Optional[str] = None,
+    on_usage: Optional[Callable[[Dict[str, int]], None]] = None,
+) -> str:
+    if not providers:
+        raise ValueError("テキスト生成のプロバイダが指定されていません")
+    loop = asyncio.get_running_loop()
+    waiting = list(providers)
+    running: Dict[asyncio.Task, TextProvider] = {}
+    usages: Dict[str, Dict[str, int]] = {}
+    errors: List[str] = []
+    ## 途中経過を通知している要求のプロバイダ名
+    progress_owner: Optional[str] = None
+    ## validate を満たさない結果が出た後はキャッシュを参照しない
+    use_cache = True
+    ## ヘッジの待ち時間は最初の要求が送信されたときから計り始める
+    hedge_due = asyncio.Event()
+    hedge_wait: Optional[asyncio.Task] = None
+    hedge_timer: Optional[asyncio.TimerHandle] = None
+    if hedge_delay and len(providers) > 1:
+        hedge_wait = asyncio.create_task(hedge_due.wait())
+
+    def admitted():
+        nonlocal hedge_timer
+        if hedge_wait is not None and hedge_timer is None:
+            hedge_timer = loop.call_later(hedge_delay, hedge_due.set)
+
+    def launch():
+        provider = waiting.pop(0)
+
+        def progress(text: str, output_tokens: int):
+            nonlocal progress_owner
+            if progress_owner is None:
+                progress_owner = provider.name
+            if progress_owner == provider.name and on_progress:
+                on_progress(text, output_tokens)
+
+        def usage(value: Dict[str, int]):
+            usages[provider.name] = value
+
+        request = provider.generate(
+            system_prompt, prompt, progress, shared_prefix, usage,
+            max_retries=rate_limit.RATE_LIMIT_MAX_RETRIES if not waiting else 0,
+            timeout=timeout,
+            validate=validate,
+            use_cache=use_cache,
+            on_admitted=admitted,
+        )
+        task = asyncio.create_task(request)
+        running[task] = provider
+
+    launch()
+    try:
+        while running:
+            waiters = set(running)
+            if hedge_wait is not None:
+                waiters.add(hedge_wait)
+            done, _ = await asyncio.wait(waiters, return_when=asyncio.FIRST_COMPLETED)
+
+            if hedge_wait in done:
+                done.discard(hedge_wait)
+                hedge_wait = None
+                ## 出力が届かないまま閾値を超えたので、次のプロバイダにも要求する（ヘッジは1回まで）
+                if waiting and progress_owner is None and running:
+                    print(f"{running[next(iter(running))].name} の応答が{hedge_delay:g}秒間無いため、{waiting[0].name} にも要求します")
+                    metrics.record_provider_attempt(waiting[0].name, "hedged")
+                    launch()
+
+            for task in done:
+                provider = running.pop(task)
+                try:
+                    text = task.result()
+                except Exception as e:
+                    if not is_failover_error(e):
+                        raise
+                    message = "タイムアウトしました" if isinstance(e, asyncio.TimeoutError) else str(e)
+                    errors.append(f"{provider.name}: {message}")
+                    metrics.record_provider_attempt(provider.name, "failed")
+                    print(f"{provider.name} での生成に失敗しました: {message}")
+                else:
+                    if validate is None or validate(text):
+                        metrics.record_provider_attempt(provider.name, "succeeded")
+                        if on_usage and provider.name in usages:
+                            on_usage(usages[provider.name])
+                        ## 途中経過を通知していなかった要求が勝った場合は、結果全体を通知し直す
+                        if on_progress and progress_owner != provider.name:
+                            on_progress(text, rate_limit.estimate_tokens(text))
+                        return text
+                    errors.append(f"{provider.name}: 出力が不完全です")
+                    metrics.record_provider_attempt(provider.name, "invalid")
+                    use_cache = False
+                    print(f"{provider.name} の出力が不完全なため使用しません")
+                if progress_owner == provider.name:
+                    progress_owner = None
+
+            ## 実行中の要求が無くなったら次のプロバイダに切り替える
+            if not running and waiting:
+                print(f"{waiting[0].name} に切り替えて生成します")
+                launch()
+
+        raise ProviderFailoverError("すべてのプロバイダで生成に失敗しました: " + " / ".join(errors))
+    finally:
+        if hedge_timer is not None:
+            hedge_timer.cancel()
+        if hedge_wait is not None:
+            hedge_wait.cancel()
+        for task in running:
+            task.cancel()
+        if running:
+            await asyncio.gather(*running.keys(), return_exceptions=True)
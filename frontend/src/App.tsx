@@ -25,16 +25,17 @@ import {
 } from "@/components/ui/form";
 import { Input } from "@/components/ui/input";
 import { Textarea } from "@/components/ui/textarea";
+import api from "@/services/api";
 
 // ジョブのステータスタイプ
-type JobStatus = "idle" | "pending" | "processing" | "completed" | "error";
+type JobStatus = "idle" | "pending" | "processing" | "completed" | "error" | "cancelled";
 
 // ステップの型定義
 interface Step {
   id: string;
   name: string;
   description: string;
-  status: "pending" | "processing" | "completed" | "error";
+  status: "pending" | "processing" | "completed" | "error" | "cancelled";
   progress: number;
 }
 
@@ -46,12 +47,13 @@ interface JobInfo {
   currentStep: string;
   steps: Step[];
   error?: string;
+  queuePosition?: number | null;
+  estimatedWaitSeconds?: number | null;
   result?: {
     html: string;
     css: string;
     js: string;
     imageUrls: string[];
-    imageBase64: string;
   };
 }
 
@@ -80,29 +82,65 @@ const formSchema = z.object({
 // APIに送信するデータの型
 type FormData = z.infer<typeof formSchema>;
 
+// 完了・エラー・キャンセルなど、これ以上状態が変化しないステータスか
+const isTerminalStatus = (status?: JobStatus) =>
+  status === "completed" || status === "error" || status === "cancelled";
+
+// SSEで受け取った差分をジョブ情報に反映する（ステップはIDごとに置き換える）
+const applyJobDelta = (job: JobInfo, delta: Partial<JobInfo>): JobInfo => {
+  const steps = delta.steps
+    ? job.steps.map((step) => delta.steps?.find((changed) => changed.id === step.id) ?? step)
+    : job.steps;
+  const merged = { ...job, ...delta, steps };
+  // 処理が始まったら待ち順は不要
+  if (merged.status !== "pending") {
+    merged.queuePosition = null;
+    merged.estimatedWaitSeconds = null;
+  }
+  return merged;
+};
+
+// 生成物内の画像ファイルの参照（url(...)・src・srcset）
+const IMAGE_FILE_PATTERN = /^[^/:#?]+\.(?:jpe?g|png|webp|avif|gif|svg)$/i;
+
+// 相対パスで参照されている画像をジョブのアセットURLに置き換える
+// style.css・script.js やページ内リンク（#section）は置き換えない
+const resolveImageUrls = (code: string, assetBaseUrl: string): string => {
+  const resolve = (name: string) => (IMAGE_FILE_PATTERN.test(name) ? `${assetBaseUrl}${name}` : name);
+  return code
+    .replace(/url\(\s*(['"]?)([^'")\s]+)\1\s*\)/g, (_, quote, name) => `url(${quote}${resolve(name)}${quote})`)
+    .replace(/\bsrc=(["'])(.*?)\1/gi, (_, quote, value) => `src=${quote}${resolve(value.trim())}${quote}`)
+    .replace(/\bsrcset=(["'])(.*?)\1/gi, (_, quote, value) => {
+      const resolved = value
+        .split(",")
+        .map((candidate: string) => candidate.trim().replace(/^\S+/, resolve))
+        .join(", ");
+      return `srcset=${quote}${resolved}${quote}`;
+    });
+};
+
 // プレビューのiframeを更新するための関数
 const updateIframeContent = (
   iframe: HTMLIFrameElement,
   html: string,
   css: string,
   js: string,
-  imageBase64: string
+  assetBaseUrl: string
 ) => {
   const iframeDoc = iframe.contentDocument || iframe.contentWindow?.document;
 
   if (iframeDoc) {
-    // CSSの中の${imageBase64}プレースホルダーを実際の画像データで置き換え
-    const updatedCss = css.replace("${imageBase64}", imageBase64);
-
+    // CSS・JSはインラインで埋め込むため、画像の参照だけをジョブのアセットURLにする
+    // （<base> を使うと index.html 内の style.css・script.js まで読み込まれ、二重に適用されてしまう）
     iframeDoc.open();
     iframeDoc.write(`
       <!DOCTYPE html>
       <html>
         <head>
-          <style>${updatedCss}</style>
+          <style>${resolveImageUrls(css, assetBaseUrl)}</style>
         </head>
         <body>
-          ${html}
+          ${resolveImageUrls(html, assetBaseUrl)}
           <script>${js}</script>
         </body>
       </html>
@@ -115,6 +153,19 @@ const App = () => {
   // 現在のジョブ情報の状態
   const [jobInfo, setJobInfo] = useState<JobInfo | null>(null);
   const iframeRef = useRef<HTMLIFrameElement>(null);
+  // 進捗イベントの購読解除関数
+  const unsubscribeRef = useRef<(() => void) | null>(null);
+  // 「新しいLP生成」から送信した場合は、同じ入力でも既存のジョブにまとめず新しく生成する
+  const forceNewJobRef = useRef(false);
+
+  // 進捗イベントの購読を停止する
+  const stopSubscription = () => {
+    unsubscribeRef.current?.();
+    unsubscribeRef.current = null;
+  };
+
+  // アンマウント時に購読を停止
+  useEffect(() => stopSubscription, []);
 
   // フォームの状態管理
   const form = useForm<FormData>({
@@ -133,7 +184,10 @@ const App = () => {
   const onSubmit = async (data: FormData) => {
     try {
       // APIを呼び出してジョブを開始
-      const response = await fetch("http://localhost:8000/api/generate", {
+      // 連打などによる重複送信は実行中のジョブにまとめ、作り直しの場合は常に新しいジョブを作成する
+      const query = forceNewJobRef.current ? "?coalesce=false" : "";
+      forceNewJobRef.current = false;
+      const response = await fetch(`http://localhost:8000/api/generate${query}`, {
         method: "POST",
         headers: { "Content-Type": "application/json" },
         body: JSON.stringify(data),
@@ -191,35 +245,35 @@ const App = () => {
         ],
       });
 
-      // ジョブステータスのポーリングを開始
-      const pollInterval = setInterval(async () => {
+      // 完了・エラー時は購読を止め、結果を含むジョブ全体を1度だけ取得する
+      const finishJob = async () => {
+        stopSubscription();
         try {
-          const statusResponse = await fetch(`http://localhost:8000/api/jobs/${jobId}`);
-          if (!statusResponse.ok) {
-            throw new Error("ジョブステータスの取得に失敗しました");
+          const jobStatus = await api.getJobStatus(jobId);
+          setJobInfo(jobStatus as JobInfo);
+        } catch (error) {
+          console.error("Error fetching job result:", error);
+        }
+      };
+
+      // ジョブの進捗をサーバーからのプッシュで受け取る
+      stopSubscription();
+      unsubscribeRef.current = api.subscribeJobEvents(jobId, {
+        onSnapshot: (job) => {
+          setJobInfo((prev) => (prev ? applyJobDelta(prev, job as Partial<JobInfo>) : (job as JobInfo)));
+          if (isTerminalStatus(job.status as JobStatus)) {
+            finishJob();
           }
-
-          const jobStatus = await statusResponse.json();
-          setJobInfo(jobStatus);
-
-          // ジョブが完了またはエラーの場合、ポーリングを停止
-          if (jobStatus.status === "completed" || jobStatus.status === "error") {
-            clearInterval(pollInterval);
-
-            // 完了時にプレビューを更新
-            if (jobStatus.status === "completed" && jobStatus.result && iframeRef.current) {
-              updateIframeContent(
-                iframeRef.current,
-                jobStatus.result.html,
-                jobStatus.result.css,
-                jobStatus.result.js,
-                jobStatus.result.imageBase64
-              );
-            }
+        },
+        onUpdate: (delta) => {
+          setJobInfo((prev) => (prev ? applyJobDelta(prev, delta as Partial<JobInfo>) : prev));
+          if (isTerminalStatus(delta.status as JobStatus)) {
+            finishJob();
           }
-        } catch (error) {
-          console.error("Error polling job status:", error);
-          clearInterval(pollInterval);
+        },
+        onError: (error) => {
+          console.error("Error receiving job events:", error);
+          stopSubscription();
           setJobInfo((prev) =>
             prev
               ? {
@@ -229,8 +283,8 @@ const App = () => {
                 }
               : null
           );
-        }
-      }, 3000); // 3秒ごとにポーリング
+        },
+      });
     } catch (error) {
       console.error("Error starting job:", error);
       setJobInfo({
@@ -246,6 +300,8 @@ const App = () => {
 
   // ジョブのリセット - 新しいLP生成を開始できるようにする
   const resetJob = () => {
+    stopSubscription();
+    forceNewJobRef.current = true;
     setJobInfo(null);
   };
 
@@ -257,10 +313,10 @@ const App = () => {
         jobInfo.result.html,
         jobInfo.result.css,
         jobInfo.result.js,
-        jobInfo.result.imageBase64
+        api.getAssetUrl(jobInfo.jobId)
       );
     }
-  }, [jobInfo?.result, jobInfo?.status]);
+  }, [jobInfo?.jobId, jobInfo?.result, jobInfo?.status]);
 
   // 日本語のステップ名を取得
 
@@ -424,7 +480,11 @@ const App = () => {
                     <CardHeader className="pb-3">
                       <CardTitle>生成中...</CardTitle>
                       <CardDescription>
-                        LPを生成しています。しばらくお待ちください。
+                        {jobInfo.status === "pending" && jobInfo.queuePosition
+                          ? `順番待ちです（${jobInfo.queuePosition}番目、約${Math.ceil(
+                              (jobInfo.estimatedWaitSeconds ?? 0) / 60
+                            )}分）。しばらくお待ちください。`
+                          : "LPを生成しています。しばらくお待ちください。"}
                       </CardDescription>
                     </CardHeader>
                     <CardContent className="flex-1 flex items-center justify-center">
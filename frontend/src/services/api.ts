@@ -1,4 +1,4 @@
-import { LPGenerationData, JobStatus } from "@/types";
+import { LPGenerationData, JobStatus, JobListResponse, JobPartialOutput, BatchStatus } from "@/types/types";
 
 // APIの基本URL
 const API_BASE_URL = import.meta.env.VITE_API_URL || "http://localhost:8000/api";
@@ -24,9 +24,14 @@ const checkResponse = async (response: Response) => {
 // API呼び出しをまとめたオブジェクト
 const api = {
   // LP生成ジョブを開始する
-  startGeneration: async (data: LPGenerationData): Promise<{ jobId: string }> => {
+  // 同じ入力で待機中・実行中のジョブがあればそのジョブが返る（coalesced: true）。coalesce: false で常に新しく生成する
+  startGeneration: async (
+    data: LPGenerationData,
+    options: { coalesce?: boolean } = {}
+  ): Promise<{ jobId: string; coalesced?: boolean }> => {
     try {
-      const response = await fetch(`${API_BASE_URL}/generate`, {
+      const query = options.coalesce === false ? "?coalesce=false" : "";
+      const response = await fetch(`${API_BASE_URL}/generate${query}`, {
         method: "POST",
         headers: {
           "Content-Type": "application/json",
@@ -41,6 +46,54 @@ const api = {
     }
   },
 
+  // 複数のLP生成ジョブをバッチとしてまとめて開始する
+  startBatchGeneration: async (
+    items: LPGenerationData[],
+    name?: string
+  ): Promise<{ batchId: string; jobIds: string[] }> => {
+    try {
+      const response = await fetch(`${API_BASE_URL}/generate/batch`, {
+        method: "POST",
+        headers: {
+          "Content-Type": "application/json",
+        },
+        body: JSON.stringify({ items, name }),
+      });
+
+      return checkResponse(response);
+    } catch (error) {
+      console.error("Error starting batch generation:", error);
+      throw error;
+    }
+  },
+
+  // バッチ全体の進捗と各ジョブの状態を取得する
+  getBatchStatus: async (batchId: string): Promise<BatchStatus> => {
+    try {
+      const response = await fetch(`${API_BASE_URL}/batches/${batchId}`);
+      return checkResponse(response);
+    } catch (error) {
+      console.error(`Error getting batch status for ${batchId}:`, error);
+      throw error;
+    }
+  },
+
+  // バッチ内の完了したジョブの生成物をまとめてダウンロードする
+  downloadBatchResults: async (batchId: string): Promise<Blob> => {
+    try {
+      const response = await fetch(`${API_BASE_URL}/batches/${batchId}/download`);
+
+      if (!response.ok) {
+        throw new Error(`Download failed: ${response.status}`);
+      }
+
+      return await response.blob();
+    } catch (error) {
+      console.error(`Error downloading batch results for ${batchId}:`, error);
+      throw error;
+    }
+  },
+
   // ジョブの状態を取得する
   getJobStatus: async (jobId: string): Promise<JobStatus> => {
     try {
@@ -52,6 +105,61 @@ const api = {
     }
   },
 
+  // ジョブの進捗をServer-Sent Eventsで購読する（戻り値は購読解除関数）
+  // 接続直後に現在の状態全体（snapshot）、以降は変化した部分のみ（update）が届く
+  // 生成途中のテキストは partial として追加分のみが届く
+  subscribeJobEvents: (
+    jobId: string,
+    handlers: {
+      onSnapshot: (job: JobStatus) => void;
+      onUpdate: (delta: Partial<JobStatus>) => void;
+      onPartial?: (partial: JobPartialOutput) => void;
+      onError?: (error: Event) => void;
+    }
+  ): (() => void) => {
+    const source = new EventSource(`${API_BASE_URL}/jobs/${jobId}/events`);
+
+    source.addEventListener("snapshot", (event) => {
+      handlers.onSnapshot(JSON.parse((event as MessageEvent).data));
+    });
+    source.addEventListener("update", (event) => {
+      handlers.onUpdate(JSON.parse((event as MessageEvent).data));
+    });
+    source.addEventListener("partial", (event) => {
+      handlers.onPartial?.(JSON.parse((event as MessageEvent).data));
+    });
+    source.onerror = (error) => {
+      // 一時的な切断はブラウザが自動で再接続するため、完全に閉じた場合のみ通知する
+      if (source.readyState === EventSource.CLOSED) {
+        handlers.onError?.(error);
+      }
+    };
+
+    return () => source.close();
+  },
+
+  // ジョブ一覧を取得する（カーソルによるページング）
+  listJobs: async (
+    options: { limit?: number; cursor?: string; status?: string[]; fields?: string[] } = {}
+  ): Promise<JobListResponse> => {
+    try {
+      const params = new URLSearchParams();
+      if (options.limit) params.set("limit", String(options.limit));
+      if (options.cursor) params.set("cursor", options.cursor);
+      if (options.status?.length) params.set("status", options.status.join(","));
+      if (options.fields?.length) params.set("fields", options.fields.join(","));
+
+      const response = await fetch(`${API_BASE_URL}/jobs?${params.toString()}`);
+      return checkResponse(response);
+    } catch (error) {
+      console.error("Error listing jobs:", error);
+      throw error;
+    }
+  },
+
+  // ジョブの生成物（画像など）のURL（name を省略するとアセットの基準URL）
+  getAssetUrl: (jobId: string, name = ""): string => `${API_BASE_URL}/jobs/${jobId}/assets/${name}`,
+
   // 生成結果をダウンロードする
   downloadResults: async (jobId: string): Promise<Blob> => {
     try {
@@ -81,6 +189,34 @@ const api = {
       throw error;
     }
   },
+
+  // 指定したステップ以降だけを作り直す新しいジョブを開始する（それ以前のステップの出力は再利用される）
+  regenerateStep: async (jobId: string, stepId: string): Promise<{ jobId: string }> => {
+    try {
+      const response = await fetch(`${API_BASE_URL}/jobs/${jobId}/steps/${stepId}/regenerate`, {
+        method: "POST",
+      });
+
+      return checkResponse(response);
+    } catch (error) {
+      console.error(`Error regenerating step ${stepId} of job ${jobId}:`, error);
+      throw error;
+    }
+  },
+
+  // 待機中・実行中のジョブをキャンセルする
+  cancelJob: async (jobId: string): Promise<{ jobId: string; status: string }> => {
+    try {
+      const response = await fetch(`${API_BASE_URL}/jobs/${jobId}`, {
+        method: "DELETE",
+      });
+
+      return checkResponse(response);
+    } catch (error) {
+      console.error(`Error cancelling job ${jobId}:`, error);
+      throw error;
+    }
+  },
 };
 
 export default api;
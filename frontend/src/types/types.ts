@@ -13,22 +13,85 @@ export interface Step {
   id: string;
   name: string;
   description: string;
-  status: "pending" | "processing" | "completed" | "error";
+  status: "pending" | "processing" | "completed" | "error" | "cancelled";
   progress: number;
+  outputTokens?: number;
+  outputChars?: number;
+  inputTokens?: number;
+  cacheCreationInputTokens?: number;
+  cacheReadInputTokens?: number;
+  reused?: boolean;
+  startedAt?: string | null;
+  completedAt?: string | null;
+  wallSeconds?: number | null;
+  queueWaitSeconds?: number;
+  retries?: number;
+  outputBytes?: Record<string, number>;
 }
 
 // ジョブ状態の型定義
 export interface JobStatus {
   jobId: string;
-  status: "idle" | "pending" | "processing" | "completed" | "error";
+  status: "idle" | "pending" | "processing" | "completed" | "error" | "cancelled";
   progress: number;
   currentStep: string;
   steps: Step[];
   error?: string;
+  queuePosition?: number | null;
+  estimatedWaitSeconds?: number | null;
+  // 保持期間を過ぎて生成物が削除された日時（状態などの概要のみ残る）
+  purgedAt?: string | null;
   result?: {
     html: string;
     css: string;
     js: string;
     imageUrls: string[];
+    imageVariants?: ImageVariant[];
   };
 }
+
+// ヒーロー画像の派生ファイル（幅・形式違い）
+export interface ImageVariant {
+  url: string;
+  width: number;
+  format: "jpg" | "webp" | "avif";
+}
+
+// ジョブ一覧の要約（既定では result を含まない）
+export type JobSummary = Partial<JobStatus> & Pick<JobStatus, "jobId">;
+
+// ジョブ一覧のレスポンス
+export interface JobListResponse {
+  jobs: JobSummary[];
+  nextCursor: string | null;
+}
+
+// バッチ内の各ジョブの状態
+export interface BatchJobSummary {
+  jobId: string;
+  serviceName?: string;
+  status: JobStatus["status"];
+  progress: number;
+  currentStep: string;
+  error?: string | null;
+  queuePosition?: number | null;
+}
+
+// バッチ全体の状態
+export interface BatchStatus {
+  batchId: string;
+  name?: string | null;
+  createdAt: string;
+  status: "pending" | "processing" | "completed" | "partial" | "error" | "cancelled";
+  progress: number;
+  total: number;
+  counts: Record<string, number>;
+  jobs: BatchJobSummary[];
+}
+
+// ストリーミング中に届く生成途中のテキスト（offset 文字目以降の追加分）
+export interface JobPartialOutput {
+  stepId: string;
+  offset: number;
+  text: string;
+}